@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import chart
+import database
+import monitor
+import rollup
+import scheduler
+import stats
+import storage
+import tempsensor
+import w1sim
+
+# benchmark.py
+# ============
+# times the parts of the monitor and the chart that grow with the
+# number of probes and the size of the database:
+#
+#   read_sensors     - one read cycle over a simulated fleet (w1sim.py),
+#                      one probe after another and concurrently
+#   log_data         - rows/s written connecting and committing every
+#                      cycle, as the old loop did, and by a
+#                      monitor.LogWriter, every cycle and batched
+#   get_data         - the chart's query for the last day, raw and at
+#                      the resolution the chart would pick
+#   create_table_all - rendering the last day's rows as the chart table
+#
+# The synthetic databases are kept in --work-dir and reused, building
+# a 10M row one takes a while. Each run is appended to --results as a
+# line of JSON and compared against the previous run with the same
+# settings, so a change that slows something down shows up.
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+DB_SENSORS = 8  # probes in the synthetic databases
+DB_PERIOD = 5  # seconds between their readings
+
+
+def best_time(fn, repeat):
+    best = None
+    result = None
+    for i in range(repeat):
+        started = scheduler.monotonic()
+        result = fn()
+        elapsed = scheduler.monotonic() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+# bench_read_sensors()
+# ====================
+# a read cycle for each fleet size, the sequential read takes
+# count * latency so it's left out when that's more than "max_seconds"
+def bench_read_sensors(results, counts, latency, crc_failures, repeat, max_seconds=10.0):
+    for count in counts:
+        bus = w1sim.SimulatedBus(count, latency=latency, crc_failures=crc_failures, seed=count)
+        work_dir = tempfile.mkdtemp(prefix="bench-")
+        try:
+            sensor_mgr = tempsensor.SensorsMgr(os.path.join(work_dir, "sensors.db"), bus=bus)
+            sensor_mgr.initialize_sensors()
+
+            if count * latency <= max_seconds:
+                seconds, failures = best_time(lambda: sensor_mgr.read_sensors(None), repeat)
+                record(results, "read_sensors sequential n={0}".format(count), seconds, len(failures))
+
+            timeout = latency * 4 + 1.0
+            seconds, failures = best_time(lambda: sensor_mgr.read_sensors(timeout), repeat)
+            record(results, "read_sensors concurrent n={0}".format(count), seconds, len(failures))
+        finally:
+            bus.close()
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return
+
+
+# bench_log_data()
+# ================
+# "cycles" cycles of readings from "sensors" probes written the way
+# the old loop did (monitor.log_data(): connect, insert, commit and
+# close every cycle), then by a LogWriter flushing every cycle on its
+# one connection and in batches of a minute
+def bench_log_data(results, sensors, cycles, repeat):
+    start = time.time() - cycles * DB_PERIOD
+    batches = []
+    for cycle in range(cycles):
+        timestamp = monitor.format_timestamp(start + cycle * DB_PERIOD)
+        batches.append([(timestamp, 20.0 + random.random(), sensor) for sensor in range(1, sensors + 1)])
+    rows = cycles * sensors
+
+    def write_per_cycle(db_name):
+        for batch in batches:
+            conn = database.connect(db_name)
+            inserted = storage.insert_rows(conn, batch)
+            rollup.update_rollups(conn, inserted)
+            stats.update_stats(conn, inserted)
+            conn.commit()
+            conn.close()
+
+    def write_batched(flush_samples):
+        def write(db_name):
+            writer = monitor.LogWriter(db_name, flush_samples, 3600.0)
+            for batch in batches:
+                writer.add_rows(batch)
+            writer.close()
+        return write
+
+    for name, write in (("log_data per cycle", write_per_cycle),
+                        ("LogWriter flush every cycle", write_batched(1)),
+                        ("LogWriter batched", write_batched(60))):
+        work_dir = tempfile.mkdtemp(prefix="bench-")
+        try:
+            def run():
+                db_name = os.path.join(work_dir, "log{0}.db".format(random.getrandbits(32)))
+                monitor.create_log_schema(db_name)
+                write(db_name)
+
+            seconds, result = best_time(run, repeat)
+            record(results, "{0} n={1}".format(name, sensors), seconds, rows, rows / seconds, "rows/s")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return
+
+
+# make_database()
+# ===============
+# "rows" readings from DB_SENSORS probes, DB_PERIOD seconds apart and
+# ending now, with the indexes and rollups monitor.py would have made,
+# moved to the compact format with "compact"
+def make_database(db_name, rows, verbose=False, compact=False):
+    sensor_mgr = tempsensor.SensorsMgr(db_name)
+    sensor_mgr.create_sensor_schema()
+    conn = database.connect(db_name)
+    conn.executemany("INSERT INTO Sensor (serial_id) VALUES(?)",
+                     [("{0}{1:012x}".format(tempsensor.DS18B20_FAMILY, w1sim.SERIAL_BASE + i),)
+                      for i in range(DB_SENSORS)])
+    conn.execute("CREATE TABLE Temperature([timestamp] TIMESTAMP, temp NUMERIC, sensor INTEGER);")
+
+    rng = random.Random(rows)
+    cycles = (rows + DB_SENSORS - 1) // DB_SENSORS
+    start = time.time() - cycles * DB_PERIOD
+    temps = [20.0] * DB_SENSORS
+
+    def generate():
+        written = 0
+        for cycle in range(cycles):
+            timestamp = monitor.format_timestamp(start + cycle * DB_PERIOD)
+            for sensor in range(DB_SENSORS):
+                if written == rows:
+                    return
+                temps[sensor] += rng.gauss(0.0, 0.1)
+                written += 1
+                yield (timestamp, round(temps[sensor], 3), sensor + 1)
+
+    conn.executemany("INSERT INTO Temperature VALUES(?, ?, ?)", generate())
+    conn.commit()
+    conn.close()
+
+    # indexes, and the rollups via the backfill as for an old database
+    monitor.create_log_schema(db_name)
+    rollup.backfill(db_name, 100000, verbose)
+    if compact:
+        storage.migrate(db_name, 100000, verbose, True)
+    return
+
+
+def get_database(work_dir, rows, verbose=False, compact=False):
+    db_name = os.path.join(work_dir, "bench-{0}{1}.db".format(rows, "-compact" if compact else ""))
+    if not os.path.exists(db_name):
+        if verbose:
+            print "building {0} ({1} rows)".format(db_name, rows)
+        partial = db_name + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        make_database(partial, rows, verbose, compact)
+        os.rename(partial, db_name)
+    return db_name
+
+
+# bench_database()
+# ================
+# get_data() and create_table_all() for the chart's default window
+def bench_database(results, db_name, rows, repeat):
+    hours = chart.DEFAULT_ZOOM_HOURS
+    resolution = rollup.pick_resolution(hours * 3600, chart.CHART_POINTS)
+
+    seconds, data = best_time(lambda: chart.get_data(hours, db_name), repeat)
+    record(results, "get_data raw {0}h rows={1}".format(hours, rows), seconds, len(data))
+
+    start = chart.time_offset(datetime.datetime.now(), -hours)
+    seconds, summary = best_time(lambda: chart.get_data(None, db_name, start=start, resolution=resolution), repeat)
+    record(results, "get_data {0} {1}h rows={2}".format(resolution, hours, rows), seconds, len(summary))
+
+    seconds, table = best_time(lambda: chart.create_table_all(data, db_name), repeat)
+    record(results, "create_table_all {0}h rows={1}".format(hours, rows), seconds, len(data))
+    return
+
+
+def record(results, name, seconds, count, rate=None, units=None):
+    result = {'name': name, 'seconds': seconds, 'count': count}
+    line = "{0:<44}{1:>12.2f} ms{2:>10}".format(name, seconds * 1000, count)
+    if rate is not None:
+        result['rate'] = rate
+        line += "{0:>14.0f} {1}".format(rate, units)
+    results.append(result)
+    print line
+
+
+# compare()
+# =========
+# how each result has changed since the last run with the same settings
+def compare(results, results_file, settings):
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as run_file:
+            for line in run_file:
+                run = json.loads(line)
+                if run.get('settings') == settings:
+                    previous = run
+
+    if previous is None:
+        print "no earlier run with these settings in {0}".format(results_file)
+        return
+
+    print "compared with the run of {0}".format(previous['time'])
+    before = dict((result['name'], result['seconds']) for result in previous['results'])
+    for result in results:
+        seconds = before.get(result['name'])
+        if seconds is None or seconds == 0:
+            continue
+        change = (result['seconds'] - seconds) * 100.0 / seconds
+        print "{0:<44}{1:>+11.1f}%{2}".format(result['name'], change, "  <-- slower" if change > 10.0 else "")
+
+
+def save(results, results_file, settings):
+    run = {'time': datetime.datetime.now().strftime(chart.TIME_FORMAT),
+           'host': platform.node(),
+           'python': platform.python_version(),
+           'sqlite': sqlite3.sqlite_version,
+           'settings': settings,
+           'results': results}
+    with open(results_file, "a") as run_file:
+        run_file.write(json.dumps(run, sort_keys=True) + "\n")
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(",") if count.strip() != ""]
+
+
+def create_parser():
+    parser = OptionParser(usage="benchmark.py [options]",
+                          description="Times sensor reads, logging and the chart against simulated probes and synthetic databases")
+
+    parser.add_option("--sensors", dest="sensors", default="1,8,64,1000",
+                      help="comma separated fleet sizes for read_sensors")
+
+    parser.add_option("--latency", dest="latency", default=w1sim.DEFAULT_LATENCY, type="float",
+                      help="seconds a simulated probe takes to answer")
+
+    parser.add_option("--crc-failures", dest="crc_failures", default=0.0, type="float",
+                      help="fraction of simulated reads with a bad CRC")
+
+    parser.add_option("--log-cycles", dest="log_cycles", default=720, type="int",
+                      help="cycles of readings to write for log_data")
+
+    parser.add_option("--rows", dest="rows", default="10000,100000,1000000",
+                      help="comma separated sizes of the synthetic databases (10000000 works, slowly)")
+
+    parser.add_option("--compact", dest="compact", default=False, action="store_true",
+                      help="store the synthetic databases in the compact format (see storage.py)")
+
+    parser.add_option("--repeat", dest="repeat", default=3, type="int",
+                      help="runs of each measurement, the best is kept")
+
+    parser.add_option("--work-dir", dest="work_dir", default=tempfile.gettempdir(),
+                      help="where to keep the synthetic databases", metavar="DIR")
+
+    parser.add_option("-o", "--results", dest="results_file", default=RESULTS_FILE,
+                      help="file to append the results to", metavar="FILE")
+
+    parser.add_option("--only", dest="only", default=None,
+                      help="run just one of read_sensors, log_data, database")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if opts.repeat < 1 or opts.only not in (None, 'read_sensors', 'log_data', 'database'):
+        parser.print_help()
+        sys.exit(-1)
+
+    settings = {'sensors': opts.sensors, 'latency': opts.latency, 'crc_failures': opts.crc_failures,
+                'log_cycles': opts.log_cycles, 'rows': opts.rows, 'compact': opts.compact, 'only': opts.only}
+    results = []
+
+    if opts.only in (None, 'read_sensors'):
+        bench_read_sensors(results, parse_counts(opts.sensors), opts.latency, opts.crc_failures, opts.repeat)
+
+    if opts.only in (None, 'log_data'):
+        for count in parse_counts(opts.sensors):
+            bench_log_data(results, count, opts.log_cycles, opts.repeat)
+
+    if opts.only in (None, 'database'):
+        for rows in parse_counts(opts.rows):
+            bench_database(results, get_database(opts.work_dir, rows, True, opts.compact), rows, opts.repeat)
+
+    compare(results, opts.results_file, settings)
+    save(results, opts.results_file, settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,30 @@ import sqlite3
 import sys
 import cgi
 import cgitb
+import datetime
+import hashlib
+import json
+import os
+import urllib
 import tempsensor
+import rollup
+import downsample
+import storage
+import database
+import live
+import retention
+import stats
 
 dbname = "/home/pi/sensorlog.db"
 
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'	# how monitor.py writes [timestamp]
+DEFAULT_ZOOM_HOURS = 24			# window shown when no range is asked for
+PAGE_ROWS = 20000				# most rows we will put in one page
+CHART_POINTS = 600				# points per sensor that fill the chart
+FETCH_ROWS = 1000				# rows per fetchmany() when streaming
+LIVE_BUFFER = live.DEFAULT_PATH	# where the monitor publishes its latest readings
+ARCHIVE_DIR = retention.DEFAULT_ARCHIVE	# where raw rows past the retention go
+
 def printHTTPheader():
 	print "Content-type: text/html\n\n"
 
@@ -23,74 +43,283 @@ def printHTMLHead(title, table, fahrenheit = False):
 
 
 
-def get_data(interval_hours, db_name):
-	conn = sqlite3.connect(db_name)
-	curs = conn.cursor()
+# get_data()
+# ==========
+# returns the (sensor, timestamp, temp, rowid) rows in time order.
+# The range can be given as the last "interval_hours" or as start/end
+# timestamps ('%Y-%m-%d %H:%M:%S', end is exclusive), all of them
+# passed as bound parameters so the [timestamp] index is used.
+# With a "limit" only that many rows are returned, starting after the
+# "after" cursor - see get_data_page(). A "resolution" reads the
+# average of each bucket from that rollup table instead of raw rows.
 
-	if interval_hours == None:
-		curs.execute("select sensor, [timestamp], [temp] from Temperature ORDER BY [timestamp]")
-	else:
-		curs.execute("select sensor, [timestamp], [temp] from Temperature where [timestamp] > datetime('now', '-%s hours') ORDER BY [timestamp]" % interval_hours)
+def get_data(interval_hours, db_name, start=None, end=None, after=None, limit=None, resolution=None):
+	if interval_hours != None:
+		start = time_offset(datetime.datetime.now(), -float(interval_hours))
 
-	rows = curs.fetchall()
+	conn = database.open_reader(db_name)
+	rows = list(open_data(conn, start, end, after, limit, resolution))
 	conn.close()
 	return rows
 
-def create_table_all(rows, db_name, fahrenheit = False):
-	if rows == None:
+# query_data()
+# ============
+# runs the get_data() query on "curs" and leaves the rows to be
+# fetched, so they can be streamed with iter_rows().
+#
+# Raw rows can be in the text Temperature table, the compact table
+# (see storage.py) or, part way through a migration, both. Compact
+# rows come back in the same shape, their timestamp turned back into
+# text and with -sensor in place of the rowid: negative so it can't
+# collide with a text row's rowid in the (timestamp, rowid) cursor.
+
+def query_data(curs, interval_hours, start=None, end=None, after=None, limit=None, resolution=None):
+	if interval_hours != None:
+		start = time_offset(datetime.datetime.now(), -float(interval_hours))
+
+	if resolution != None:
+		sel_sql = "select sensor, [timestamp], total * 1.0 / samples, rowid from " + rollup.get_table(resolution)
+		sel_sql, params = add_range(sel_sql, "[timestamp]", "rowid", "rowid", start, end, after, limit)
+		curs.execute(sel_sql, params)
+		return curs
+
+	queries = []
+	for fmt in storage.get_formats(curs.connection):
+		if fmt == 'text':
+			sel_sql = "select sensor, [timestamp], [temp], rowid from Temperature"
+			queries.append(add_range(sel_sql, "[timestamp]", "rowid", "rowid", start, end, after, limit))
+		else:
+			# (time, -sensor) order is (time, sensor DESC), which the
+			# TemperatureCompactTime index gives us without a sort
+			sel_sql = ("select sensor, datetime([time], 'unixepoch', 'localtime'), millic / 1000.0, -sensor "
+					   "from TemperatureCompact")
+			queries.append(add_range(sel_sql, "[time]", "-sensor", "sensor DESC", to_epoch(start), to_epoch(end),
+									 after and (storage.to_epoch(after[0]), after[1]), limit))
+
+	if len(queries) == 1:
+		curs.execute(queries[0][0], queries[0][1])
+		return curs
+
+	# both formats, merge them (each side is already in order and limited)
+	sel_sql = " union all ".join("select * from ({0})".format(query[0]) for query in queries)
+	sel_sql += " ORDER BY 2, 4"
+	params = []
+	for query in queries:
+		params.extend(query[1])
+	if limit != None:
+		sel_sql += " LIMIT ?"
+		params.append(limit)
+
+	curs.execute(sel_sql, params)
+	return curs
+
+# add_range()
+# ===========
+# the where, order and limit clauses for a get_data() query on a table
+# whose time column is "time_col" and whose rows are told apart within
+# a second by "key_col" (sorted by "key_order").
+
+def add_range(sel_sql, time_col, key_col, key_order, start, end, after, limit):
+	where = []
+	params = []
+	if start != None:
+		where.append(time_col + " >= ?")
+		params.append(start)
+	if end != None:
+		where.append(time_col + " < ?")
+		params.append(end)
+	if after != None:
+		# keyset pagination, (timestamp, rowid) is unique and the
+		# [timestamp] index already carries the rowid so no sort is needed
+		where.append("{0} >= ? AND ({0} > ? OR {1} > ?)".format(time_col, key_col))
+		params.extend([after[0], after[0], after[1]])
+	if len(where) != 0:
+		sel_sql += " where " + " AND ".join(where)
+
+	sel_sql += " ORDER BY {0}, {1}".format(time_col, key_order)
+	if limit != None:
+		sel_sql += " LIMIT ?"
+		params.append(limit)
+	return sel_sql, params
+
+def to_epoch(timestamp):
+	if timestamp == None:
 		return None
+	return storage.to_epoch(timestamp)
 
-	# first see how many sensors logged data
+# get_live_rows()
+# ===============
+# the raw rows for the window from the monitor's live buffer (see
+# live.py) when it holds all of them, otherwise None and it's up to
+# the database. Only the latest raw readings are there, the rollups
+# always come from the database.
+
+def get_live_rows(start, end=None, after=None, limit=None, resolution=None):
+	if resolution != None or start == None:
+		return None
+	reader = live.open_reader(LIVE_BUFFER)
+	if reader == None:
+		return None
+	rows = reader.get_rows(start, end, after, limit)
+	reader.close()
+	return rows
+
+# open_data()
+# ===========
+# an iterator over the get_data() rows on "conn", with the raw rows
+# that retention.py has moved out to the archive merged back in. The
+# archive is only read for days it has a segment for, so windows
+# within the retention cost a stat() or two.
+
+def open_data(conn, start=None, end=None, after=None, limit=None, resolution=None):
+	rows = iter_rows(query_data(conn.cursor(), None, start, end, after, limit, resolution))
+	if resolution != None:
+		return rows
+	return retention.merge_rows(rows, retention.read_archive(ARCHIVE_DIR, start, end, after), limit)
+
+def iter_rows(curs, size=FETCH_ROWS):
+	while True:
+		rows = curs.fetchmany(size)
+		if len(rows) == 0:
+			return
+		for row in rows:
+			yield row
+
+# get_data_page()
+# ===============
+# one page of rows plus the cursor to pass as "after" for the next
+# page, the cursor is None when there is nothing more to read.
+
+def get_data_page(db_name, start=None, end=None, after=None, limit=PAGE_ROWS, resolution=None):
+	rows = get_data(None, db_name, start, end, after, limit, resolution)
+	if len(rows) < limit:
+		return rows, None
+
+	last_row = rows[-1]
+	return rows, (last_row[1], last_row[3])
+
+def time_offset(timestamp, hours):
+	return (timestamp + datetime.timedelta(hours=hours)).strftime(TIME_FORMAT)
+
+def parse_time(value):
+	for time_format in (TIME_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+		try:
+			return datetime.datetime.strptime(value, time_format)
+		except ValueError:
+			continue
+	return None
+
+def parse_cursor(value):
+	if value == None:
+		return None
+	parts = value.rsplit('|', 1)
+	if len(parts) != 2 or parse_time(parts[0]) == None or not parts[1].lstrip('-').isdigit():
+		return None
+	return parts[0], int(parts[1])
+
+def format_cursor(cursor):
+	return "{0}|{1}".format(cursor[0], cursor[1])
+
+# scan_rows()
+# ===========
+# one pass over the rows to find the sensors in the order they first
+# appear along with their first temperature (the table header and the
+# starting column values), the number of rows and the last row.
+
+def scan_rows(rows):
 	sensors = []
-	output_temps = []
+	first_temps = []
+	columns = {}
+	row_count = 0
+	last_row = None
 	for row in rows:
-		if row[0] not in sensors:
+		if row[0] not in columns:
+			columns[row[0]] = len(sensors)
 			sensors.append(row[0])
-			output_temps.append(row[2])
+			first_temps.append(row[2])
+		row_count += 1
+		last_row = row
 
-	# the number of sensors is len(sensors)
+	return sensors, first_temps, row_count, last_row
+
+def create_table_all(rows, db_name, fahrenheit = False):
+	if rows == None:
+		return None
+
+	# first see how many sensors logged data
+	sensors, output_temps, row_count, last_row = scan_rows(rows)
 
 	sensor_mgr = tempsensor.SensorsMgr(db_name)
 	sensor_mgr.read_sensors_from_db()	# get the list of sensors from the db!
 
-	# Now let's create our composite data table
-	current_timestamp = rows[0][1]
-	IsFirstRow = True
+	return "".join(create_table_chunks(rows, sensors, output_temps, sensor_mgr, fahrenheit))
+
+# get_column_label()
+# ==================
+# what a sensor is called in the chart and the stats, "T[<label>]" for
+# a temperature, with the units after anything else ("H[...] %").
+
+def get_column_label(sensor):
+	if sensor.is_temperature():
+		return "T[{0}]".format(sensor.get_label())
+	return "H[{0}] {1}".format(sensor.get_label(), sensor.get_units())
+
+# create_table_chunks()
+# =====================
+# generates the data table a piece at a time (the header, then one
+# chart row per timestamp) so it can be written out as the rows are
+# read. Each row carries the last temperature seen for every sensor
+# the header has a column for.
+# Only the temperatures are converted to F, a humidity stays in %.
+# Note that the final timestamp is still being accumulated when the
+# rows run out and is never written.
+
+def create_table_chunks(rows, sensors, output_temps, sensor_mgr, fahrenheit = False):
+	columns = dict((sensors[i], i) for i in range(len(sensors)))
+	output_temps = list(output_temps)
+	convert = [False] * len(sensors)
 
 	# create our header dynamically based on # of sensors found
-	chart_table = "['Time'"
+	header = "['Time'"
 	for i in range(len(sensors)):
 		sensor = sensor_mgr.get_sensor_by_index(sensors[i])
-		serial_id = sensor.get_serial_id()
-		chart_table += ",'T[{0}]'".format(serial_id[3:])
+		header += ",'{0}'".format(get_column_label(sensor))
+		convert[i] = fahrenheit == True and sensor.is_temperature()
 
-	chart_table += "],\n"
+	yield header + "],\n"
 
+	current_timestamp = None
+	IsFirstRow = True
 	for row in rows:
-		idx = sensors.index(row[0])
+		# a sensor whose first row was logged after scan_rows() looked
+		# has no column, the header has gone out without it
+		idx = columns.get(row[0])
+		if idx == None:
+			continue
+
 		temp = float(row[2])
-		if fahrenheit == True:
+		if convert[idx]:
 			temp = temp *1.8 + 32.0
 
+		if current_timestamp == None:
+			current_timestamp = row[1]
+
 		if row[1] == current_timestamp:
 			output_temps[idx] = temp   # update temperature from sensor if available
 		else: # output info we have accumulated a row's worth of data
 			rowstr = "['{0}'".format(current_timestamp)
-			for i in range(len(sensors)):
-				rowstr += ", {0}".format(output_temps[i])
+			for output_temp in output_temps:
+				rowstr += ", {0}".format(output_temp)
 
-			rowstr += "]" 
+			rowstr += "]"
 			current_timestamp = row[1]
 			output_temps[idx] = temp
 
 			if IsFirstRow == True:
-				chart_table += rowstr
 				IsFirstRow = False
+				yield rowstr
 			else:
-				chart_table += ",\n" + rowstr
-		
-	return chart_table
-
+				yield ",\n" + rowstr
 
 def print_graph_script(table, fahrenheight = False):
 
@@ -119,16 +348,24 @@ def print_graph_script(table, fahrenheight = False):
 	if fahrenheight == True:
 		temp_scale = '\xB0F'
 
-	print chart_code % (table, temp_scale)
+	# the table can be a string or chunks from create_table_chunks()
+	if isinstance(table, basestring):
+		table = [table]
 
-	return	
+	script_head, script_tail = chart_code.split("[%s]", 1)
+	sys.stdout.write(script_head + "[")
+	for chunk in table:
+		sys.stdout.write(chunk)
+	print "]" + script_tail % temp_scale
+
+	return
 
 def show_graph():
 	print"<h2>Temperature Chart</h2>"
 	print '<div id ="chart_div" style="width: 1200px; height: 600px;"></div>'
 	return
 
-def show_button(fahrenheit):
+def show_button(fahrenheit, window):
 	print "<form action=\"chart.py\" method=\"post\">"
 	if fahrenheit == True:
 		print "<input OnChange='this.form.submit();' type=\"radio\" name=\"temperature\" value=\"celsius\">\xB0Celsius<br>"
@@ -137,45 +374,260 @@ def show_button(fahrenheit):
 		print "<input OnChange='this.form.submit();' type=\"radio\" name=\"temperature\" value=\"celsius\" checked=\"checked\">\xB0Celsius<br>"
 		print "<input OnChange='this.form.submit();' type=\"radio\" name=\"temperature\" value=\"fahrenheit\">\xB0Fahrenheit<br>"
 
+	# keep looking at the same window when switching scales
+	for name in ('start', 'zoom', 'points', 'after'):
+		if window.get(name) != None:
+			print "<input type=\"hidden\" name=\"{0}\" value=\"{1}\">".format(name, cgi.escape(str(window[name]), True))
+
 	print "</form>"
 	return
 
-def show_stats(db_name):
-	conn=sqlite3.conn(db_name)
-	curs=conn.cursor()
+# get_window()
+# ============
+# works out the time range to chart from the form, "start" and "end"
+# are timestamps and "zoom" is the width of the window in hours. With
+# no start we show the most recent "zoom" hours. Long windows are
+# drawn from the coarsest rollup that still fills the chart. "points"
+# is how many points per sensor to draw, 0 draws every row.
+
+def get_window(form):
+	zoom = DEFAULT_ZOOM_HOURS
+	try:
+		zoom = float(form.getvalue('zoom', DEFAULT_ZOOM_HOURS))
+	except ValueError:
+		pass
+	if zoom <= 0:
+		zoom = DEFAULT_ZOOM_HOURS
+
+	start = parse_time(form.getvalue('start', ''))
+	end = parse_time(form.getvalue('end', ''))
+	if start == None:
+		if end == None:
+			end = datetime.datetime.now()
+		start = end - datetime.timedelta(hours=zoom)
+	elif end == None:
+		end = start + datetime.timedelta(hours=zoom)
+	else:
+		zoom = (end - start).total_seconds() / 3600.0
+
+	points = CHART_POINTS
+	try:
+		points = int(form.getvalue('points', CHART_POINTS))
+	except ValueError:
+		pass
+
+	return {'start': start.strftime(TIME_FORMAT),
+			'end': end.strftime(TIME_FORMAT),
+			'zoom': zoom,
+			'points': points,
+			'resolution': rollup.pick_resolution(zoom * 3600, CHART_POINTS),
+			'after': form.getvalue('after')}
+
+def window_link(label, fahrenheit, start, zoom, after=None):
+	params = [('start', start), ('zoom', zoom)]
+	if after != None:
+		params.append(('after', after))
+	if fahrenheit == True:
+		params.append(('temperature', 'fahrenheit'))
+	return "<a href=\"chart.py?{0}\">{1}</a>".format(cgi.escape(urllib.urlencode(params), True), label)
+
+def show_navigation(fahrenheit, window, next_cursor):
+	start = parse_time(window['start'])
+	zoom = window['zoom']
+	resolution = window['resolution']
+	links = [window_link("&lt;&lt; earlier", fahrenheit, time_offset(start, -zoom), zoom),
+			 window_link("zoom out", fahrenheit, time_offset(start, -zoom / 2), zoom * 2),
+			 window_link("zoom in", fahrenheit, time_offset(start, zoom / 4), zoom / 2),
+			 window_link("later &gt;&gt;", fahrenheit, time_offset(start, zoom), zoom)]
+	if next_cursor != None:
+		links.append(window_link("next page", fahrenheit, window['start'], zoom, format_cursor(next_cursor)))
+
+	print "<p>{0} to {1} ({2})</p>".format(window['start'], window['end'], resolution or 'raw')
+	print "<p>" + "&nbsp;|&nbsp;".join(links) + "</p>"
+	return
+
+# show_stats()
+# ============
+# the stats panel, a row per sensor with its latest reading and the
+# min/max/mean/stddev over each of stats.WINDOWS and all time.
+# "sensor_stats" is what stats.get_stats() returned, a few rows kept up
+# to date by the monitor, so this doesn't grow with the log.
+
+def show_stats(sensor_stats, sensor_mgr, fahrenheit = False):
+	if sensor_stats == None or len(sensor_stats) == 0:
+		return
+
+	unit = "C"
+	if fahrenheit == True:
+		unit = "F"
 
-	curs.execute("SELECT [timestamp], max(temp) FROM Temperature")
-	rowmax = curs.fetchone()
-	rowstrmax = "{0}&nbsp&nbsp{1}C".format(str(rowmax[0]), str(rowmax[1]) )
+	def format_temp(temp):
+		if temp == None:
+			return "-"
+		return "{0:.2f}".format(temp * scale + offset)
 
 	print "<hr>"
-	print "<h2>Maximum Temperature</h2>"
-	print rowstrmax
+	print "<h2>Statistics</h2>"
+	print "<table border=1 cellpadding=3>"
+	print "<tr><th>Sensor</th><th>Latest</th><th>Period</th><th>Min {0}</th><th>Max {0}</th><th>Mean {0}</th><th>Std dev</th><th>Readings</th></tr>".format(unit)
+	for sensor_id, last_timestamp, last_temp, windows in sensor_stats:
+		sensor = sensor_mgr.get_sensor_by_index(sensor_id)
+		label = str(sensor_id)
+		scale, offset = 1.0, 0.0
+		if fahrenheit == True:
+			scale, offset = 1.8, 32.0
+		if sensor != None:
+			label = get_column_label(sensor)
+			if not sensor.is_temperature():
+				scale, offset = 1.0, 0.0
+
+		latest = "{0}&nbsp;&nbsp;{1}".format(format_temp(last_temp), last_timestamp)
+		print "<tr><td rowspan={0}>{1}</td><td rowspan={0}>{2}</td>".format(len(windows), cgi.escape(label), latest)
+		for i in range(len(windows)):
+			name, window = windows[i]
+			if i != 0:
+				print "<tr>"
+			if window.samples == 0:
+				print "<td>{0}</td><td colspan=5>no readings</td></tr>".format(name)
+				continue
+			stddev = window.get_stddev() * scale
+			print "<td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4:.3f}</td><td>{5}</td></tr>".format(
+				name, format_temp(window.min_temp), format_temp(window.max_temp), format_temp(window.mean),
+				stddev, window.samples)
+	print "</table>"
 	print "<hr>"
+	return
+
+# get_series_range()
+# ==================
+# where the rows for a JSON request start. "since" is the cursor the
+# previous response handed back, for raw rows we carry on after it.
+# Rollup buckets keep changing until they close so for those we send
+# the last bucket again and the client replaces the point it has.
+
+def get_series_range(window, since):
+	start = window['start']
+	after = None
+	if since != None:
+		if window['resolution'] == None:
+			after = since
+		elif since[0] > start:
+			start = since[0]
+	return start, after
+
+# create_series()
+# ===============
+# turns the rows into one series per sensor for the JSON data API,
+#   {"units": "C", "resolution": null, "since": "<cursor>", "more": false,
+#    "sensors": [{"sensor": 1, "serial_id": "28-...", "units": "C", "points": [["<timestamp>", 21.5], ...]}]}
+# the sensor's "units" is F or C for a temperature, a humidity is "%".
+# "since" goes back on the next request to only get newer points and
+# "more" says the response was cut off at "limit" rows.
+
+def create_series(rows, sensor_mgr, fahrenheit, resolution, since=None, limit=PAGE_ROWS):
+	series = {}
+	sensors = []
+	convert = {}
+	row_count = 0
+	for row in rows:
+		points = series.get(row[0])
+		if points == None:
+			points = series[row[0]] = []
+			sensors.append(row[0])
+			sensor = sensor_mgr.get_sensor_by_index(row[0])
+			convert[row[0]] = fahrenheit == True and (sensor == None or sensor.is_temperature())
 
+		temp = float(row[2])
+		if convert[row[0]]:
+			temp = temp *1.8 + 32.0
+		points.append([row[1], round(temp, 3)])
+
+		row_count += 1
+		since = (row[1], row[3])
+
+	result = {'units': 'F' if fahrenheit == True else 'C',
+			  'resolution': resolution,
+			  'since': format_cursor(since) if since != None else None,
+			  'more': row_count == limit,
+			  'sensors': []}
+	for sensor_id in sensors:
+		sensor = sensor_mgr.get_sensor_by_index(sensor_id)
+		units = result['units']
+		if sensor != None and not sensor.is_temperature():
+			units = sensor.get_units()
+		result['sensors'].append({'sensor': sensor_id,
+								  'serial_id': sensor.get_serial_id() if sensor != None else None,
+								  'units': units,
+								  'points': series[sensor_id]})
+	return result
+
+# create_json()
+# =============
+# the response body and its ETag, the tag only depends on the body so
+# a client polling an unchanged window gets the same one back.
+
+def create_json(series):
+	body = json.dumps(series, separators=(',', ':'))
+	return body, '"' + hashlib.md5(body).hexdigest() + '"'
+
+def etag_matches(etag, if_none_match):
+	if if_none_match == None:
+		return False
+	tags = [tag.strip() for tag in if_none_match.split(',')]
+	return etag in tags or '*' in tags
+
+def print_json(db_name, form, fahrenheit):
+	window = get_window(form)
+	since = parse_cursor(form.getvalue('since'))
+	start, after = get_series_range(window, since)
+
+	conn = database.open_reader(db_name)
+	rows = get_live_rows(start, window['end'], after, PAGE_ROWS, window['resolution'])
+	if rows == None:
+		rows = open_data(conn, start, window['end'], after, PAGE_ROWS, window['resolution'])
+
+	sensor_mgr = tempsensor.SensorsMgr(db_name)
+	sensor_mgr.read_sensors_from_db()
+
+	body, etag = create_json(create_series(rows, sensor_mgr, fahrenheit, window['resolution'], since))
 	conn.close()
-	return
 
-def main():
-	cgitb.enable()
+	if etag_matches(etag, os.environ.get('HTTP_IF_NONE_MATCH')):
+		print "Status: 304 Not Modified"
+		print "ETag: " + etag + "\n"
+		return
 
-	form = cgi.FieldStorage()
-	fahrenheit = False	# default display to celsius
-	if form != None:
-		value = form.getvalue('temperature')
-		if value == 'fahrenheit':
-			fahrenheit = True
+	print "Content-type: application/json"
+	print "ETag: " + etag + "\n"
+	sys.stdout.write(body)
+	return
 
-	records = get_data(None, dbname)
+# print_page()
+# ============
+# prints the page for "window". "open_rows" returns a new iterator
+# over the page's rows each time it is called, we make two passes,
+# the first to find the sensors for the header and the second streams
+# the table straight to stdout, thinned out to the window's "points"
+# per sensor on the way. "sensor_stats" (stats.get_stats()) adds the
+# stats panel below the chart.
 
-	printHTTPheader()
+def print_page(open_rows, sensor_mgr, window, fahrenheit, sensor_stats=None):
+	sensors, first_temps, row_count, last_row = scan_rows(open_rows())
 
-	if len(records) != 0:
-		table = create_table_all(records, dbname, fahrenheit)
-	else:
+	if row_count == 0:
 		print "No data found!"
 		return
 
+	next_cursor = None
+	if row_count == PAGE_ROWS:
+		next_cursor = (last_row[1], last_row[3])
+
+	chart_rows = open_rows()
+	if window['points'] > 0:
+		chart_rows = downsample.minmax(chart_rows, window['start'], window['end'], window['points'])
+
+	table = create_table_chunks(chart_rows, sensors, first_temps, sensor_mgr, fahrenheit)
+
 	# start printing the page
 	print "<html>"
 	printHTMLHead("Raspberry Pi Temperature logger", table, fahrenheit)
@@ -184,10 +636,48 @@ def main():
 	print "<h1>Raspberry Pi Temperature Logger</h1>"
 	print "<hr>"
 	show_graph()
-	show_button(fahrenheit)
+	show_navigation(fahrenheit, window, next_cursor)
+	show_button(fahrenheit, window)
+	show_stats(sensor_stats, sensor_mgr, fahrenheit)
 
 	print "</body>"
 	print "</html>"
+	return
+
+def main():
+	cgitb.enable()
+
+	form = cgi.FieldStorage()
+	fahrenheit = False	# default display to celsius
+	if form != None:
+		value = form.getvalue('temperature')
+		if value == 'fahrenheit':
+			fahrenheit = True
+
+	# ?format=json is the data API, see create_series()
+	if form.getvalue('format') == 'json':
+		print_json(dbname, form, fahrenheit)
+		sys.stdout.flush()
+		return
+
+	window = get_window(form)
+	after = parse_cursor(window['after'])
+
+	conn = database.open_reader(dbname)
+
+	rows = get_live_rows(window['start'], window['end'], after, PAGE_ROWS, window['resolution'])
+
+	def open_rows():
+		if rows != None:
+			return iter(rows)
+		return open_data(conn, window['start'], window['end'], after, PAGE_ROWS, window['resolution'])
+
+	sensor_mgr = tempsensor.SensorsMgr(dbname)
+	sensor_mgr.read_sensors_from_db()	# get the list of sensors from the db!
+
+	printHTTPheader()
+	print_page(open_rows, sensor_mgr, window, fahrenheit, stats.get_stats(conn))
+	conn.close()
 	sys.stdout.flush()
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+import bisect
+import cgi
+import datetime
+import StringIO
+import sys
+import time
+from optparse import OptionParser
+from wsgiref.simple_server import make_server
+
+import chart
+import database
+import stats
+import tempsensor
+
+# chartserver.py
+# ==============
+# a long running alternative to running chart.py as a CGI. We keep
+# the sensor list and the most recent readings in memory and only ask
+# the database for rows newer than the last one we have, so a page
+# view (or flipping between C and F) doesn't start python, reload
+# the Sensor table and re-read the whole window every time.
+
+
+# CachedRows
+# ==========
+# the rows get_data() returns for one resolution (None for the raw
+# rows), from "cache_start" on, in time order.
+
+class CachedRows(object):
+    def __init__(self, resolution):
+        self._resolution = resolution
+        self._rows = []  # (sensor, timestamp, temp, rowid)
+        self._keys = []  # (timestamp, rowid) of each row, for bisect
+        self._cache_start = None  # we have every row from here on
+
+    # refresh()
+    # =========
+    # re-reads from the newest timestamp we have rather than the whole
+    # window. We can't just take rows after the last one because the
+    # newest rollup buckets keep changing until their minute/hour/day
+    # is over, and more raw rows can land in the same second.
+    def refresh(self, conn, cache_start):
+        since = cache_start
+        if self._cache_start is not None and len(self._keys) != 0:
+            since = self._keys[-1][0]
+            first = bisect.bisect_left(self._keys, (since,))
+            del self._rows[first:]
+            del self._keys[first:]
+        elif self._cache_start is not None:
+            since = self._cache_start
+
+        curs = chart.query_data(conn.cursor(), None, start=since, resolution=self._resolution)
+        for row in chart.iter_rows(curs):
+            self._rows.append(row)
+            self._keys.append((row[1], row[3]))
+
+        if self._cache_start is None:
+            self._cache_start = cache_start
+        elif cache_start > self._cache_start:
+            expired = bisect.bisect_left(self._keys, (cache_start,))
+            del self._rows[:expired]
+            del self._keys[:expired]
+            self._cache_start = cache_start
+        return
+
+    # get_rows()
+    # ==========
+    # the rows get_data() would return for this window, or None when
+    # the window isn't covered by the cache.
+    def get_rows(self, start, end=None, after=None, limit=None):
+        if self._cache_start is None or start is None or start < self._cache_start:
+            return None
+
+        first = bisect.bisect_left(self._keys, (start,))
+        if after is not None:
+            first = max(first, bisect.bisect_right(self._keys, after))
+        last = len(self._keys)
+        if end is not None:
+            last = bisect.bisect_left(self._keys, (end,))
+        if limit is not None:
+            last = min(last, first + limit)
+
+        return self._rows[first:last]
+
+
+# ChartCache
+# ==========
+# the sensor list plus the last "cache_hours" of rows for each
+# resolution that has been asked for, kept on one connection.
+
+class ChartCache(object):
+    def __init__(self, db_name, cache_hours=chart.DEFAULT_ZOOM_HOURS, refresh_seconds=5.0):
+        self._db_name = db_name
+        self._cache_hours = cache_hours
+        self._refresh_seconds = refresh_seconds
+        self._conn = database.open_reader(db_name)
+        self._sensor_mgr = None
+        self._tables = {}  # resolution -> CachedRows
+        self._time_last_refresh = 0.0
+
+    def get_sensor_mgr(self, sensors=()):
+        # (re)load the sensor list when we see a sensor we don't know
+        if self._sensor_mgr is not None:
+            for sensor_id in sensors:
+                if self._sensor_mgr.get_sensor_by_index(sensor_id) is None:
+                    self._sensor_mgr = None
+                    break
+
+        if self._sensor_mgr is None:
+            self._sensor_mgr = tempsensor.SensorsMgr(self._db_name)
+            self._sensor_mgr.read_sensors_from_db()
+
+        return self._sensor_mgr
+
+    def get_cache_start(self):
+        return chart.time_offset(datetime.datetime.now(), -self._cache_hours)
+
+    def refresh(self, force=False):
+        now = time.time()
+        if not force and now - self._time_last_refresh < self._refresh_seconds:
+            return
+        self._time_last_refresh = now
+
+        cache_start = self.get_cache_start()
+        for table in self._tables.itervalues():
+            table.refresh(self._conn, cache_start)
+        return
+
+    # get_rows()
+    # ==========
+    # rows for the window from memory, or None if it starts before the
+    # cache does. A resolution is loaded the first time it's wanted.
+    def get_rows(self, start, end=None, after=None, limit=None, resolution=None):
+        if start is None or start < self.get_cache_start():
+            return None
+
+        table = self._tables.get(resolution)
+        if table is None:
+            table = CachedRows(resolution)
+            table.refresh(self._conn, self.get_cache_start())
+            self._tables[resolution] = table
+        else:
+            self.refresh()
+
+        return table.get_rows(start, end, after, limit)
+
+    def get_connection(self):
+        return self._conn
+
+
+# ChartApp
+# ========
+# the WSGI application, serves the same page (and form parameters)
+# as chart.py. Windows inside the cache come from memory, anything
+# older is queried as chart.py would, archive and all.
+
+class ChartApp(object):
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '/') not in ('/', '/chart.py'):
+            start_response('404 Not Found', [('Content-type', 'text/plain')])
+            return ["Not found\n"]
+
+        form = cgi.FieldStorage(fp=environ.get('wsgi.input'), environ=environ)
+        fahrenheit = form.getvalue('temperature') == 'fahrenheit'
+
+        if form.getvalue('format') == 'json':
+            return self.render_json(form, fahrenheit, environ, start_response)
+
+        page = self.render(form, fahrenheit)
+        start_response('200 OK', [('Content-type', 'text/html'),
+                                  ('Content-Length', str(len(page)))])
+        return [page]
+
+    # render_json()
+    # =============
+    # the ?format=json data API (see chart.create_series), a client that
+    # sends back the ETag it was given gets a 304 when nothing changed.
+    def render_json(self, form, fahrenheit, environ, start_response):
+        cache = self._cache
+
+        window = chart.get_window(form)
+        since = chart.parse_cursor(form.getvalue('since'))
+        start, after = chart.get_series_range(window, since)
+
+        rows = chart.get_live_rows(start, window['end'], after, chart.PAGE_ROWS, window['resolution'])
+        if rows is None:
+            rows = cache.get_rows(start, window['end'], after, chart.PAGE_ROWS, window['resolution'])
+        if rows is None:
+            rows = list(chart.open_data(cache.get_connection(), start, window['end'],
+                                        after, chart.PAGE_ROWS, window['resolution']))
+
+        sensor_mgr = cache.get_sensor_mgr(chart.scan_rows(rows)[0])
+        body, etag = chart.create_json(chart.create_series(rows, sensor_mgr, fahrenheit, window['resolution'], since))
+
+        if chart.etag_matches(etag, environ.get('HTTP_IF_NONE_MATCH')):
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+
+        start_response('200 OK', [('Content-type', 'application/json'),
+                                  ('ETag', etag),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def render(self, form, fahrenheit):
+        cache = self._cache
+
+        window = chart.get_window(form)
+        after = chart.parse_cursor(window['after'])
+
+        rows = chart.get_live_rows(window['start'], window['end'], after, chart.PAGE_ROWS, window['resolution'])
+        if rows is None:
+            rows = cache.get_rows(window['start'], window['end'], after, chart.PAGE_ROWS, window['resolution'])
+
+        if rows is not None:
+            def open_rows():
+                return iter(rows)
+        else:
+            def open_rows():
+                return chart.open_data(cache.get_connection(), window['start'], window['end'],
+                                       after, chart.PAGE_ROWS, window['resolution'])
+
+        # make sure we know every sensor that shows up in the window
+        # (or in the stats panel)
+        sensor_stats = stats.get_stats(cache.get_connection())
+        sensors = chart.scan_rows(open_rows())[0]
+        sensor_mgr = cache.get_sensor_mgr(sensors + [row[0] for row in sensor_stats])
+
+        # the page is printed, so catch it rather than re-writing chart.py
+        page = StringIO.StringIO()
+        stdout = sys.stdout
+        sys.stdout = page
+        try:
+            chart.print_page(open_rows, sensor_mgr, window, fahrenheit, sensor_stats)
+        finally:
+            sys.stdout = stdout
+
+        return page.getvalue()
+
+
+def create_parser():
+    parser = OptionParser(usage="chartserver.py [options]",
+                          description="Serves the temperature chart over HTTP from an in-memory cache")
+
+    parser.add_option("-d", "--db", dest="db_name", default=chart.dbname,
+                      help="sqlite database to chart", metavar="FILE")
+
+    parser.add_option("-a", "--address", dest="address", default="",
+                      help="address to listen on (default all)")
+
+    parser.add_option("-p", "--port", dest="port", default=8080, type="int",
+                      help="port to listen on")
+
+    parser.add_option("--cache-hours", dest="cache_hours", default=chart.DEFAULT_ZOOM_HOURS, type="float",
+                      help="hours of recent readings to keep in memory")
+
+    parser.add_option("--refresh-seconds", dest="refresh_seconds", default=5.0, type="float",
+                      help="look for new readings at most this often")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    cache = ChartCache(opts.db_name, opts.cache_hours, opts.refresh_seconds)
+
+    server = make_server(opts.address, opts.port, ChartApp(cache))
+    print "serving {0} on port {1}".format(opts.db_name, opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
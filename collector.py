@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import datetime
+import json
+import Queue
+import signal
+import SocketServer
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from optparse import OptionParser
+
+import database
+import monitor
+import rollup
+import sender
+import stats
+import storage
+import tempsensor
+
+# collector.py
+# ============
+# the central store for a house full of monitors. Each Pi runs
+# monitor.py with --collector pointing here and its sender (sender.py)
+# posts its readings in compressed batches, the collector writes them
+# all into one database laid out like a node's sensorlog.db, so the
+# chart can show every room at once: chartserver.py --db pointed at it,
+# or chart.py (the CGI) with its "dbname" set to it.
+#
+# A sensor is known by its node and serial id together, "kitchen/28-
+# 0416718527ff" in the Sensor table (sender.get_qualified_id()), rather
+# than the sensor_id the node gave it: every node numbers its sensors
+# from 1, and the same probe moved to another room is another sensor.
+#
+#   Node - per node the stream its batches are from, the last sequence
+#          number taken from it and how much it has sent. It's updated
+#          in the same transaction as the rows, so a batch sent again
+#          (the answer was lost, the node restarted) is skipped and
+#          every batch goes in exactly once.
+#
+# The requests are read on a thread each, the writes all go through a
+# single writer thread (Ingester) with the one connection. It takes
+# whatever batches are waiting, up to "group_requests" requests of
+# them, and writes them in one transaction with their rollups and
+# stats, so a dozen nodes catching up after an outage cost a dozen
+# requests but only a few commits.
+#
+# To try it on one machine, with a simulated bus per node (the nodes
+# don't publish live readings, they'd share the one live file and the
+# chart would show them as the collector's sensors):
+#
+#   collector.py --db /tmp/collector.db --port 8900 serve &
+#   w1sim.py --root /tmp/kitchen --seed 1 &
+#   monitor.py --db /tmp/kitchen.db --w1-devices /tmp/kitchen --node kitchen \
+#              --live-readings 0 --collector http://127.0.0.1:8900 &
+#   (and again for another room)
+#   chartserver.py --db /tmp/collector.db --port 8080
+
+dbname = '/home/pi/collector.db'
+
+DEFAULT_PORT = 8900
+GROUP_REQUESTS = 50  # most requests written in one transaction
+MAX_BODY = 16 * 1024 * 1024
+
+
+def create_collector_schema(db_name, compact=False):
+    monitor.create_log_schema(db_name, compact)
+    tempsensor.SensorsMgr(db_name).create_sensor_schema()
+    conn = database.connect(db_name)
+    conn.execute("CREATE TABLE IF NOT EXISTS Node(node TEXT PRIMARY KEY, stream TEXT NOT NULL, "
+                 "last_seq INTEGER NOT NULL, batches INTEGER NOT NULL, rows INTEGER NOT NULL, "
+                 "last_seen TIMESTAMP);")
+    conn.commit()
+    conn.close()
+    return
+
+
+# Ingester
+# ========
+# the writer thread. ingest() is called from the request threads and
+# waits for the batches to be written.
+
+class Ingester(object):
+    def __init__(self, db_name, group_requests=GROUP_REQUESTS):
+        self._db_name = db_name
+        self._group_requests = group_requests
+        self._queue = Queue.Queue()
+        self._sensors = {}  # qualified id -> sensor_id
+        self._thread = None
+
+        self.requests = 0
+        self.commits = 0
+        self.batches = 0
+        self.duplicates = 0  # batches we had already
+        self.rows = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ingester")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    # ingest()
+    # ========
+    # writes a decoded payload (sender.decode_payload()), returns the
+    # last sequence number we have from the node. Raises the error the
+    # write failed with.
+    def ingest(self, node, stream, batches):
+        request = {'payload': (node, stream, batches), 'done': threading.Event()}
+        self._queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['last_seq']
+
+    def _run(self):
+        conn = database.connect(self._db_name)
+        try:
+            while True:
+                request = self._queue.get()
+                if request is None:
+                    return
+                group = [request]
+                while len(group) < self._group_requests:
+                    try:
+                        request = self._queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if request is None:
+                        self._queue.put(None)  # after this group
+                        break
+                    group.append(request)
+
+                try:
+                    self.write(conn, group)
+                except Exception as e:
+                    traceback.print_exc()
+                    self._sensors = {}  # the ids may have been rolled back
+                    for request in group:
+                        request['error'] = e
+                for request in group:
+                    request['done'].set()
+        finally:
+            conn.close()
+
+    # write()
+    # =======
+    # one transaction for the whole group. The Node row is read (and
+    # kept up to date) as we go, so two requests in the group with the
+    # same batches still only write them once.
+    def write(self, conn, group):
+        now = datetime.datetime.now().strftime(storage.TIME_FORMAT)
+        nodes = {}  # node -> [stream, last_seq, batches, rows]
+        rows = []
+        written = 0
+        duplicates = 0
+        with conn:
+            for request in group:
+                node, stream, batches = request['payload']
+                if node not in nodes:
+                    row = conn.execute("SELECT stream, last_seq, batches, rows FROM Node WHERE node = ?",
+                                       (node,)).fetchone()
+                    nodes[node] = list(row) if row is not None else [stream, 0, 0, 0]
+                state = nodes[node]
+                if state[0] != stream:
+                    print "{0} started a new stream, its sequence numbers start again".format(node)
+                    state[:2] = [stream, 0]
+
+                for seq, batch_rows in batches:
+                    if seq <= state[1]:
+                        duplicates += 1
+                        continue
+                    for epoch, millic, serial_id in batch_rows:
+                        rows.append((storage.to_timestamp(epoch), millic / 1000.0,
+                                     self.get_sensor_id(conn, sender.get_qualified_id(node, serial_id))))
+                    state[1] = seq
+                    state[2] += 1
+                    state[3] += len(batch_rows)
+                    written += 1
+                request['last_seq'] = state[1]
+
+            inserted = storage.insert_rows(conn, rows)
+            rollup.update_rollups(conn, inserted)
+            stats.update_stats(conn, inserted)
+            for node, (stream, last_seq, batches, node_rows) in nodes.iteritems():
+                conn.execute("INSERT OR REPLACE INTO Node(node, stream, last_seq, batches, rows, last_seen) "
+                             "VALUES(?,?,?,?,?,?)", (node, stream, last_seq, batches, node_rows, now))
+
+        self.requests += len(group)
+        self.commits += 1
+        self.batches += written
+        self.duplicates += duplicates
+        self.rows += len(rows)
+        return
+
+    def get_sensor_id(self, conn, qualified_id):
+        sensor_id = self._sensors.get(qualified_id)
+        if sensor_id is None:
+            conn.execute("INSERT OR IGNORE INTO Sensor(serial_id) VALUES(?)", (qualified_id,))
+            sensor_id = conn.execute("SELECT sensor_id FROM Sensor WHERE serial_id = ?", (qualified_id,)).fetchone()[0]
+            self._sensors[qualified_id] = sensor_id
+        return sensor_id
+
+    # returns (requests, commits, batches written, batches skipped as
+    # already written, rows written)
+    def get_stats(self):
+        return self.requests, self.commits, self.batches, self.duplicates, self.rows
+
+
+class CollectorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, a sender posts a batch a minute
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if self.path.split("?")[0] != sender.PATH:
+            self.rfile.read(length)
+            self.send_body(404, "", "text/plain")
+            return
+        if length > MAX_BODY:
+            self.send_body(413, "", "text/plain")
+            self.close_connection = 1
+            return
+
+        try:
+            node, stream, batches = sender.decode_payload(self.rfile.read(length))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_body(400, str(e), "text/plain")
+            return
+
+        try:
+            last_seq = self.server.ingester.ingest(node, stream, batches)
+        except (sqlite3.Error, EnvironmentError) as e:
+            self.send_body(503, str(e), "text/plain")  # locked, disk full, the sender tries again
+            return
+        except Exception as e:
+            self.send_body(500, str(e), "text/plain")
+            return
+        self.send_body(200, json.dumps({"last_seq": last_seq}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CollectorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# serve()
+# =======
+# runs the collector on its own thread (and the Ingester on another),
+# returns the server, its "ingester" has the counts. Port 0 picks a
+# free one, see server_address. shutdown() then close() to stop it.
+def serve(db_name, address="127.0.0.1", port=DEFAULT_PORT, compact=False, group_requests=GROUP_REQUESTS):
+    create_collector_schema(db_name, compact)
+    ingester = Ingester(db_name, group_requests)
+    ingester.start()
+    server = CollectorServer((address, port), CollectorHandler)
+    server.ingester = ingester
+    thread = threading.Thread(target=server.serve_forever, name="collector")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_url(server):
+    return "http://{0}:{1}".format(*server.server_address)
+
+
+def print_status(db_name):
+    conn = database.open_reader(db_name)
+    for node, last_seq, batches, rows, last_seen in conn.execute(
+            "SELECT node, last_seq, batches, rows, last_seen FROM Node ORDER BY node"):
+        print "{0}: {1} rows in {2} batches, last batch {3} at {4}".format(node, rows, batches, last_seq, last_seen)
+    for serial_id, sensor_id in conn.execute("SELECT serial_id, sensor_id FROM Sensor ORDER BY serial_id"):
+        print "    [{0}] {1}".format(sensor_id, serial_id)
+    conn.close()
+
+
+def create_parser():
+    parser = OptionParser(usage="collector.py [options] serve|status",
+                          description="Collects the readings of many monitors (monitor.py --collector) into one database")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database to collect into", metavar="FILE")
+
+    parser.add_option("-a", "--address", dest="address", default="0.0.0.0",
+                      help="address to listen on")
+
+    parser.add_option("-p", "--port", dest="port", default=DEFAULT_PORT, type="int",
+                      help="port to listen on")
+
+    parser.add_option("--compact", dest="compact", default=False, action="store_true",
+                      help="keep the readings in the compact format (see storage.py)")
+
+    parser.add_option("--group", dest="group_requests", default=GROUP_REQUESTS, type="int",
+                      help="most requests to write in one transaction")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('serve', 'status'):
+        parser.print_help()
+        sys.exit(-1)
+
+    if args[0] == 'status':
+        print_status(opts.db_name)
+        return
+
+    # a "kill" should let the writer finish like a ^C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = serve(opts.db_name, opts.address, opts.port, opts.compact, opts.group_requests)
+    print "collecting into {0} on {1}".format(opts.db_name, get_url(server))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(60)
+            requests, commits, batches, duplicates, rows = server.ingester.get_stats()
+            print "{0} requests, {1} commits, {2} batches ({3} already in), {4} rows".format(
+                requests, commits, batches, duplicates, rows)
+            sys.stdout.flush()
+    except (KeyboardInterrupt, SystemExit):
+        server.shutdown()
+        server.ingester.close()
+
+
+if __name__ == "__main__":
+    main()
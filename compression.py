@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+import sys
+from optparse import OptionParser
+
+import database
+import storage
+
+# compression.py
+# ==============
+# decides which readings are worth writing to the database. Each
+# sensor has a compressor that is handed every (time, temperature)
+# sample and gives back the points to store, the chart rebuilds the
+# signal from those points:
+#
+#   raw          - every sample is stored
+#   deadband     - a sample is stored when it is more than "tolerance"
+#                  from the last one stored, the signal is held flat
+#                  in between (what Sensor.set_temperature used to do)
+#   swingingdoor - stores the ends of straight line segments, every
+#                  sample is within "tolerance" of the line between
+#                  the stored points around it
+#
+# flush() ends whatever is in progress at the latest sample, we use it
+# for the forced writes and on shutdown.
+
+dbname = '/home/pi/sensorlog.db'
+
+DEFAULT_MODE = 'deadband'
+DEFAULT_TOLERANCE = 0.2  # C
+
+
+class RawCapture(object):
+    interpolation = 'step'
+
+    def __init__(self, tolerance=0.0):
+        self.tolerance = 0.0
+        self.samples = 0
+        self.points = 0
+
+    def add(self, t, value):
+        self.samples += 1
+        self.points += 1
+        return [(t, value)]
+
+    def flush(self):
+        return []
+
+
+class DeadBand(object):
+    interpolation = 'step'
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.samples = 0
+        self.points = 0
+        self._base = None  # last value stored
+        self._last = None  # latest sample, None once it has been stored
+
+    def add(self, t, value):
+        self.samples += 1
+        if self._base is not None and abs(value - self._base) <= self.tolerance:
+            self._last = (t, value)
+            return []
+
+        self._base = value
+        self._last = None
+        self.points += 1
+        return [(t, value)]
+
+    def flush(self):
+        if self._last is None:
+            return []
+
+        point = self._last
+        self._base = point[1]
+        self._last = None
+        self.points += 1
+        return [point]
+
+
+class SwingingDoor(object):
+    interpolation = 'linear'
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.samples = 0
+        self.points = 0
+        self._anchor = None  # the last point stored, where this segment starts
+        self._last = None  # latest sample
+        self._lower = None  # range of slopes from the anchor that keep every
+        self._upper = None  # sample since it within tolerance, None if none yet
+
+    def add(self, t, value):
+        self.samples += 1
+        if self._anchor is None:
+            self._anchor = self._last = (t, value)
+            self.points += 1
+            return [(t, value)]
+
+        dt = t - self._anchor[0]
+        if dt <= 0:
+            return []  # same timestamp as the anchor, nothing to draw
+
+        lower = (value - self.tolerance - self._anchor[1]) / dt
+        upper = (value + self.tolerance - self._anchor[1]) / dt
+        if self._lower is not None:
+            lower = max(lower, self._lower)
+            upper = min(upper, self._upper)
+
+        if lower <= upper:
+            # the doors are still open, this sample fits on the segment
+            self._lower = lower
+            self._upper = upper
+            self._last = (t, value)
+            return []
+
+        # the doors have closed, end the segment at the previous sample
+        # and start the next one from there
+        stored = self._close()
+        dt = t - self._anchor[0]
+        self._lower = (value - self.tolerance - self._anchor[1]) / dt
+        self._upper = (value + self.tolerance - self._anchor[1]) / dt
+        self._last = (t, value)
+        return [stored]
+
+    # the segment ends at the latest sample's time. We keep the real
+    # reading when the line to it fits every sample in between, if not
+    # we use the nearest value that does (it's within tolerance of the
+    # reading anyway).
+    def _close(self):
+        t, value = self._last
+        dt = t - self._anchor[0]
+        real_slope = (value - self._anchor[1]) / dt
+        slope = min(max(real_slope, self._lower), self._upper)
+        if slope != real_slope:
+            value = self._anchor[1] + slope * dt
+
+        self._anchor = (t, value)
+        self._lower = None
+        self._upper = None
+        self.points += 1
+        return self._anchor
+
+    def flush(self):
+        if self._lower is None:
+            return []  # nothing since the last point stored
+        return [self._close()]
+
+
+MODES = {'raw': RawCapture,
+         'deadband': DeadBand,
+         'swingingdoor': SwingingDoor}
+
+
+def create_compressor(mode=DEFAULT_MODE, tolerance=DEFAULT_TOLERANCE):
+    return MODES[mode](tolerance)
+
+
+# reconstruct()
+# =============
+# the value the stored points give us at time "t", held flat or drawn
+# as a line between the points depending on the compressor.
+
+def reconstruct(points, t, interpolation, start=0):
+    # points are in time order, "start" is where to begin looking
+    i = start
+    while i + 1 < len(points) and points[i + 1][0] <= t:
+        i += 1
+
+    t0, v0 = points[i]
+    if interpolation == 'step' or i + 1 == len(points) or t <= t0:
+        return v0, i
+
+    t1, v1 = points[i + 1]
+    return v0 + (v1 - v0) * (t - t0) / (t1 - t0), i
+
+
+# evaluate()
+# ==========
+# runs a series of raw (time, value) samples through a compressor and
+# returns (samples, points stored, compression ratio, max error) where
+# the error is between each sample and the signal rebuilt from the
+# stored points.
+
+def evaluate(compressor, samples):
+    points = []
+    for t, value in samples:
+        points.extend(compressor.add(t, value))
+    points.extend(compressor.flush())
+
+    if len(points) == 0:
+        return 0, 0, 0.0, 0.0
+
+    max_error = 0.0
+    i = 0
+    for t, value in samples:
+        rebuilt, i = reconstruct(points, t, compressor.interpolation, i)
+        max_error = max(max_error, abs(value - rebuilt))
+
+    return len(samples), len(points), float(len(samples)) / len(points), max_error
+
+
+def create_parser():
+    parser = OptionParser(usage="compression.py [options] sensor_id",
+                          description="Compares the compression modes on readings logged with --compression raw")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database with the raw readings", metavar="FILE")
+
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=DEFAULT_TOLERANCE, type="float",
+                      help="error tolerance (C) to compress with")
+
+    parser.add_option("-s", "--start", dest="start", default=None,
+                      help="only use readings from this timestamp on")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(-1)
+
+    conn = database.open_reader(opts.db_name)
+    samples = storage.read_readings(conn, int(args[0]), opts.start)
+    conn.close()
+
+    print "{0:<14}{1:>10}{2:>10}{3:>10}{4:>12}".format("mode", "samples", "points", "ratio", "max error")
+    for mode in ('raw', 'deadband', 'swingingdoor'):
+        count, points, ratio, max_error = evaluate(create_compressor(mode, opts.tolerance), samples)
+        print "{0:<14}{1:>10}{2:>10}{3:>10.1f}{4:>12.3f}".format(mode, count, points, ratio, max_error)
+
+
+if __name__ == "__main__":
+    main()
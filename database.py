@@ -0,0 +1,90 @@
+import sqlite3
+
+# database.py
+# ===========
+# every connection to sensorlog.db is opened here so they all agree
+# on how the file is shared. The monitor writes while chart.py and the
+# tools read, so the database runs in WAL mode: readers see the last
+# commit and never block the writer, and the writer never blocks them.
+#
+#   synchronous=NORMAL - in WAL mode a power cut can lose the last few
+#                        commits but can't corrupt the file, and we save
+#                        an fsync per commit (slow on an SD card)
+#   cache_size         - a bigger page cache than the 2MB default for
+#                        the readers' range queries
+#   readers            - are query_only, a bug in the chart can't write
+#   checkpoints        - the monitor's writer runs them itself on a
+#                        schedule (checkpoint()), PASSIVE so it never
+#                        waits for a reader to finish
+#   auto_vacuum        - INCREMENTAL, so retention.py can hand deleted
+#                        pages back a few at a time. It only takes on a
+#                        new (empty) file, older ones need a VACUUM
+#                        (retention.py enable-vacuum)
+#   busy               - the writer only waits WRITER_TIMEOUT for the
+#                        lock (another writer like the rollup backfill
+#                        or a migration) and then keeps its rows for the
+#                        next flush rather than stalling the sampling,
+#                        see is_busy()
+#
+# (python 2's sqlite3 can't open a file read-only with a URI, query_only
+# is the nearest thing.)
+
+BUSY_TIMEOUT = 5.0  # seconds to wait for the write lock, tools and readers
+WRITER_TIMEOUT = 1.0  # seconds the monitor's writer waits before giving up
+CACHE_KB = 8192
+
+
+def _configure(conn):
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -{0}".format(CACHE_KB))
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+# connect()
+# =========
+# a connection that may write, for the tools and the odd write from
+# elsewhere (the Sensor table). Switches the file to WAL, which sticks
+# once done.
+def connect(db_name, timeout=BUSY_TIMEOUT):
+    conn = sqlite3.connect(db_name, timeout)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")  # before WAL creates the file
+    conn.execute("PRAGMA journal_mode = WAL")
+    return _configure(conn)
+
+
+# open_writer()
+# =============
+# the monitor's connection, checkpoints are left to checkpoint()
+def open_writer(db_name):
+    conn = connect(db_name, WRITER_TIMEOUT)
+    conn.execute("PRAGMA wal_autocheckpoint = 0")
+    return conn
+
+
+# open_reader()
+# =============
+# a connection for reading only. It doesn't change the journal mode,
+# the CGI user may not be allowed to.
+def open_reader(db_name):
+    conn = sqlite3.connect(db_name, BUSY_TIMEOUT)
+    conn.execute("PRAGMA query_only = ON")
+    return _configure(conn)
+
+
+# checkpoint()
+# ============
+# copies the WAL back into the database. PASSIVE does what it can
+# without waiting for readers, TRUNCATE (on the way out) waits and
+# empties the WAL file. Returns (busy, pages in the WAL, pages copied)
+# as sqlite reports them.
+def checkpoint(conn, mode='PASSIVE'):
+    return conn.execute("PRAGMA wal_checkpoint({0})".format(mode)).fetchone()
+
+
+# the database is locked by another connection, worth trying again later
+def is_busy(error):
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error)
+    return "locked" in message or "busy" in message
@@ -0,0 +1,77 @@
+import datetime
+
+# downsample.py
+# =============
+# the chart is 1200px wide, there's no point sending it more points
+# than that. minmax() cuts the window into equal time buckets and keeps
+# the lowest and highest reading of each sensor in each bucket, so the
+# peaks and troughs survive where an average would flatten them.
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# get_boundaries()
+# ================
+# the start of each bucket after the first as timestamp strings, the
+# rows' timestamps are in the same format so we can compare the text
+# rather than parse every row.
+
+def get_boundaries(start, end, buckets):
+    start_time = datetime.datetime.strptime(start, TIME_FORMAT)
+    end_time = datetime.datetime.strptime(end, TIME_FORMAT)
+    width = (end_time - start_time).total_seconds() / buckets
+
+    boundaries = []
+    for i in range(1, buckets):
+        boundary = start_time + datetime.timedelta(seconds=width * i)
+        boundaries.append(boundary.strftime(TIME_FORMAT))
+    return boundaries
+
+
+# minmax()
+# ========
+# takes (sensor, timestamp, temp, rowid) rows in time order, like
+# chart.get_data() returns, and yields at most "points" of them per
+# sensor, still in time order. Only the current bucket is held in
+# memory so the rows can come straight from the cursor.
+
+def minmax(rows, start, end, points):
+    buckets = max(1, points // 2)
+    boundaries = get_boundaries(start, end, buckets)
+    next_boundary = 0
+    extremes = {}  # sensor -> [min row, max row] for the current bucket
+
+    for row in rows:
+        if next_boundary < len(boundaries) and row[1] >= boundaries[next_boundary]:
+            # this row is past the current bucket, everything held so far
+            # is older than it
+            for kept in flush(extremes):
+                yield kept
+            while next_boundary < len(boundaries) and row[1] >= boundaries[next_boundary]:
+                next_boundary += 1
+
+        kept = extremes.get(row[0])
+        if kept is None:
+            extremes[row[0]] = [row, row]
+            continue
+
+        temp = float(row[2])
+        if temp < float(kept[0][2]):
+            kept[0] = row
+        if temp > float(kept[1][2]):
+            kept[1] = row
+
+    for kept in flush(extremes):
+        yield kept
+
+
+def flush(extremes):
+    kept = []
+    for low, high in extremes.itervalues():
+        kept.append(low)
+        if high is not low:
+            kept.append(high)
+    extremes.clear()
+
+    kept.sort(key=lambda row: (row[1], row[3]))
+    return kept
@@ -0,0 +1,445 @@
+#!/usr/bin/python
+
+import csv
+import gzip
+import json
+import struct
+import sys
+from optparse import OptionParser
+
+import database
+import monitor
+import rollup
+import stats
+import storage
+import tempsensor
+
+# export.py
+# =========
+# moves readings in and out of sensorlog.db without holding them all in
+# memory, to copy a database to a bigger machine, merge one Pi's log
+# into another's or pull a range out for a spreadsheet:
+#
+#   export.py -d sensorlog.db -o kitchen.csv.gz --start 2016-01-01 export
+#   export.py -d other.db -i kitchen.csv.gz import
+#
+# A reading is (timestamp, serial id, temp), the sensor by its serial id
+# from the Sensor table since the sensor_ids are only good for the one
+# database. Export reads both tables (see storage.py) "chunk_rows" at a
+# time with fetchmany(), import writes "chunk_rows" per transaction with
+# their rollups and stats, skipping readings the database already has
+# (storage.filter_new_rows()), so importing the same file twice or two
+# overlapping exports is safe. The formats are
+#
+#   csv    - timestamp,serial_id,temp with a header line
+#   ndjson - {"timestamp": ..., "serial_id": ..., "temp": ...} a line
+#   binary - columnar blocks, see BinaryWriter. Temperatures are kept
+#            in milli-degrees as in the compact table.
+#
+# Any of them can be gzipped, a file name ending .gz is. The format
+# goes by the file name too (.csv, .ndjson/.jsonl, .bin) unless given.
+
+dbname = '/home/pi/sensorlog.db'
+
+CHUNK_ROWS = 5000
+FORMATS = ('csv', 'ndjson', 'binary')
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.bin': 'binary'}
+CSV_HEADER = ['timestamp', 'serial_id', 'temp']
+
+
+# get_format()
+# ============
+# (format, gzipped) for a file name, "fmt" if it's given
+def get_format(file_name, fmt=None):
+    name = file_name.lower()
+    gzipped = name.endswith('.gz')
+    if gzipped:
+        name = name[:-len('.gz')]
+    if fmt is None:
+        for extension, extension_fmt in EXTENSIONS.items():
+            if name.endswith(extension):
+                fmt = extension_fmt
+    return fmt, gzipped
+
+
+def open_file(file_name, mode, gzipped):
+    if file_name == '-':
+        std_file = sys.stdout if 'w' in mode else sys.stdin
+        if gzipped:
+            return gzip.GzipFile(fileobj=std_file, mode=mode)
+        return std_file
+    if gzipped:
+        return gzip.open(file_name, mode)
+    return open(file_name, mode)
+
+
+# a start or end as a timestamp, a day on its own is its midnight
+def parse_time(value):
+    if value is None:
+        return None
+    if len(value) == len('2016-01-01'):
+        value += ' 00:00:00'
+    storage.to_epoch(value)  # raises ValueError if it isn't one
+    return value
+
+
+# iter_rows()
+# ===========
+# (timestamp, epoch, temp, serial id) for the readings from "start" up
+# to "end" (timestamps) of the sensors in "sensor_ids" (all if None),
+# read "chunk_rows" at a time. Each table is read in its own order,
+# the rows of both aren't merged.
+def iter_rows(conn, start=None, end=None, sensor_ids=None, chunk_rows=CHUNK_ROWS):
+    for fmt in storage.get_formats(conn):
+        if fmt == 'text':
+            # the epoch is worked out as storage.to_epoch() would, but
+            # by sqlite rather than strptime() a row at a time
+            sel_sql = ("SELECT t.[timestamp], CAST(strftime('%s', t.[timestamp], 'utc') AS INTEGER), t.temp, "
+                       "COALESCE(s.serial_id, t.sensor) FROM Temperature t LEFT JOIN Sensor s ON s.sensor_id = t.sensor")
+            time_col = "t.[timestamp]"
+            bounds = (start, end)
+        else:
+            sel_sql = ("SELECT datetime(t.[time], 'unixepoch', 'localtime'), t.[time], t.millic / 1000.0, "
+                       "COALESCE(s.serial_id, t.sensor) FROM TemperatureCompact t LEFT JOIN Sensor s ON s.sensor_id = t.sensor")
+            time_col = "t.[time]"
+            bounds = (start and storage.to_epoch(start), end and storage.to_epoch(end))
+
+        where = []
+        params = []
+        if bounds[0] is not None:
+            where.append(time_col + " >= ?")
+            params.append(bounds[0])
+        if bounds[1] is not None:
+            where.append(time_col + " < ?")
+            params.append(bounds[1])
+        if sensor_ids is not None:
+            where.append("t.sensor IN ({0})".format(",".join("?" * len(sensor_ids))))
+            params.extend(sensor_ids)
+        if len(where) != 0:
+            sel_sql += " WHERE " + " AND ".join(where)
+
+        curs = conn.cursor()
+        curs.arraysize = chunk_rows
+        curs.execute(sel_sql, params)
+        while True:
+            rows = curs.fetchmany()
+            if len(rows) == 0:
+                break
+            for timestamp, epoch, temp, serial_id in rows:
+                yield timestamp, epoch, temp, unicode(serial_id)
+        curs.close()
+
+
+# the sensor_ids for serial ids, raises ValueError for one we don't have
+def get_sensor_ids(conn, serial_ids):
+    sensor_ids = []
+    for serial_id in serial_ids:
+        row = conn.execute("SELECT sensor_id FROM Sensor WHERE serial_id = ?", (serial_id,)).fetchone()
+        if row is None:
+            raise ValueError("no sensor {0}".format(serial_id))
+        sensor_ids.append(row[0])
+    return sensor_ids
+
+
+class CsvWriter(object):
+    def __init__(self, out_file):
+        self._writer = csv.writer(out_file, lineterminator='\n')
+        self._writer.writerow(CSV_HEADER)
+
+    def write(self, timestamp, epoch, temp, serial_id):
+        self._writer.writerow((timestamp, serial_id.encode('utf-8'), repr(float(temp))))
+
+    def close(self):
+        return
+
+
+class NdjsonWriter(object):
+    def __init__(self, out_file):
+        self._out_file = out_file
+
+    def write(self, timestamp, epoch, temp, serial_id):
+        self._out_file.write(json.dumps({"timestamp": timestamp, "serial_id": serial_id, "temp": float(temp)},
+                                        separators=(',', ':')) + "\n")
+
+    def close(self):
+        return
+
+
+# BinaryWriter
+# ============
+# the readings as a stream of little endian records after a 5 byte
+# header ("SPXB" and a version):
+#
+#   'S' index(H) length(H) serial id   - a sensor, before its first
+#                                        reading, numbered from 0
+#   'R' rows(I) base(q)                - a block of readings, then
+#       rows x sensor index(H)           the columns one after the
+#       rows x seconds after base(i)     other (times and temperatures
+#       rows x milli-degrees C(i)        in one place gzip well)
+#
+# A block is written every "block_rows" readings, so neither side ever
+# holds more than that.
+
+BINARY_MAGIC = 'SPXB'
+BINARY_VERSION = 1
+SENSOR_HEADER = struct.Struct('<cHH')
+BLOCK_HEADER = struct.Struct('<cIq')
+
+
+class BinaryWriter(object):
+    def __init__(self, out_file, block_rows=CHUNK_ROWS):
+        self._out_file = out_file
+        self._block_rows = block_rows
+        self._sensors = {}  # serial id -> index
+        self._block = []
+        out_file.write(BINARY_MAGIC + chr(BINARY_VERSION))
+
+    def write(self, timestamp, epoch, temp, serial_id):
+        index = self._sensors.get(serial_id)
+        if index is None:
+            index = self._sensors[serial_id] = len(self._sensors)
+            name = serial_id.encode('utf-8')
+            self._out_file.write(SENSOR_HEADER.pack('S', index, len(name)) + name)
+        self._block.append((index, epoch, storage.to_millic(temp)))
+        if len(self._block) == self._block_rows:
+            self.write_block()
+
+    def write_block(self):
+        rows = len(self._block)
+        if rows == 0:
+            return
+        base = min(row[1] for row in self._block)
+        self._out_file.write(BLOCK_HEADER.pack('R', rows, base) +
+                             struct.pack('<{0}H'.format(rows), *[row[0] for row in self._block]) +
+                             struct.pack('<{0}i'.format(rows), *[row[1] - base for row in self._block]) +
+                             struct.pack('<{0}i'.format(rows), *[row[2] for row in self._block]))
+        self._block = []
+
+    def close(self):
+        self.write_block()
+
+
+WRITERS = {'csv': CsvWriter, 'ndjson': NdjsonWriter, 'binary': BinaryWriter}
+
+
+# export()
+# ========
+# writes the readings to "file_name" ('-' for stdout) in "fmt" (None
+# goes by the name), returns the number of readings written
+def export(db_name, file_name, fmt=None, start=None, end=None, serial_ids=None, chunk_rows=CHUNK_ROWS, gzipped=None):
+    name_fmt, name_gzipped = get_format(file_name, fmt)
+    if gzipped is None:
+        gzipped = name_gzipped
+    if name_fmt not in FORMATS:
+        raise ValueError("no format for {0}, give one of {1}".format(file_name, ", ".join(FORMATS)))
+
+    conn = database.open_reader(db_name)
+    out_file = open_file(file_name, 'wb', gzipped)
+    try:
+        sensor_ids = None
+        if serial_ids:
+            sensor_ids = get_sensor_ids(conn, serial_ids)
+        writer = WRITERS[name_fmt](out_file)
+        exported = 0
+        for row in iter_rows(conn, parse_time(start), parse_time(end), sensor_ids, chunk_rows):
+            writer.write(*row)
+            exported += 1
+        writer.close()
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+        conn.close()
+    return exported
+
+
+# the read_*() yield (timestamp, temp, serial id) rows
+
+def read_csv(in_file):
+    for row in csv.reader(in_file):
+        if len(row) == 0 or row == CSV_HEADER:
+            continue
+        timestamp, serial_id, temp = row
+        yield timestamp, float(temp), serial_id.decode('utf-8')
+
+
+def read_ndjson(in_file):
+    for line in in_file:
+        if line.strip() == "":
+            continue
+        row = json.loads(line)
+        yield row["timestamp"], float(row["temp"]), row["serial_id"]
+
+
+def read_exactly(in_file, size):
+    data = in_file.read(size)
+    if len(data) != size:
+        raise ValueError("the file ends part way through a record")
+    return data
+
+
+def read_binary(in_file):
+    header = in_file.read(len(BINARY_MAGIC) + 1)
+    if header[:len(BINARY_MAGIC)] != BINARY_MAGIC or ord(header[-1]) != BINARY_VERSION:
+        raise ValueError("not a binary export")
+
+    sensors = []
+    while True:
+        kind = in_file.read(1)
+        if kind == '':
+            return
+        if kind == 'S':
+            kind, index, length = SENSOR_HEADER.unpack(kind + read_exactly(in_file, SENSOR_HEADER.size - 1))
+            sensors.append(read_exactly(in_file, length).decode('utf-8'))
+        elif kind == 'R':
+            kind, rows, base = BLOCK_HEADER.unpack(kind + read_exactly(in_file, BLOCK_HEADER.size - 1))
+            indexes = struct.unpack('<{0}H'.format(rows), read_exactly(in_file, 2 * rows))
+            offsets = struct.unpack('<{0}i'.format(rows), read_exactly(in_file, 4 * rows))
+            millics = struct.unpack('<{0}i'.format(rows), read_exactly(in_file, 4 * rows))
+            timestamps = {}  # the sensors are read together, a second's timestamp is wanted once each
+            for i in range(rows):
+                timestamp = timestamps.get(offsets[i])
+                if timestamp is None:
+                    timestamp = timestamps[offsets[i]] = storage.to_timestamp(base + offsets[i])
+                yield timestamp, millics[i] / 1000.0, sensors[indexes[i]]
+        else:
+            raise ValueError("bad record {0!r}".format(kind))
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson, 'binary': read_binary}
+
+
+# import_rows()
+# =============
+# writes (timestamp, temp, serial id) rows "chunk_rows" per transaction,
+# the sensors are added to the Sensor table as they turn up. Returns
+# (rows read, rows written), the difference were already in.
+def import_rows(conn, rows, chunk_rows=CHUNK_ROWS, verbose=False):
+    sensors = dict((serial_id, sensor_id) for sensor_id, serial_id in
+                   conn.execute("SELECT sensor_id, serial_id FROM Sensor"))
+    read = 0
+    written = 0
+    chunk = []
+    for timestamp, temp, serial_id in rows:
+        chunk.append((timestamp, temp, serial_id))
+        if len(chunk) == chunk_rows:
+            written += write_chunk(conn, chunk, sensors)
+            read += len(chunk)
+            chunk = []
+            if verbose:
+                print "{0} rows read, {1} written".format(read, written)
+    written += write_chunk(conn, chunk, sensors)
+    read += len(chunk)
+    return read, written
+
+
+def write_chunk(conn, chunk, sensors):
+    if len(chunk) == 0:
+        return 0
+    with conn:
+        rows = []
+        for timestamp, temp, serial_id in chunk:
+            sensor_id = sensors.get(serial_id)
+            if sensor_id is None:
+                conn.execute("INSERT OR IGNORE INTO Sensor(serial_id) VALUES(?)", (serial_id,))
+                sensor_id = conn.execute("SELECT sensor_id FROM Sensor WHERE serial_id = ?", (serial_id,)).fetchone()[0]
+            rows.append((timestamp, temp, sensor_id))
+        new_rows = storage.filter_new_rows(conn, rows)
+        storage.insert_rows(conn, new_rows)
+        rollup.update_rollups(conn, new_rows)
+        stats.update_stats(conn, new_rows)
+
+    # only once they're committed, a rolled back sensor_id may be reused
+    for timestamp, temp, serial_id in chunk:
+        if serial_id not in sensors:
+            sensors[serial_id] = conn.execute("SELECT sensor_id FROM Sensor WHERE serial_id = ?",
+                                              (serial_id,)).fetchone()[0]
+    return len(new_rows)
+
+
+# import_file()
+# =============
+# reads "file_name" ('-' for stdin) into "db_name", creating the
+# database (in the compact format with "compact") if it isn't there.
+# Returns (rows read, rows written).
+def import_file(db_name, file_name, fmt=None, chunk_rows=CHUNK_ROWS, gzipped=None, compact=False, verbose=False):
+    name_fmt, name_gzipped = get_format(file_name, fmt)
+    if gzipped is None:
+        gzipped = name_gzipped
+    if name_fmt not in FORMATS:
+        raise ValueError("no format for {0}, give one of {1}".format(file_name, ", ".join(FORMATS)))
+
+    monitor.create_log_schema(db_name, compact)
+    tempsensor.SensorsMgr(db_name).create_sensor_schema()
+
+    conn = database.connect(db_name)
+    in_file = open_file(file_name, 'rb', gzipped)
+    try:
+        return import_rows(conn, READERS[name_fmt](in_file), chunk_rows, verbose)
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+        conn.close()
+
+
+def create_parser():
+    parser = OptionParser(usage="export.py [options] export|import",
+                          description="Exports the readings to a csv, ndjson or binary file (gzipped if the name ends .gz), "
+                                      "or imports them into a database, skipping any it has already")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database", metavar="FILE")
+
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="file to export to, - for stdout", metavar="FILE")
+
+    parser.add_option("-i", "--input", dest="input", default=None,
+                      help="file to import, - for stdin", metavar="FILE")
+
+    parser.add_option("-f", "--format", dest="fmt", default=None, choices=FORMATS,
+                      help="csv, ndjson or binary (default from the file name)")
+
+    parser.add_option("-z", "--gzip", dest="gzipped", default=None, action="store_true",
+                      help="gzip (default if the file name ends .gz)")
+
+    parser.add_option("--start", dest="start", default=None,
+                      help="export from this time on, YYYY-MM-DD [HH:MM:SS]")
+
+    parser.add_option("--end", dest="end", default=None,
+                      help="export up to (not including) this time")
+
+    parser.add_option("-s", "--sensor", dest="serial_ids", default=[], action="append",
+                      help="export only this sensor, by serial id (repeat for more sensors)", metavar="SERIAL")
+
+    parser.add_option("-c", "--chunk", dest="chunk_rows", default=CHUNK_ROWS, type="int",
+                      help="rows to read at a time, and to import per transaction")
+
+    parser.add_option("--compact", dest="compact", default=False, action="store_true",
+                      help="create the database being imported into in the compact format (see storage.py)")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('export', 'import'):
+        parser.print_help()
+        sys.exit(-1)
+
+    try:
+        if args[0] == 'export':
+            exported = export(opts.db_name, opts.output or '-', opts.fmt, opts.start, opts.end, opts.serial_ids,
+                              opts.chunk_rows, opts.gzipped)
+            print >> sys.stderr, "{0} rows exported".format(exported)
+        else:
+            read, written = import_file(opts.db_name, opts.input or '-', opts.fmt, opts.chunk_rows, opts.gzipped,
+                                        opts.compact, opts.input not in (None, '-'))
+            print "{0} rows read, {1} imported, {2} were already in".format(read, written, read - written)
+    except ValueError as e:
+        print >> sys.stderr, e
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+import datetime
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+# live.py
+# =======
+# the monitor publishes every reading to a small memory mapped file,
+# the last "readings" of each sensor in a ring, so the chart (or
+# anything else on the Pi) can show the live window without going to
+# the database. SQLite is only needed for what's older than the ring.
+#
+#   header   magic, version, sensors, readings, started, updated
+#   sensors  one block per sensor:
+#              sensor id (0 for a free block), seq, count
+#              "readings" x (time, temp) as epoch seconds and C
+#
+# There's one writer (the monitor, whose sampling thread and Nest
+# poller take turns with a lock) and any number of readers in other
+# processes, with no locks between them. Each block
+# has a seqlock: the writer makes "seq" odd, writes the reading, bumps
+# "count" and makes "seq" even again. A reader reads "seq", then the
+# readings straight out of the mapping, then "seq" again and starts
+# over if it was odd or has moved on.
+#
+# The file lives in /dev/shm (memory, not the SD card) when there is
+# one. A new writer builds a fresh file and renames it into place, so a
+# reader that still has the old one mapped is never pulled out from
+# under.
+
+HEADER = struct.Struct('<4sIIIdd')
+BLOCK = struct.Struct('<iIQ')  # sensor id, seq, count
+READING = struct.Struct('<dd')  # time, temp
+MAGIC = 'SPLB'
+VERSION = 1
+
+DEFAULT_SENSORS = 64
+DEFAULT_READINGS = 720  # an hour at the default 5s period
+STALE_SECONDS = 60.0  # a buffer the monitor hasn't touched for this long is ignored
+RETRIES = 100
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def get_default_path():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/sensorpi.live'
+    return os.path.join(tempfile.gettempdir(), 'sensorpi.live')
+
+
+DEFAULT_PATH = get_default_path()
+
+
+def get_size(sensors, readings):
+    return HEADER.size + sensors * (BLOCK.size + readings * READING.size)
+
+
+# LiveWriter
+# ==========
+# the monitor's end of the buffer
+
+class LiveWriter(object):
+    def __init__(self, path=DEFAULT_PATH, sensors=DEFAULT_SENSORS, readings=DEFAULT_READINGS):
+        self._path = path
+        self._sensors = sensors
+        self._readings = readings
+        self._blocks = {}  # sensor id -> offset of its block
+        self._counts = {}  # sensor id -> readings written
+        self._lock = threading.Lock()
+
+        size = get_size(sensors, readings)
+        partial = "{0}.{1}".format(path, os.getpid())
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        now = time.time()
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, sensors, readings, now, now)
+        os.rename(partial, path)
+
+    # publish()
+    # =========
+    # adds a reading to the sensor's ring, False when there's no room
+    # for another sensor
+    def publish(self, sensor_id, timestamp, temp):
+        with self._lock:
+            return self._publish(sensor_id, timestamp, temp)
+
+    def _publish(self, sensor_id, timestamp, temp):
+        offset = self._blocks.get(sensor_id)
+        if offset is None:
+            if len(self._blocks) == self._sensors:
+                return False
+            offset = HEADER.size + len(self._blocks) * (BLOCK.size + self._readings * READING.size)
+            self._blocks[sensor_id] = offset
+            self._counts[sensor_id] = 0
+            BLOCK.pack_into(self._mm, offset, sensor_id, 0, 0)
+
+        count = self._counts[sensor_id]
+        seq = struct.unpack_from('<I', self._mm, offset + 4)[0]
+        struct.pack_into('<I', self._mm, offset + 4, seq + 1)  # odd, being written
+        READING.pack_into(self._mm, offset + BLOCK.size + (count % self._readings) * READING.size, timestamp, temp)
+        struct.pack_into('<Q', self._mm, offset + 8, count + 1)
+        struct.pack_into('<I', self._mm, offset + 4, (seq + 2) & 0xFFFFFFFF)
+        self._counts[sensor_id] = count + 1
+        return True
+
+    # the time of the last update, so readers can tell we're still here
+    def touch(self):
+        struct.pack_into('<d', self._mm, HEADER.size - 8, time.time())
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+# LiveReader
+# ==========
+# a consumer's view of the buffer, see open_reader()
+
+class LiveReader(object):
+    def __init__(self, mm):
+        self._mm = mm
+        magic, version, self._sensors, self._readings, self.started, self.updated = HEADER.unpack_from(mm, 0)
+
+    def is_stale(self):
+        updated = struct.unpack_from('<d', self._mm, HEADER.size - 8)[0]
+        return time.time() - updated > STALE_SECONDS
+
+    # read_block()
+    # ============
+    # (sensor id, count, [(time, temp)] oldest first) for the block at
+    # "offset", or None if the writer kept getting in the way
+    def read_block(self, offset):
+        for i in range(RETRIES):
+            sensor_id, seq, count = BLOCK.unpack_from(self._mm, offset)
+            if seq & 1:
+                time.sleep(0)
+                continue
+
+            kept = min(count, self._readings)
+            first = count - kept
+            readings = []
+            for n in range(first, count):
+                readings.append(READING.unpack_from(self._mm, offset + BLOCK.size + (n % self._readings) * READING.size))
+
+            if struct.unpack_from('<I', self._mm, offset + 4)[0] == seq:
+                return sensor_id, count, readings
+        return None
+
+    # read_all()
+    # ==========
+    # {sensor id: (count, readings)} for every sensor in the buffer
+    def read_all(self):
+        sensors = {}
+        for i in range(self._sensors):
+            offset = HEADER.size + i * (BLOCK.size + self._readings * READING.size)
+            if struct.unpack_from('<i', self._mm, offset)[0] == 0:
+                break  # blocks are handed out in order, the rest are free
+            block = self.read_block(offset)
+            if block is None:
+                return None
+            sensors[block[0]] = (block[1], block[2])
+        return sensors
+
+    # get_rows()
+    # ==========
+    # the readings from "start" on as chart.get_data() rows,
+    # (sensor, timestamp, temp, -sensor) in (timestamp, key) order, or
+    # None when the buffer doesn't hold everything since "start" (it
+    # has wrapped past it, or the monitor started after it) or the
+    # monitor has gone away.
+    def get_rows(self, start, end=None, after=None, limit=None):
+        if self.is_stale():
+            return None
+
+        start_time = time.mktime(datetime.datetime.strptime(start, TIME_FORMAT).timetuple())
+        sensors = self.read_all()
+        if sensors is None or self.started > start_time:
+            return None
+
+        rows = []
+        for sensor_id, (count, readings) in sensors.items():
+            if count > self._readings and readings[0][0] > start_time:
+                return None  # the ring has already dropped some of the window
+            for reading_time, temp in readings:
+                timestamp = datetime.datetime.fromtimestamp(reading_time).strftime(TIME_FORMAT)
+                if timestamp < start or (end is not None and timestamp >= end):
+                    continue
+                row = (sensor_id, timestamp, temp, -sensor_id)
+                if after is not None and (timestamp, -sensor_id) <= (after[0], after[1]):
+                    continue
+                rows.append(row)
+
+        rows.sort(key=lambda row: (row[1], row[3]))
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+    def close(self):
+        self._mm.close()
+
+
+# open_reader()
+# =============
+# maps the monitor's buffer for reading, None when there isn't one
+def open_reader(path=DEFAULT_PATH):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        if size < HEADER.size:
+            return None
+        mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    magic, version, sensors, readings = HEADER.unpack_from(mm, 0)[:4]
+    if magic != MAGIC or version != VERSION or size < get_size(sensors, readings):
+        mm.close()
+        return None
+    return LiveReader(mm)
+
+
+def create_parser():
+    parser = OptionParser(usage="live.py [options]",
+                          description="Shows the latest readings in the monitor's live buffer")
+
+    parser.add_option("-f", "--file", dest="path", default=DEFAULT_PATH,
+                      help="the live buffer", metavar="FILE")
+
+    parser.add_option("-n", "--readings", dest="readings", default=5, type="int",
+                      help="readings to show per sensor")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    reader = open_reader(opts.path)
+    if reader is None:
+        print "no live buffer at {0}".format(opts.path)
+        sys.exit(-1)
+
+    if reader.is_stale():
+        print "(the monitor hasn't updated the buffer for a while)"
+    for sensor_id, (count, readings) in sorted((reader.read_all() or {}).items()):
+        latest = ", ".join("{0} {1:.3f}".format(time.strftime('%H:%M:%S', time.localtime(t)), temp)
+                           for t, temp in readings[-opts.readings:])
+        print "[{0}] {1} readings: {2}".format(sensor_id, count, latest)
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
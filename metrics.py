@@ -0,0 +1,251 @@
+import BaseHTTPServer
+import bisect
+import os
+import threading
+
+# metrics.py
+# ==========
+# counters, gauges and histograms the monitor keeps as it runs, shown
+# in the Prometheus text format on a local port (serve()) or written
+# to a file for node_exporter's textfile collector (write_textfile()).
+# Recording is a dict lookup, a lock and an add, cheap enough to do
+# for every probe on every cycle.
+#
+#   READ_SECONDS = metrics.histogram('sensorpi_read_seconds', 'Time to read a probe', ['sensor'])
+#   READ_SECONDS.labels('28-0416718527ff').observe(0.75)
+#
+# Values that are already kept elsewhere (the compressors' counts, the
+# writer's statistics) are read when the metrics are rendered rather
+# than copied every cycle, see add_collector().
+
+# seconds, from a fast read to a probe that hung for the whole timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0)
+
+
+class CounterValue(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get_samples(self, name):
+        return [(name, (), self.value)]
+
+
+class GaugeValue(CounterValue):
+    def set(self, value):
+        self.value = value
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self._sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def get_samples(self, name):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(list(self._buckets) + ['+Inf'], counts):
+            cumulative += count
+            samples.append((name + '_bucket', (('le', format_value(bound)),), cumulative))
+        samples.append((name + '_sum', (), total))
+        samples.append((name + '_count', (), cumulative))
+        return samples
+
+
+# Metric
+# ======
+# one named metric, with a value for each combination of its labels.
+# A metric without labels can be used directly (inc/set/observe).
+
+class Metric(object):
+    def __init__(self, name, help_text, kind, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self._label_names = tuple(label_names)
+        self._buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+        if len(self._label_names) == 0:
+            self.labels()  # shows up as 0 before anything happens
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self._label_names):
+                raise ValueError("{0} takes labels {1}".format(self.name, self._label_names))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_value()
+        return child
+
+    def _new_value(self):
+        if self.kind == 'histogram':
+            return HistogramValue(self._buckets)
+        if self.kind == 'gauge':
+            return GaugeValue()
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def get_samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+
+        samples = []
+        for values, child in children:
+            labels = tuple(zip(self._label_names, values))
+            for name, extra, value in child.get_samples(self.name):
+                samples.append((name, labels + extra, value))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    # add_collector()
+    # ===============
+    # "collect" is called each time the metrics are rendered and
+    # returns a list of (name, help, kind, [(labels dict, value)])
+    def add_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        for metric in metrics:
+            add_family(lines, metric.name, metric.help_text, metric.kind, metric.get_samples())
+
+        for collect in collectors:
+            for name, help_text, kind, values in collect():
+                samples = [(name, tuple(sorted(labels.items())), value) for labels, value in values]
+                add_family(lines, name, help_text, kind, samples)
+
+        return "\n".join(lines) + "\n"
+
+
+def add_family(lines, name, help_text, kind, samples):
+    lines.append("# HELP {0} {1}".format(name, help_text.replace("\\", "\\\\").replace("\n", "\\n")))
+    lines.append("# TYPE {0} {1}".format(name, kind))
+    for sample_name, labels, value in samples:
+        lines.append("{0}{1} {2}".format(sample_name, format_labels(labels), format_value(value)))
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, escape(value)) for name, value in labels) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Metric(name, help_text, 'counter', label_names))
+
+
+def gauge(name, help_text, label_names=()):
+    return REGISTRY.register(Metric(name, help_text, 'gauge', label_names))
+
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Metric(name, help_text, 'histogram', label_names, buckets))
+
+
+def add_collector(collect):
+    REGISTRY.add_collector(collect)
+
+
+# write_textfile()
+# ================
+# the metrics into "path", via a temporary file and a rename so the
+# collector never reads half of it
+def write_textfile(path, registry=REGISTRY):
+    partial = path + ".tmp"
+    with open(partial, "w") as metrics_file:
+        metrics_file.write(registry.render())
+    os.rename(partial, path)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # a scrape every 15s would drown out the readings
+
+
+# serve()
+# =======
+# answers GET /metrics on its own thread, returns the server so it can
+# be shut down
+def serve(address, port):
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,103 +1,702 @@
 import sqlite3
 import datetime
+import signal
+import sys
 import time
 import tempsensor
+import database
+import rollup
+import storage
+import stats
+import compression
+import scheduler
+import spool
+import runtime
+import metrics
+import live
+import retention
+import nest
+import nestpoller
+import sender
+from optparse import OptionParser
 
 dbname = '/home/pi/sensorlog.db'
 
+# what we measure as we go, see metrics.py and --metrics-port
+READ_SECONDS = metrics.histogram('sensorpi_read_seconds', 'Time taken to read a probe', ['sensor'])
+READ_FAILURES = metrics.counter('sensorpi_read_failures_total', 'Probe reads that failed', ['sensor', 'reason'])
+CYCLE_SECONDS = metrics.histogram('sensorpi_cycle_seconds', 'Time taken by a sampling cycle')
+TICK_LATE_SECONDS = metrics.histogram('sensorpi_tick_late_seconds', 'How late a sampling cycle started (scheduler drift)',
+									  buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+MISSED_TICKS = metrics.counter('sensorpi_missed_ticks_total', 'Sampling ticks missed because a cycle overran')
+OVERRUNS = metrics.counter('sensorpi_overruns_total', 'Sampling cycles that started after the next tick was due')
+WRITE_SECONDS = metrics.histogram('sensorpi_write_seconds', 'Time taken by a database write transaction')
+ROWS_WRITTEN = metrics.counter('sensorpi_rows_written_total', 'Rows written to the database')
+WRITE_FAILURES = metrics.counter('sensorpi_write_failures_total', 'Database writes that failed', ['reason'])
+ROWS_SPOOLED = metrics.counter('sensorpi_rows_spooled_total', 'Rows written to the spool instead of the database')
+
 # ------------------------------------------------------
-def create_log_schema(db_name):
-	conn = sqlite3.connect(db_name)
+# with "compact" new readings go to the compact table (storage.py),
+# an existing database is moved over with "storage.py migrate"
+def create_log_schema(db_name, compact=False):
+	conn = database.connect(db_name)
 	conn.execute("CREATE TABLE IF NOT EXISTS Temperature([timestamp] TIMESTAMP, temp NUMERIC, sensor INTEGER);")
+	if compact:
+		storage.create_compact_schema(conn)
 	conn.commit()
+	migrate_log_schema(conn)
 	conn.close()
 	return
 
-# log_data()
-# ==========
-# only writes to the database if the data has changed
-# or we are told to "force" a write.
+# migrate_log_schema()
+# ====================
+# brings an existing database up to date, the schema version
+# lives in "PRAGMA user_version" so each step only runs once.
+#   1 - indexes for time range queries (chart.get_data)
+#   2 - minute/hour/day rollup tables (see rollup.py)
+#   3 - per sensor statistics (see stats.py), worked out from the
+#       rows logged so far
 
-def log_data(sensor_list, force_logging, db_name):
-	conn = sqlite3.connect(db_name)
-	curs = conn.cursor()
-	data_logged = False
+LOG_SCHEMA_VERSION = 3
 
-	# write the list of temperatures passed in
-	ins_sql = "INSERT INTO Temperature([timestamp], temp, sensor) VALUES(?,?,?)"
-	timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def migrate_log_schema(conn):
+	version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+	if version < 1:
+		conn.execute("CREATE INDEX IF NOT EXISTS TemperatureTime ON Temperature([timestamp]);")
+		conn.execute("CREATE INDEX IF NOT EXISTS TemperatureSensorTime ON Temperature(sensor, [timestamp]);")
 
+	if version < 2:
+		rollup.create_rollup_schema(conn)
+
+	if version < 3:
+		conn.commit()
+		stats.rebuild(conn)
+
+	if version < LOG_SCHEMA_VERSION:
+		conn.execute("PRAGMA user_version = {0}".format(LOG_SCHEMA_VERSION))
+		conn.commit()
+	return
+
+def format_timestamp(point_time):
+	return datetime.datetime.fromtimestamp(point_time).strftime('%Y-%m-%d %H:%M:%S')
+
+# collect_rows()
+# ==============
+# the (timestamp, temp, sensor) rows to log for this cycle, printing
+# each sensor's reading as we go.
+
+def collect_rows(sensor_list, force_logging):
+	rows = []
 	for sensor in sensor_list:
-		if sensor._active == False:
+		if sensor._active == False or sensor.get_temperature() is None:
 			continue
 
 		print '[{0}]{1:.2f}C {2:.2f}F'.format(sensor._sensor_id, sensor.get_temperature(), sensor.get_temperature(True)),
 
-		# only write out a temperature to the DB if we *have to*, meaning it has
-		# changed or there have been no changes in a long while so we are forcing a write
-		if sensor.get_dirty_temp() == False and force_logging == False:
-			continue
+		# only write out a temperature to the DB if we *have to*, meaning the
+		# sensor's compressor wants it or there have been no changes in a long
+		# while so we are forcing a write
+		for point_time, temp in sensor.take_points(force_logging):
+			rows.append((format_timestamp(point_time), temp, sensor._sensor_id))
 
-		curs.execute(ins_sql, (timestamp, sensor.get_temperature(), sensor._sensor_id))
-		data_logged = True
+	return rows
 
+# log_data()
+# ==========
+# only writes to the database if the data has changed
+# or we are told to "force" a write.
+
+def log_data(sensor_list, force_logging, db_name):
+	conn = database.connect(db_name)
+	data_logged = False
+
+	# write the list of temperatures passed in
+	rows = collect_rows(sensor_list, force_logging)
+	inserted = storage.insert_rows(conn, rows)
+	data_logged = len(rows) != 0
+
+	rollup.update_rollups(conn, inserted)
+	stats.update_stats(conn, inserted)
 	conn.commit()
 	conn.close()
 	return data_logged
 
 
-# Sleep()
-# =======
-# There's a lot of processing time in the loop
-# (probably the DB connection stuff) that impacts
-# the interval of sampling, this will adjust.
+# LogWriter
+# =========
+# keeps a single connection to the database open and queues
+# up the readings in memory. The queue is written out with one
+# executemany() in a single transaction once we have collected
+# "flush_samples" rows or "flush_seconds" have elapsed since the
+# last flush, whichever comes first. The rollup tables are updated
+# in the same transaction. Compared to log_data() (one
+# connect/commit/close per sampling cycle) we can see the savings
+# in the ratio of cycles to commits.
+#
+# The writer owns the WAL checkpoints (see database.py), one every
+# "checkpoint_seconds" after a flush. When another writer has the
+# database locked we don't wait on it.
+#
+# With a "spool_name" a flush the database won't take (locked, corrupt,
+# disk full) goes to the spool file instead (see spool.py) and the
+# monitor carries on. The spool is replayed ahead of the next flush
+# that can get through, so the rows still go in in order. Without one
+# a locked database leaves the rows queued for the next flush and any
+# other error is raised.
 #
-def Sleep(time_last_sleep, sleep_interval):
-	# time_last_sleep is in seconds
-	# sleep_interval is a float
-	if (time_last_sleep == 0):
-		time.sleep(sleep_interval)
+# With an "outbox" (see sender.py) every row also goes to the outbox,
+# sealed into a batch for the collector at each flush whether the
+# database took the rows or not.
+
+class LogWriter(object):
+	def __init__(self, db_name, flush_samples=60, flush_seconds=60.0, checkpoint_seconds=300.0, spool_name=None,
+				 outbox=None):
+		self._db_name = db_name
+		self._flush_samples = flush_samples
+		self._flush_seconds = flush_seconds
+		self._checkpoint_seconds = checkpoint_seconds
+		self._queue = []
+		self._time_last_flush = scheduler.monotonic()
+		self._time_last_checkpoint = self._time_last_flush
+		self._conn = database.open_writer(db_name)
+		self._spool = None
+		if spool_name is not None:
+			self._spool = spool.Spool(spool_name)
+		self._outbox = outbox
+
+		# statistics so we can measure the write amplification
+		self._cycles = 0
+		self._commits = 0
+		self._rows_written = 0
+		self._busy = 0	# flushes put off because the database was locked
+		self._checkpoints = 0
+		self._wal_pages = 0	# pages in the WAL after the last checkpoint
+		self._failures = 0	# flushes that failed for any other reason
+
+		# anything left in the spool from last time goes in first
+		if self._spool is not None and self._spool.has_records():
+			self.flush()
+
+	# same contract as log_data(), only writes the points the sensors'
+	# compressors want (or all when forced), returns True if anything
+	# was queued
+	def log_data(self, sensor_list, force_logging):
+		rows = collect_rows(sensor_list, force_logging)
+		self.add_rows(rows)
+		return len(rows) != 0
+
+	def add_rows(self, rows):
+		self._cycles += 1
+		self._queue.extend(rows)
+		if self._outbox is not None:
+			self._outbox.add_rows(rows)
+
+		if self.flush_due():
+			self.flush()
 		return
 
-	current_time = time.time()
-	delta_time = current_time - time_last_sleep
-	new_sleep_interval = sleep_interval - delta_time
-	if (new_sleep_interval < 0.0):
-		time.sleep(sleep_interval)
+	def flush_due(self):
+		if len(self._queue) == 0:
+			return False
+		if len(self._queue) >= self._flush_samples:
+			return True
+		return (scheduler.monotonic() - self._time_last_flush) >= self._flush_seconds
+
+	# seconds until the queued rows are due to be written, None when
+	# there's nothing queued
+	def time_to_flush(self):
+		if len(self._queue) == 0:
+			return None
+		return max(0.0, self._time_last_flush + self._flush_seconds - scheduler.monotonic())
+
+	def flush(self):
+		self._time_last_flush = scheduler.monotonic()
+		self.seal_outbox()
+		spooled = self._spool is not None and self._spool.has_records()
+		if len(self._queue) == 0 and not spooled:
+			return 0
+
+		rows = self._queue
+		try:
+			if self._conn is None:
+				self._conn = database.open_writer(self._db_name)
+			if spooled:
+				ROWS_WRITTEN.inc(self._spool.replay(self._conn))
+			started = scheduler.monotonic()
+			with self._conn:	# commits on success, rolls back on error
+				inserted = storage.insert_rows(self._conn, rows)	# the format can change under us, see storage.migrate()
+				rollup.update_rollups(self._conn, inserted)
+				stats.update_stats(self._conn, inserted)
+			WRITE_SECONDS.observe(scheduler.monotonic() - started)
+		except (sqlite3.Error, EnvironmentError) as e:
+			self.write_failed(e)
+			return 0
+
+		self._queue = []
+		self._commits += 1
+		self._rows_written += len(rows)
+		ROWS_WRITTEN.inc(len(rows))
+
+		if scheduler.monotonic() - self._time_last_checkpoint >= self._checkpoint_seconds:
+			self.checkpoint()
+		return len(rows)
+
+	# write_failed()
+	# ==============
+	# the queued rows couldn't be written, spool them if we can.
+	def write_failed(self, error):
+		if database.is_busy(error):
+			self._busy += 1
+			WRITE_FAILURES.labels('busy').inc()
+		else:
+			self._failures += 1
+			WRITE_FAILURES.labels('error').inc()
+			if self._spool is None:
+				raise error
+			print "database write failed ({0}), spooling to {1}".format(error, self._spool.get_name())
+			# start again with a new connection next time, the old one
+			# may be no good (the file was replaced, say)
+			try:
+				self._conn.close()
+			except (sqlite3.Error, AttributeError):
+				pass
+			self._conn = None
+
+		if self._spool is None:
+			return	# locked, try again next flush
+
+		try:
+			self._spool.append(self._queue)
+		except EnvironmentError as e:
+			print "spool write failed ({0}), keeping {1} rows in memory".format(e, len(self._queue))
+			return
+		ROWS_SPOOLED.inc(len(self._queue))
+		self._queue = []
 		return
 
-	time.sleep(new_sleep_interval)
-	return
+	# the rows added since the last flush become the collector's next
+	# batch. A full card keeps them for the next flush, the database
+	# write is what matters here.
+	def seal_outbox(self):
+		if self._outbox is None:
+			return
+		try:
+			self._outbox.seal()
+		except EnvironmentError as e:
+			print "outbox write failed ({0}), keeping {1} rows for the next one".format(e, self._outbox.get_pending_rows())
+		return
 
-def main():
+	def checkpoint(self, mode='PASSIVE'):
+		self._time_last_checkpoint = scheduler.monotonic()
+		if self._conn is None:
+			return
+		try:
+			busy, self._wal_pages, copied = database.checkpoint(self._conn, mode)
+		except sqlite3.OperationalError as e:
+			if not database.is_busy(e):
+				raise
+			return
+		self._checkpoints += 1
+		return
+
+	def close(self):
+		if self._conn is not None:
+			# on the way out it's worth waiting for the lock rather than
+			# losing the rows
+			self._conn.execute("PRAGMA busy_timeout = {0}".format(int(database.BUSY_TIMEOUT * 1000)))
+		self.flush()
+		if self._conn is None:
+			return
+		self.checkpoint('TRUNCATE')	# leave an empty WAL behind
+		self._conn.close()
+		self._conn = None
+
+	def get_pending(self):
+		return len(self._queue)
+
+	# returns (cycles, commits, rows written). log_data() would
+	# have committed once per cycle for the same rows.
+	def get_stats(self):
+		return self._cycles, self._commits, self._rows_written
+
+	# returns (flushes put off by a locked database, checkpoints,
+	# pages in the WAL after the last one)
+	def get_wal_stats(self):
+		return self._busy, self._checkpoints, self._wal_pages
+
+	# returns (failed flushes, rows spooled, rows replayed from the
+	# spool, spooled rows that were already in the database)
+	def get_spool_stats(self):
+		if self._spool is None:
+			return self._failures, 0, 0, 0
+		return self._failures, self._spool.rows_spooled, self._spool.rows_replayed, self._spool.duplicates
+
+
+def create_parser():
+	parser = OptionParser(usage="monitor.py [options]")
+
+	parser.add_option("-d", "--db", dest="db_name", default=dbname,
+					  help="sqlite database to log to", metavar="FILE")
+
+	parser.add_option("--compact", dest="compact", default=False, action="store_true",
+					  help="log in the compact format (integer time and milli-degrees, see storage.py)")
+
+	parser.add_option("--flush-samples", dest="flush_samples", default=60, type="int",
+					  help="write queued readings once this many are pending")
+
+	parser.add_option("--flush-seconds", dest="flush_seconds", default=60.0, type="float",
+					  help="write queued readings at least this often")
+
+	parser.add_option("--live", dest="live_path", default=live.DEFAULT_PATH,
+					  help="shared memory file to publish the latest readings in (see live.py)", metavar="FILE")
+
+	parser.add_option("--live-readings", dest="live_readings", default=live.DEFAULT_READINGS, type="int",
+					  help="readings per sensor to keep in the live file (0 for none)")
+
+	parser.add_option("--live-sensors", dest="live_sensors", default=live.DEFAULT_SENSORS, type="int",
+					  help="most sensors the live file has room for")
+
+	parser.add_option("--metrics-port", dest="metrics_port", default=0, type="int",
+					  help="serve the metrics in the Prometheus text format on this port (0 for off)")
+
+	parser.add_option("--metrics-address", dest="metrics_address", default="127.0.0.1",
+					  help="address to serve the metrics on")
+
+	parser.add_option("--metrics-textfile", dest="metrics_textfile", default=None,
+					  help="write the metrics to this file, for node_exporter's textfile collector", metavar="FILE")
+
+	parser.add_option("--metrics-seconds", dest="metrics_seconds", default=15.0, type="float",
+					  help="how often to write the metrics file")
+
+	parser.add_option("--spool", dest="spool_name", default=None,
+					  help="where to keep readings while the database can't be written (default the database name + .spool)",
+					  metavar="FILE")
+
+	parser.add_option("--checkpoint-seconds", dest="checkpoint_seconds", default=300.0, type="float",
+					  help="copy the WAL back into the database this often")
+
+	parser.add_option("--keep-days", dest="keep_days", default=0, type="int",
+					  help="move raw readings older than this many days to the archive (0 keeps them all)")
+
+	parser.add_option("--archive-dir", dest="archive_dir", default=retention.DEFAULT_ARCHIVE,
+					  help="where the archived readings go", metavar="DIR")
+
+	parser.add_option("--retention-seconds", dest="retention_seconds", default=3600.0, type="float",
+					  help="how often to look for readings to archive")
+
+	parser.add_option("--nest-user", dest="nest_user", default=None,
+					  help="also log the Nest thermostat's temperature, humidity and setpoint, username on nest.com")
+
+	parser.add_option("--nest-password", dest="nest_password", default=None,
+					  help="password on nest.com")
+
+	parser.add_option("--nest-serial", dest="nest_serial", default=None,
+					  help="serial number of the thermostat (default the first one)")
+
+	parser.add_option("--nest-login-url", dest="nest_login_url", default=nest.LOGIN_URL,
+					  help="where to log in to Nest (a test server, say)", metavar="URL")
+
+	parser.add_option("--nest-cache", dest="nest_cache", default=nest.CACHE_FILE,
+					  help="file to keep the Nest login in", metavar="FILE")
+
+	parser.add_option("--nest-min-interval", dest="nest_min_interval", default=nestpoller.MIN_INTERVAL, type="float",
+					  help="seconds between polls of the thermostat while it's changing")
+
+	parser.add_option("--nest-max-interval", dest="nest_max_interval", default=nestpoller.MAX_INTERVAL, type="float",
+					  help="most seconds between polls while nothing changes")
+
+	parser.add_option("--collector", dest="collector_url", default=None,
+					  help="also send the readings to the collector at this url (see collector.py)", metavar="URL")
+
+	parser.add_option("--node", dest="node", default=sender.get_node_name(),
+					  help="what the collector calls this monitor (default the host name)")
+
+	parser.add_option("--outbox", dest="outbox_dir", default=None,
+					  help="where readings wait for the collector (default the database name + .outbox)", metavar="DIR")
+
+	parser.add_option("--compression", dest="compression", default=compression.DEFAULT_MODE,
+					  choices=sorted(compression.MODES.keys()),
+					  help="which readings to log: raw, deadband or swingingdoor (see compression.py)")
+
+	parser.add_option("--tolerance", dest="tolerance", default=compression.DEFAULT_TOLERANCE, type="float",
+					  help="error (C) the compression may introduce")
+
+	parser.add_option("--sensor-tolerance", dest="sensor_tolerances", default=[], action="append",
+					  help="tolerance for one sensor, SERIAL=C (repeat for more sensors)", metavar="SERIAL=C")
+
+	parser.add_option("--period", dest="period", default=5.0, type="float",
+					  help="seconds between readings")
+
+	parser.add_option("--sensor-period", dest="sensor_periods", default=[], action="append",
+					  help="seconds between readings for one sensor, SERIAL=S (repeat for more sensors)", metavar="SERIAL=S")
+
+	parser.add_option("--missed-ticks", dest="missed_ticks", default="coalesce", choices=scheduler.POLICIES,
+					  help="after an overrun: coalesce (read once for the missed ticks) or skip (wait for the next tick)")
+
+	parser.add_option("--w1-devices", dest="w1_devices", default=tempsensor.W1_DEVICES,
+					  help="where the 1-Wire probes show up", metavar="DIR")
+
+	parser.add_option("--rescan-seconds", dest="rescan_seconds", default=30.0, type="float",
+					  help="look for probes being added or removed this often (0 never looks)")
+
+	parser.add_option("--queue-size", dest="queue_size", default=100, type="int",
+					  help="batches of readings that can wait for the database writer")
+
+	parser.add_option("--backfill-chunk", dest="backfill_chunk", default=1000, type="int",
+					  help="rows to roll up every 10 seconds until the rollups are complete")
+
+	parser.add_option("--read-timeout", dest="read_timeout", default=2.0, type="float",
+					  help="read probes concurrently, giving up on a probe after this many seconds (0 reads them one at a time)")
+
+	return parser
+
+# Sampler
+# =======
+# the sensor side of the monitor, runs on the runtime's producer
+# thread. Each tick reads the sensors that are due and returns the
+# rows their compressors want logged. Every "rescan_seconds" we look
+# for probes coming and going (sysfs can't be watched with inotify,
+# a directory listing is cheap enough).
+
+class Sampler(object):
 	LOGGING_THRESHOLD = 10 * 60  # don't let more than 10 minutes elapse without logging
 
-	sampling_interval_seconds = 5  # every 5 seconds (our sampling interval)
-	create_log_schema(dbname)  # if our table doesn't exist, create it
+	def __init__(self, sensor_mgr, ticker, default_period, sensor_periods, read_timeout, rescan_seconds=30.0,
+				 live_writer=None):
+		self._sensor_mgr = sensor_mgr
+		self._live_writer = live_writer	# every reading goes here too, see live.py
+		self._ticker = ticker
+		self._default_period = default_period
+		self._sensor_periods = sensor_periods  # serial_id -> period
+		self._read_timeout = read_timeout or None
+		self._rescan_seconds = rescan_seconds
+		self._time_last_logging = scheduler.monotonic()
+		self._time_last_rescan = scheduler.monotonic()
 
-	sensor_mgr = tempsensor.SensorsMgr(dbname)
+	def get_period(self, sensor):
+		return self._sensor_periods.get(sensor.get_serial_id(), self._default_period)
 
-	# create our Sensor list managment classes
-	sensor_mgr.initialize_sensors()
+	# rescan()
+	# ========
+	# picks up probes that have been plugged in or pulled out since we
+	# last looked. A probe that's gone gets its last point logged.
+	def rescan(self):
+		self._time_last_rescan = scheduler.monotonic()
+		appeared, vanished = self._sensor_mgr.rescan_sensors()
+		for serial_id in appeared:
+			print "+{0}".format(serial_id),
+
+		rows = []
+		for sensor in vanished:
+			print "-{0}".format(sensor.get_serial_id()),
+			for point_time, temp in sensor.take_points(True):
+				rows.append((format_timestamp(point_time), temp, sensor._sensor_id))
+		return rows
 
-	sensors = sensor_mgr.find_sensors()
+	def sample(self, periods_due):
+		started = scheduler.monotonic()
+		TICK_LATE_SECONDS.observe(self._ticker.last_jitter)
+		if self._ticker.last_missed != 0:
+			MISSED_TICKS.inc(self._ticker.last_missed)
+			OVERRUNS.inc()
 
-	last_sleep_time = 0.0
-	time_last_logging = time.time()
-	while True:
-		sensor_mgr.read_sensors()	# read the temperature probes
-		data_logged = log_data(sensor_mgr.get_sensor_list(),
-							   (time.time() - time_last_logging) > LOGGING_THRESHOLD, dbname)
-		if data_logged:
-			time_last_logging = time.time()
+		rows = []
+		if self._rescan_seconds and scheduler.monotonic() - self._time_last_rescan >= self._rescan_seconds:
+			rows = self.rescan()
+
+		sensors = [sensor for sensor in self._sensor_mgr.get_probe_list() if self.get_period(sensor) in periods_due]
+		time_read = time.time()
+		failures = self._sensor_mgr.read_sensors(self._read_timeout, sensors)	# read the temperature probes
+		for sensor_id in sorted(failures.keys()):
+			print '[{0}]{1}'.format(sensor_id, failures[sensor_id]),
+		self.record_reads(sensors, failures)
+		self.publish(sensors, failures, time_read)
+
+		rows += collect_rows(self._sensor_mgr.get_probe_list(),
+							 (scheduler.monotonic() - self._time_last_logging) > self.LOGGING_THRESHOLD)
+		if self._ticker.last_missed != 0:
+			print "(missed {0} ticks)".format(self._ticker.last_missed),
+		if len(rows) != 0:
+			self._time_last_logging = scheduler.monotonic()
 			print " (logged)"
 		else:
 			print ""
 
-		Sleep(last_sleep_time, sampling_interval_seconds)
-		last_sleep_time = time.time()
+		CYCLE_SECONDS.observe(scheduler.monotonic() - started)
+		return rows
+
+	def publish(self, sensors, failures, time_read):
+		if self._live_writer is None:
+			return
+		for sensor in sensors:
+			if sensor._active == False or sensor._sensor_id in failures or sensor.get_temperature() is None:
+				continue
+			self._live_writer.publish(sensor._sensor_id, time_read, sensor.get_temperature())
+		self._live_writer.touch()
+		return
+
+	def record_reads(self, sensors, failures):
+		for sensor in sensors:
+			if sensor._active == False:
+				continue
+			serial_id = sensor.get_serial_id()
+			reason = failures.get(sensor._sensor_id)
+			if reason is not None:
+				if reason not in ('timeout', 'busy', 'crc error'):
+					reason = 'error'	# keep the label values to a handful
+				READ_FAILURES.labels(serial_id, reason).inc()
+			if reason not in ('timeout', 'busy') and sensor.get_read_seconds() is not None:
+				READ_SECONDS.labels(serial_id).observe(sensor.get_read_seconds())
+		return
+
+	# log where each sensor's signal ends before we go
+	def finish(self):
+		rows = collect_rows(self._sensor_mgr.get_probe_list(), True)
+		print ""
+		return rows
+
+# get_collector()
+# ===============
+# the metrics that are counted elsewhere already, read when the
+# metrics are rendered: each sensor's readings and how many of them
+# the compression logged or suppressed, and the writer's queue.
+def get_collector(sensor_mgr, monitor):
+	def collect():
+		readings = []
+		logged = []
+		suppressed = []
+		for sensor in sensor_mgr.get_sensor_list():
+			compressor = sensor.get_compressor()
+			labels = {'sensor': sensor.get_serial_id()}
+			readings.append((labels, compressor.samples))
+			logged.append((labels, compressor.points))
+			suppressed.append((labels, max(0, compressor.samples - compressor.points)))
+
+		return [('sensorpi_readings_total', 'Readings taken (since the compression was set up)', 'counter', readings),
+				('sensorpi_readings_logged_total', 'Readings the compression kept', 'counter', logged),
+				('sensorpi_readings_suppressed_total', 'Readings the compression left out', 'counter', suppressed),
+				('sensorpi_write_backpressure_total', 'Times sampling waited for the writer', 'counter',
+				 [({}, monitor.backpressure)])]
+	return collect
+
+# turns the SERIAL=value options into {serial_id: value}
+def parse_sensor_values(values):
+	sensor_values = {}
+	for value in values:
+		serial_id, sensor_value = value.split('=', 1)
+		sensor_values[serial_id] = float(sensor_value)
+	return sensor_values
+
+def main():
+	parser = create_parser()
+	(opts, args) = parser.parse_args()
+
+	create_log_schema(opts.db_name, opts.compact)  # if our table doesn't exist, create it
+
+	sensor_mgr = tempsensor.SensorsMgr(opts.db_name, opts.w1_devices)
+	sensor_mgr.set_compression(opts.compression, opts.tolerance, parse_sensor_values(opts.sensor_tolerances))
+
+	# create our Sensor list managment classes
+	sensor_mgr.initialize_sensors()
+
+	# a "kill" should flush our queue just like a ^C does
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	monitor = runtime.Runtime(opts.queue_size)
+
+	# every sampling period is a job on the scheduler, when it's due we
+	# read the sensors that have that period
+	sensor_periods = parse_sensor_values(opts.sensor_periods)
+	ticker = scheduler.Scheduler(opts.missed_ticks, sleep=monitor.sleep)
+	for period in sorted(set([opts.period] + sensor_periods.values())):
+		ticker.add(period, period)
+
+	live_writer = None
+	if opts.live_readings > 0:
+		live_writer = live.LiveWriter(opts.live_path, opts.live_sensors, opts.live_readings)
+
+	sampler = Sampler(sensor_mgr, ticker, opts.period, sensor_periods, opts.read_timeout, opts.rescan_seconds,
+					  live_writer)
+	monitor.add_producer("sensors", ticker, sampler.sample, sampler.finish)
+
+	# the thermostat's values are virtual sensors, their rows go to the
+	# same writer (and transactions) as the probes'
+	poller = None
+	if opts.nest_user:
+		thermostat = nest.Nest(opts.nest_user, opts.nest_password, opts.nest_serial, units="C",
+							   login_url=opts.nest_login_url, cache_file=opts.nest_cache)
+		poller = nestpoller.NestPoller(thermostat, sensor_mgr, opts.nest_min_interval, opts.nest_max_interval,
+									   live_writer)
+		nest_ticker = scheduler.Scheduler('skip', sleep=monitor.sleep)
+		nest_ticker.add('nest', opts.nest_min_interval)
+		monitor.add_producer("nest", nest_ticker, poller.poll, poller.finish)
+
+	# the writer seals a batch for the collector at every flush, the
+	# sender posts them from a thread of its own
+	outbox = None
+	outbox_sender = None
+	if opts.collector_url:
+		outbox = sender.Outbox(opts.outbox_dir or opts.db_name + ".outbox")
+		outbox_sender = sender.Sender(outbox, opts.db_name, opts.node, opts.collector_url)
+		outbox_sender.start()
+
+	spool_name = opts.spool_name or opts.db_name + ".spool"
+	monitor.set_writer(lambda: LogWriter(opts.db_name, opts.flush_samples, opts.flush_seconds, opts.checkpoint_seconds,
+										 spool_name, outbox))
+
+	# roll up anything logged before we kept rollups, a bit at a time
+	monitor.add_job("backfill", 10.0, lambda: rollup.backfill(opts.db_name, opts.backfill_chunk, max_chunks=1))
+
+	# move the old raw rows out, a small batch at a time
+	if opts.keep_days > 0:
+		monitor.add_job("retention", opts.retention_seconds,
+						lambda: retention.run(opts.db_name, opts.archive_dir, opts.keep_days))
+
+	metrics.add_collector(get_collector(sensor_mgr, monitor))
+	metrics_server = None
+	if opts.metrics_port:
+		metrics_server = metrics.serve(opts.metrics_address, opts.metrics_port)
+	if opts.metrics_textfile:
+		monitor.add_job("metrics", opts.metrics_seconds, lambda: metrics.write_textfile(opts.metrics_textfile))
+
+	monitor.run()
+
+	if outbox_sender is not None:
+		outbox_sender.close(5.0)	# the last batch, if the collector's there
+	if live_writer is not None:
+		live_writer.close()
+	if metrics_server is not None:
+		metrics_server.shutdown()
+	if opts.metrics_textfile:
+		metrics.write_textfile(opts.metrics_textfile)
+
+	if monitor.writer is not None:
+		cycles, commits, rows = monitor.writer.get_stats()
+		print "{0} rows written in {1} transactions over {2} cycles".format(rows, commits, cycles)
+		busy, checkpoints, wal_pages = monitor.writer.get_wal_stats()
+		print "{0} WAL checkpoints, {1} flushes put off by a locked database".format(checkpoints, busy)
+		failures, spooled, replayed, duplicates = monitor.writer.get_spool_stats()
+		if failures + spooled != 0:
+			print "{0} failed writes, {1} rows spooled, {2} replayed ({3} were already in)".format(
+				failures, spooled, replayed, duplicates)
+	if outbox_sender is not None:
+		requests, batches, rows, failures, waiting = outbox_sender.get_stats()
+		print "collector: {0} rows sent in {1} batches, {2} requests, {3} failed, {4} batches waiting".format(
+			rows, batches, requests, failures, waiting)
+	if poller is not None:
+		polls, fetches, changes, failures = poller.get_stats()
+		print "nest: {0} polls, {1} fetched, {2} saw a change, {3} failed".format(polls, fetches, changes, failures)
+	stats = ticker.get_stats()
+	print "{0} ticks, jitter {1:.1f}ms mean {2:.1f}ms max, {3} ticks missed in {4} overruns, writer held us up {5} times".format(
+		stats['cycles'], stats['mean_jitter'] * 1000, stats['max_jitter'] * 1000, stats['missed_ticks'], stats['overruns'],
+		monitor.backpressure)
+	for sensor in sensor_mgr.get_sensor_list():
+		compressor = sensor.get_compressor()
+		if compressor.points != 0:
+			print "[{0}] {1} readings, {2} logged ({3:.1f}:1)".format(sensor._sensor_id, compressor.samples, compressor.points,
+																   float(compressor.samples) / compressor.points)
 
 
 if __name__ == "__main__":
 	main()
-
@@ -17,9 +17,16 @@
 #    Chris Burris's Siri Nest Proxy was very helpful to learn the nest's
 #       authentication and some bits of the protocol.
 
-import urllib
-import urllib2
+import calendar
+import errno
+import httplib
+import os
+import socket
 import sys
+import tempfile
+import time
+import urllib
+import urlparse
 from optparse import OptionParser
 
 try:
@@ -32,13 +39,123 @@ except ImportError:
        print "or simpejson."
        sys.exit(-1)
 
+USER_AGENT = "Nest/1.1.0.10 CFNetwork/548.0.4"
+LOGIN_URL = "https://home.nest.com/user/login"
+CACHE_FILE = os.path.expanduser("~/.nest_cache")
+TOKEN_SECONDS = 24*60*60      # how long a token lasts when the login doesn't say
+TOKEN_MARGIN = 5*60           # log in again this long before the token expires
+STATUS_TTL = 60               # seconds a get_status() payload is good for
+TIMEOUT = 30
+
+class NestError(Exception):
+    def __init__(self, status, reason, body=""):
+        Exception.__init__(self, "%d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+# Session
+# =======
+# keeps one keep-alive connection per host, so the login and every
+# transport request after it share a connection (and, for https, a
+# single TLS handshake) rather than opening one each like urllib2. A
+# connection the server has dropped while idle is reopened and the
+# request sent again, but only when the request can't have got there
+# (see is_stale()). Anything else is only tried again for a GET, a put
+# that timed out may well have been done and mustn't be done twice.
+
+class Session:
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.connections = {}
+
+    def connect(self, scheme, netloc):
+        if (scheme == "https"):
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def request(self, method, url, body=None, headers={}):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        for attempt in range(2):
+            conn = self.connections.get(key)
+            reused = conn is not None
+            if not reused:
+                conn = self.connections[key] = self.connect(parts.scheme, parts.netloc)
+
+            stale = True    # until we've seen the start of an answer
+            try:
+                conn.request(method, path, body, headers)
+                try:
+                    res = conn.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    stale = is_stale(e)
+                    raise
+                stale = False
+                data = res.read()    # all of it, or the connection can't be reused
+            except (httplib.HTTPException, socket.error):
+                self.drop(key)
+                if reused and attempt == 0 and (stale or method == "GET"):
+                    continue
+                raise
+
+            if res.will_close:
+                self.drop(key)
+            return res.status, res.reason, data
+
+    def drop(self, key):
+        conn = self.connections.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        for key in self.connections.keys():
+            self.drop(key)
+
+# is_stale()
+# ==========
+# the server had closed a kept-alive connection before it read the
+# request: the connection ended without a byte of the answer, or was
+# reset. A timeout waiting for the answer isn't, the server may be
+# slow doing what we asked.
+def is_stale(error):
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ("", "''") or error.line.startswith("No status line")
+    if isinstance(error, socket.error):
+        return error.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+# the login's "expires_in", eg "Mon, 03-Feb-2014 19:27:43 GMT", as epoch seconds
+def parse_expiry(value, now):
+    try:
+        return calendar.timegm(time.strptime(str(value), "%a, %d-%b-%Y %H:%M:%S GMT"))
+    except ValueError:
+        return now + TOKEN_SECONDS
+
 class Nest:
-    def __init__(self, username, password, serial=None, index=0, units="F"):
+    # "login_url" points us at another server (see nestsim.py), the
+    # transport url comes back from the login. With a "cache_file" the
+    # login is kept until it expires and the get_status() payload for
+    # "status_ttl" seconds, so a command line run doesn't start from
+    # scratch every time.
+    def __init__(self, username, password, serial=None, index=0, units="F",
+                 login_url=LOGIN_URL, cache_file=None, status_ttl=STATUS_TTL, session=None):
         self.username = username
         self.password = password
         self.serial = serial
         self.units = units
         self.index = index
+        self.login_url = login_url
+        self.cache_file = cache_file
+        self.status_ttl = status_ttl
+        self.session = session or Session()
+        self.expires = 0
+        self.status = None
+        self.status_time = 0
 
     def loads(self, res):
         if hasattr(json, "loads"):
@@ -47,31 +164,116 @@ class Nest:
             res = json.read(res)
         return res
 
-    def login(self):
-        data = urllib.urlencode({"username": self.username, "password": self.password})
+    def load_cache(self):
+        if (self.cache_file is None) or (not os.path.exists(self.cache_file)):
+            return {}
+        try:
+            f = open(self.cache_file)
+            try:
+                cache = self.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}    # unreadable, we'll just log in again
+        if (cache.get("username") != self.username) or (cache.get("login_url") != self.login_url):
+            return {}    # someone else's login
+        return cache
+
+    # written to the side and renamed into place, readable only by us
+    # as it holds the access token (mkstemp makes it 0600)
+    def save_cache(self):
+        if (self.cache_file is None):
+            return
+        cache = {"username": self.username,
+                 "login_url": self.login_url,
+                 "transport_url": self.transport_url,
+                 "access_token": self.access_token,
+                 "userid": self.userid,
+                 "expires": self.expires}
+        if (self.status is not None):
+            cache["status"] = self.status
+            cache["status_time"] = self.status_time
+
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_file)))
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(json.dumps(cache))
+        finally:
+            f.close()
+        os.rename(partial, self.cache_file)
+
+    # login()
+    # =======
+    # uses the cached token while it's good, unless "force"d to log in
+    def login(self, force=False):
+        now = time.time()
+        if (not force):
+            if (self.expires - TOKEN_MARGIN > now):
+                return
+            cache = self.load_cache()
+            if (cache.get("expires", 0) - TOKEN_MARGIN > now):
+                self.transport_url = str(cache["transport_url"])
+                self.access_token = str(cache["access_token"])
+                self.userid = str(cache["userid"])
+                self.expires = cache["expires"]
+                if ("status" in cache):
+                    self.status = cache["status"]
+                    self.status_time = cache["status_time"]
+                return
 
-        req = urllib2.Request("https://home.nest.com/user/login",
-                              data,
-                              {"user-agent":"Nest/1.1.0.10 CFNetwork/548.0.4"})
+        data = urllib.urlencode({"username": self.username, "password": self.password})
 
-        res = urllib2.urlopen(req).read()
+        status, reason, res = self.session.request("POST", self.login_url, data,
+                                                   {"user-agent": USER_AGENT,
+                                                    "Content-Type": "application/x-www-form-urlencoded"})
+        if (status != 200):
+            raise NestError(status, reason, res)
 
         res = self.loads(res)
 
-        self.transport_url = res["urls"]["transport_url"]
-        self.access_token = res["access_token"]
-        self.userid = res["userid"]
-
-    def get_status(self):
-        req = urllib2.Request(self.transport_url + "/v2/mobile/user." + self.userid,
-                              headers={"user-agent":"Nest/1.1.0.10 CFNetwork/548.0.4",
-                                       "Authorization":"Basic " + self.access_token,
-                                       "X-nl-user-id": self.userid,
-                                       "X-nl-protocol-version": "1"})
-
-        res = urllib2.urlopen(req).read()
-
-        res = self.loads(res)
+        self.transport_url = str(res["urls"]["transport_url"])
+        self.access_token = str(res["access_token"])
+        self.userid = str(res["userid"])
+        self.expires = parse_expiry(res.get("expires_in"), now)
+        self.status = None    # it was for the old login
+        self.save_cache()
+
+    # transport()
+    # ===========
+    # a request to the transport server, logging in again once if the
+    # server has gone off our token
+    def transport(self, path, data=None, headers={}):
+        for attempt in range(2):
+            all_headers = {"user-agent": USER_AGENT,
+                           "Authorization": "Basic " + self.access_token,
+                           "X-nl-protocol-version": "1"}
+            all_headers.update(headers)
+            method = "GET"
+            if (data is not None):
+                method = "POST"
+            status, reason, res = self.session.request(method, self.transport_url + path, data, all_headers)
+            if (status == 401) and (attempt == 0):
+                self.login(force=True)
+                continue
+            if (status < 200) or (status >= 300):
+                raise NestError(status, reason, res)
+            return res
+
+    # get_status()
+    # ============
+    # the cached payload if it's younger than "max_age" seconds (the
+    # status_ttl by default), otherwise a fresh one
+    def get_status(self, max_age=None):
+        if (max_age is None):
+            max_age = self.status_ttl
+
+        if (self.status is not None) and (time.time() - self.status_time < max_age):
+            res = self.status
+        else:
+            res = self.loads(self.transport("/v2/mobile/user." + self.userid, headers={"X-nl-user-id": self.userid}))
+            self.status_time = time.time()
+            self.status = res
+            self.save_cache()
 
         self.structure_id = res["structure"].keys()[0]
 
@@ -79,8 +281,6 @@ class Nest:
             self.device_id = res["structure"][self.structure_id]["devices"][self.index]
             self.serial = self.device_id.split(".")[1]
 
-        self.status = res
-
         #print "res.keys", res.keys()
         #print "res[structure][structure_id].keys", res["structure"][self.structure_id].keys()
         #print "res[device].keys", res["device"].keys()
@@ -103,7 +303,7 @@ class Nest:
         shared = self.status["shared"][self.serial]
         device = self.status["device"][self.serial]
 
-        allvars = shared
+        allvars = dict(shared)
         allvars.update(device)
 
         for k in sorted(allvars.keys()):
@@ -115,31 +315,30 @@ class Nest:
 
         print "%0.1f" % temp
 
-    def set_temperature(self, temp):
+    # put_temperature() and put_fan() send the change and return the
+    # server's answer, the set_ versions print it. To send changes
+    # without waiting on them see nestcommands.py.
+    def put_temperature(self, temp):
         temp = self.temp_in(temp)
 
         data = '{"target_change_pending":true,"target_temperature":' + '%0.1f' % temp + '}'
-        req = urllib2.Request(self.transport_url + "/v2/put/shared." + self.serial,
-                              data,
-                              {"user-agent":"Nest/1.1.0.10 CFNetwork/548.0.4",
-                               "Authorization":"Basic " + self.access_token,
-                               "X-nl-protocol-version": "1"})
-
-        res = urllib2.urlopen(req).read()
-
-        print res
+        res = self.transport("/v2/put/shared." + self.serial, data)
+        self.status = None    # it's changed
+        self.save_cache()
+        return res
 
-    def set_fan(self, state):
+    def put_fan(self, state):
         data = '{"fan_mode":"' + str(state) + '"}'
-        req = urllib2.Request(self.transport_url + "/v2/put/device." + self.serial,
-                              data,
-                              {"user-agent":"Nest/1.1.0.10 CFNetwork/548.0.4",
-                               "Authorization":"Basic " + self.access_token,
-                               "X-nl-protocol-version": "1"})
+        res = self.transport("/v2/put/device." + self.serial, data)
+        self.status = None
+        self.save_cache()
+        return res
 
-        res = urllib2.urlopen(req).read()
+    def set_temperature(self, temp):
+        print self.put_temperature(temp)
 
-        print res
+    def set_fan(self, state):
+        print self.put_fan(state)
 
 def create_parser():
    parser = OptionParser(usage="nest [options] command [command_options] [command_args]",
@@ -161,6 +360,18 @@ def create_parser():
    parser.add_option("-i", "--index", dest="index", default=0, type="int",
                      help="optional, specify index number of nest to talk to")
 
+   parser.add_option("--login-url", dest="login_url", default=LOGIN_URL,
+                     help="optional, where to log in (a test server, say)", metavar="URL")
+
+   parser.add_option("--cache", dest="cache_file", default=CACHE_FILE,
+                     help="optional, file to keep the login and status in", metavar="FILE")
+
+   parser.add_option("--no-cache", dest="cache_file", action="store_const", const=None,
+                     help="optional, log in and fetch the status every time")
+
+   parser.add_option("--status-ttl", dest="status_ttl", default=STATUS_TTL, type="float",
+                     help="optional, seconds the cached status is good for")
+
 
    return parser
 
@@ -173,6 +384,10 @@ def help():
     print "   --serial <number>      ... optional, specify serial number of nest to use"
     print "   --index <number>       ... optional, 0-based index of nest"
     print "                                (use --serial or --index, but not both)"
+    print "   --login-url <url>      ... optional, log in somewhere other than nest.com"
+    print "   --cache <file>         ... optional, where the login and status are kept"
+    print "                                (default ~/.nest_cache, --no-cache for none)"
+    print "   --status-ttl <seconds> ... optional, how long the cached status is used"
     print
     print "commands: temp, fan, show, curtemp, curhumid"
     print "    temp <temperature>    ... set target temperature"
@@ -202,7 +417,8 @@ def main():
     else:
         units = "F"
 
-    n = Nest(opts.user, opts.password, opts.serial, opts.index, units=units)
+    n = Nest(opts.user, opts.password, opts.serial, opts.index, units=units,
+             login_url=opts.login_url, cache_file=opts.cache_file, status_ttl=opts.status_ttl)
     n.login()
     n.get_status()
 
@@ -0,0 +1,313 @@
+import collections
+import httplib
+import socket
+import threading
+import time
+
+import nest
+import scheduler
+
+# nestcommands.py
+# ===============
+# sends setpoint and fan changes to the Nest without flooding it. An
+# automation can call set_temperature() as often as it likes:
+#
+#   commands = CommandQueue(nest.Nest(user, password, units="C", cache_file=nest.CACHE_FILE))
+#   handle = commands.set_temperature(21.5)
+#   ...
+#   if handle.wait(120): ...    # or look at handle.done()/handle.state later
+#
+# - a change that's still waiting to go out is replaced by a newer one
+#   of the same kind (its handle ends up 'superseded'), so only the
+#   latest setpoint and the latest fan mode are ever sent
+# - every call to Nest (puts and the status fetches that confirm them)
+#   takes a token from a bucket that refills at "rate" per second and
+#   holds at most "burst"
+# - a put that fails (network, 5xx, throttled) is tried again after
+#   "backoff" seconds, doubling each time up to "max_backoff", at most
+#   "retries" times. Other 4xx answers fail the command straight away.
+# - a change counts once the status shows it: the target temperature
+#   (with no change pending) or the fan mode. The status comes through
+#   Nest.get_status()'s cache, fetched at most every "confirm_interval"
+#   seconds. A change that hasn't shown up after "confirm_seconds" is
+#   sent again (a retry).
+#
+# The commands are sent from a thread of the queue's own, with the
+# Nest object to itself (its connection isn't shared with the poller).
+
+RATE = 1.0 / 10  # calls per second, on average
+BURST = 5
+RETRIES = 5
+BACKOFF = 5.0  # seconds before the first retry
+MAX_BACKOFF = 300.0
+CONFIRM_INTERVAL = 10.0
+CONFIRM_SECONDS = 120.0
+
+# the errors worth trying again, other 4xx are our fault
+RETRY_STATUS = (401, 408, 429)
+
+
+# TokenBucket
+# ===========
+# "rate" tokens a second, up to "burst" of them saved up
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=scheduler.monotonic):
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._time_last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._time_last) * self._rate)
+        self._time_last = now
+
+    # seconds until a token is available, 0 when there's one now
+    def get_wait(self):
+        self._refill()
+        if self._tokens >= 1.0:
+            return 0.0
+        return (1.0 - self._tokens) / self._rate
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1.0
+
+
+# CommandHandle
+# =============
+# what a caller gets back for a change. "state" is one of
+#   queued, sent                             - still going
+#   confirmed, failed, superseded, cancelled - done
+
+class CommandHandle(object):
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+        self.state = 'queued'
+        self.error = None
+        self.attempts = 0
+        self._event = threading.Event()
+
+    def done(self):
+        return self._event.is_set()
+
+    # wait()
+    # ======
+    # waits up to "timeout" seconds (for ever if None) for the change
+    # to be done, True if it was confirmed
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.state == 'confirmed'
+
+    def _finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self._event.set()
+
+
+class Command(object):
+    def __init__(self, kind, value, handle):
+        self.kind = kind
+        self.value = value
+        self.handle = handle
+        self.sent = False
+        self.not_before = 0.0  # monotonic time it can next be worked on
+        self.confirm_by = None
+
+
+class CommandQueue(object):
+    def __init__(self, thermostat, rate=RATE, burst=BURST, retries=RETRIES, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, confirm_interval=CONFIRM_INTERVAL, confirm_seconds=CONFIRM_SECONDS,
+                 clock=scheduler.monotonic):
+        self._nest = thermostat
+        self._bucket = TokenBucket(rate, burst, clock)
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._confirm_interval = confirm_interval
+        self._confirm_seconds = confirm_seconds
+        self._clock = clock
+
+        self._lock = threading.Condition()
+        self._pending = collections.OrderedDict()  # kind -> Command, oldest first
+        self._running = True
+
+        self.calls = 0  # to Nest
+        self.coalesced = 0
+
+        self._thread = threading.Thread(target=self._run, name="nest-commands")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # set_temperature() and set_fan() queue the change and return its
+    # CommandHandle straight away. The temperature is in the Nest's units.
+    def set_temperature(self, temp):
+        return self.submit('temperature', float(temp))
+
+    def set_fan(self, state):
+        return self.submit('fan', str(state))
+
+    def submit(self, kind, value):
+        handle = CommandHandle(kind, value)
+        with self._lock:
+            if not self._running:
+                handle._finish('cancelled')
+                return handle
+            older = self._pending.pop(kind, None)
+            if older is not None:
+                older.handle._finish('superseded')
+                self.coalesced += 1
+            self._pending[kind] = Command(kind, value, handle)
+            self._lock.notify()
+        return handle
+
+    def get_pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # close()
+    # =======
+    # stops the queue, giving the changes still pending up to "timeout"
+    # seconds to go out (and be confirmed) first. Whatever's left is
+    # cancelled.
+    def close(self, timeout=0.0):
+        deadline = self._clock() + timeout
+        with self._lock:
+            while len(self._pending) != 0 and self._clock() < deadline:
+                self._lock.wait(min(1.0, deadline - self._clock()))
+            self._running = False
+            for command in self._pending.values():
+                command.handle._finish('cancelled')
+            self._pending.clear()
+            self._lock.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                command = self._next_command()
+                if command is None:
+                    return
+
+            self._work(command)
+
+            with self._lock:
+                self._lock.notify_all()  # for close()
+
+    # the next command that's ready with a token for it, waiting as
+    # needed. Called with the lock held, None when we're stopping.
+    def _next_command(self):
+        while self._running:
+            if len(self._pending) == 0:
+                self._lock.wait()
+                continue
+
+            now = self._clock()
+            command = min(self._pending.values(), key=lambda command: command.not_before)
+            wait = max(command.not_before - now, 0.0)
+            if wait == 0.0 and self._needs_call(command):
+                wait = self._bucket.get_wait()
+            if wait > 0.0:
+                self._lock.wait(wait)  # a new command wakes us early
+                continue
+
+            if self._needs_call(command):
+                self._bucket.take()
+                self.calls += 1
+            return command
+        return None
+
+    # a put always goes to Nest, a confirmation only when the cached
+    # status is too old
+    def _needs_call(self, command):
+        if not command.sent:
+            return True
+        return self._nest.status is None or time.time() - self._nest.status_time >= self._confirm_interval
+
+    # _work()
+    # =======
+    # sends the command or checks it has taken, outside the lock. The
+    # command may be superseded while we're at it, so the outcome only
+    # counts if it's still the pending one.
+    def _work(self, command):
+        try:
+            self._nest.login()
+            if self._nest.serial is None:
+                self._nest.get_status()
+            if not command.sent:
+                command.handle.attempts += 1
+                if command.kind == 'temperature':
+                    self._nest.put_temperature(command.value)
+                else:
+                    self._nest.put_fan(command.value)
+                self._sent(command)
+                return
+
+            self._nest.get_status(max_age=self._confirm_interval)
+            confirmed = self.is_confirmed(command, self._nest.status)
+        except nest.NestError as e:
+            if (e.status < 500) and (e.status not in RETRY_STATUS):
+                self._finish(command, 'failed', e)
+            else:
+                self._retry(command, e)
+            return
+        except (httplib.HTTPException, socket.error, EnvironmentError, ValueError, KeyError) as e:
+            self._retry(command, e)
+            return
+
+        with self._lock:
+            if self._pending.get(command.kind) is not command:
+                return
+            if confirmed:
+                self._finish(command, 'confirmed')
+            elif self._clock() >= command.confirm_by:
+                command.sent = False  # never showed up, send it again
+                if command.handle.attempts > self._retries:
+                    self._finish(command, 'failed', "not confirmed")
+            else:
+                command.not_before = self._clock() + self._confirm_interval
+
+    def _sent(self, command):
+        with self._lock:
+            if self._pending.get(command.kind) is not command:
+                return
+            command.sent = True
+            command.handle.state = 'sent'
+            command.confirm_by = self._clock() + self._confirm_seconds
+            command.not_before = self._clock()  # the put emptied the status cache, confirm when there's a token
+
+    def _retry(self, command, error):
+        with self._lock:
+            if self._pending.get(command.kind) is not command:
+                return
+            if command.sent and self._clock() >= command.confirm_by:
+                command.sent = False  # couldn't confirm it in time, send it again
+            if command.handle.attempts > self._retries:
+                self._finish(command, 'failed', error)
+                return
+            backoff = min(self._backoff * 2 ** max(command.handle.attempts - 1, 0), self._max_backoff)
+            command.not_before = self._clock() + backoff
+            command.handle.error = error
+
+    # a superseded command's handle already says so, whatever became
+    # of its last call
+    def _finish(self, command, state, error=None):
+        with self._lock:
+            if self._pending.get(command.kind) is not command:
+                return
+            del self._pending[command.kind]
+            command.handle._finish(state, error)
+
+    # is_confirmed()
+    # ==============
+    # the change shows in the thermostat's status
+    def is_confirmed(self, command, status):
+        serial = self._nest.serial
+        if command.kind == 'temperature':
+            shared = status["shared"][serial]
+            target = round(self._nest.temp_in(command.value), 1)
+            return abs(shared["target_temperature"] - target) < 0.05 and not shared.get("target_change_pending")
+        return status["device"][serial]["fan_mode"] == command.value
@@ -0,0 +1,172 @@
+import httplib
+import socket
+import time
+
+import nest
+import scheduler
+import storage
+
+# nestpoller.py
+# =============
+# logs the Nest thermostat's readings next to the probes. Each value
+# is a virtual sensor (tempsensor.SensorsMgr.add_virtual_sensor()),
+# registered in the Sensor table as
+#
+#   nest-<serial>-temperature  current_temperature (C)
+#   nest-<serial>-humidity     current_humidity (%)
+#   nest-<serial>-target       target_temperature (C)
+#
+# and goes through its own compressor like a probe's readings, so the
+# rows are the same shape and the monitor's writer puts them in the
+# same transactions as the probe rows (the poller is a runtime
+# producer, see monitor.main()).
+#
+# Every HTTP call to Nest counts, so the interval adapts: after a poll
+# where nothing we log has changed the interval doubles, up to
+# "max_interval", and as soon as something does change (or the
+# thermostat is heating, cooling or has a setpoint change pending) it
+# drops back to "min_interval". A failed poll backs off the same way.
+# The status goes through Nest.get_status()'s cache, so a status
+# fetched for some other reason (a set_temperature() confirming, say)
+# in the last half a min_interval saves a call.
+
+MIN_INTERVAL = 60.0  # seconds
+MAX_INTERVAL = 600.0
+LOGGING_THRESHOLD = 10 * 60  # log the values at least this often, as the Sampler does
+
+# (suffix, bucket, field) for each value we log
+VALUES = [
+    ('temperature', 'shared', 'current_temperature'),
+    ('humidity', 'device', 'current_humidity'),
+    ('target', 'shared', 'target_temperature'),
+]
+
+# keep polling quickly while any of these is on
+ACTIVE_FIELDS = [('shared', 'target_change_pending'), ('shared', 'hvac_heater_state'),
+                 ('shared', 'hvac_ac_state'), ('shared', 'hvac_fan_state')]
+
+
+def get_serial_id(serial, suffix):
+    return "nest-{0}-{1}".format(serial, suffix)
+
+
+class NestPoller(object):
+    def __init__(self, thermostat, sensor_mgr, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 live_writer=None, clock=scheduler.monotonic):
+        self._nest = thermostat  # a nest.Nest, in C
+        self._sensor_mgr = sensor_mgr
+        self._min_interval = min_interval
+        self._max_interval = max(min_interval, max_interval)
+        self._live_writer = live_writer
+        self._clock = clock
+
+        self._sensors = {}  # suffix -> virtual Sensor
+        self._last_values = None
+        self._interval = min_interval
+        self._next_poll = clock()
+        self._time_last_logging = clock()
+
+        self.polls = 0
+        self.fetches = 0  # polls that went to Nest rather than the cache
+        self.changes = 0
+        self.failures = 0
+
+    def get_interval(self):
+        return self._interval
+
+    # poll()
+    # ======
+    # the producer, called every tick (min_interval). Fetches the status
+    # when it's due and returns the rows to log.
+    def poll(self, due=None):
+        now = self._clock()
+        if now < self._next_poll:
+            return []
+
+        self.polls += 1
+        status_time = self._nest.status_time
+        try:
+            self._nest.login()
+            self._nest.get_status(max_age=self._min_interval / 2)
+            values = self.read_values(self._nest.status)
+        except (nest.NestError, httplib.HTTPException, socket.error, EnvironmentError, ValueError, KeyError) as e:
+            self.failures += 1
+            print "nest poll failed ({0})".format(e)
+            self.set_interval(self._interval * 2)
+            return []
+        if self._nest.status_time != status_time:
+            self.fetches += 1
+
+        if values != self._last_values or self.is_active(self._nest.status):
+            if values != self._last_values:
+                self.changes += 1
+            self.set_interval(self._min_interval)
+        else:
+            self.set_interval(self._interval * 2)
+        self._last_values = values
+
+        return self.record(values, time.time())
+
+    def set_interval(self, interval):
+        self._interval = min(max(interval, self._min_interval), self._max_interval)
+        self._next_poll = self._clock() + self._interval
+
+    def read_values(self, status):
+        serial = self._nest.serial
+        values = {}
+        for suffix, bucket, field in VALUES:
+            value = status[bucket][serial].get(field)
+            if value is not None:
+                values[suffix] = float(value)
+        return values
+
+    def is_active(self, status):
+        serial = self._nest.serial
+        for bucket, field in ACTIVE_FIELDS:
+            if status[bucket][serial].get(field):
+                return True
+        return False
+
+    def get_sensor(self, suffix):
+        sensor = self._sensors.get(suffix)
+        if sensor is None:
+            sensor = self._sensor_mgr.add_virtual_sensor(get_serial_id(self._nest.serial, suffix))
+            if sensor is None:
+                return None
+            self._sensors[suffix] = sensor
+        return sensor
+
+    # record()
+    # ========
+    # hands the values to the virtual sensors' compressors and returns
+    # the (timestamp, value, sensor) rows they want logged
+    def record(self, values, timestamp):
+        force_logging = self._clock() - self._time_last_logging > LOGGING_THRESHOLD
+        rows = []
+        for suffix, bucket, field in VALUES:
+            if suffix not in values:
+                continue
+            sensor = self.get_sensor(suffix)
+            if sensor is None:
+                continue
+            sensor.set_temperature(values[suffix], timestamp)
+            if self._live_writer is not None:
+                self._live_writer.publish(sensor._sensor_id, timestamp, values[suffix])
+            for point_time, value in sensor.take_points(force_logging):
+                rows.append((storage.to_timestamp(point_time), value, sensor._sensor_id))
+
+        if len(rows) != 0:
+            self._time_last_logging = self._clock()
+        return rows
+
+    # log where each value's signal ends before we go
+    def finish(self):
+        rows = []
+        for sensor in self._sensors.values():
+            for point_time, value in sensor.take_points(True):
+                rows.append((storage.to_timestamp(point_time), value, sensor._sensor_id))
+        return rows
+
+    # returns (polls, fetches from Nest, polls that saw a change, failed polls)
+    def get_stats(self):
+        return self.polls, self.fetches, self.changes, self.failures
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import json
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import uuid
+from optparse import OptionParser
+
+# nestsim.py
+# ==========
+# a stand-in for the Nest servers, so nest.py can be run (and timed)
+# against something on the Pi rather than home.nest.com. It answers
+# the same requests nest.py makes:
+#
+#   POST /user/login               form username/password, returns the
+#                                  access token, user id, expiry and a
+#                                  transport url pointing back here
+#   GET  /v2/mobile/user.<userid>  the status payload
+#   POST /v2/put/shared.<serial>   target_temperature and the like
+#   POST /v2/put/device.<serial>   fan_mode and the like
+#
+# with one thermostat. Connections are kept alive (HTTP/1.1) and the
+# server counts logins, connections and requests so a test can tell
+# whether the client reused them. Tokens expire after
+# "token_seconds", a transport request with an unknown or expired
+# token gets a 401 as from the real thing.
+
+DEFAULT_PORT = 8800
+USERID = "1234567"
+SERIAL = "01AA02AB03CD04EF"
+STRUCTURE = "a1b2c3d4-0000-1111-2222-333344445555"
+TOKEN_SECONDS = 24 * 60 * 60
+
+
+class NestState(object):
+    def __init__(self, username, password, token_seconds=TOKEN_SECONDS):
+        self.username = username
+        self.password = password
+        self.token_seconds = token_seconds
+        self.tokens = {}  # access token -> expiry (epoch seconds)
+        self.lock = threading.Lock()
+
+        self.fail_puts = 0  # answer this many puts with a 503, to test retries
+        self.pending_seconds = 0.0  # how long a new setpoint stays target_change_pending
+
+        self.logins = 0
+        self.connections = 0
+        self.requests = 0
+        self.puts = 0
+
+        self.shared = {"current_temperature": 20.5, "target_temperature": 21.0,
+                       "target_change_pending": False, "hvac_heater_state": False,
+                       "hvac_ac_state": False, "hvac_fan_state": False}
+        self.device = {"current_humidity": 45, "fan_mode": "auto", "temperature_scale": "C",
+                       "serial_number": SERIAL}
+        self.time_pending = 0  # when the pending setpoint is taken up
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def login(self, username, password):
+        with self.lock:
+            self.logins += 1
+            if username != self.username or password != self.password:
+                return None
+            token = uuid.uuid4().hex
+            expires = time.time() + self.token_seconds
+            self.tokens[token] = expires
+            return token, expires
+
+    def check_token(self, authorization):
+        if authorization is None or not authorization.startswith("Basic "):
+            return False
+        with self.lock:
+            expires = self.tokens.get(authorization[len("Basic "):])
+        return expires is not None and expires > time.time()
+
+    def expire_tokens(self):
+        with self.lock:
+            self.tokens = {}
+
+    def set_current(self, temperature=None, humidity=None):
+        with self.lock:
+            if temperature is not None:
+                self.shared["current_temperature"] = temperature
+            if humidity is not None:
+                self.device["current_humidity"] = humidity
+
+    def get_payload(self):
+        with self.lock:
+            if self.shared["target_change_pending"] and time.time() >= self.time_pending:
+                self.shared["target_change_pending"] = False
+            return {"structure": {STRUCTURE: {"devices": ["device." + SERIAL], "name": "Home"}},
+                    "shared": {SERIAL: dict(self.shared)},
+                    "device": {SERIAL: dict(self.device)},
+                    "user": {USERID: {"name": self.username}}}
+
+    # put()
+    # =====
+    # applies the values, False if we're failing puts
+    def put(self, bucket, values):
+        with self.lock:
+            self.puts += 1
+            if self.fail_puts > 0:
+                self.fail_puts -= 1
+                return False
+            target = self.shared if bucket == "shared" else self.device
+            target.update(values)
+            if values.get("target_change_pending"):
+                self.time_pending = time.time() + self.pending_seconds
+            return True
+
+
+class NestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        self.server.state.count_request()
+        body = self.read_body()
+        path = self.path.split("?")[0]
+
+        if path == "/user/login":
+            form = urlparse.parse_qs(body)
+            login = self.server.state.login(form.get("username", [None])[0], form.get("password", [None])[0])
+            if login is None:
+                self.send_body(400, json.dumps({"error": "access_denied"}))
+                return
+            token, expires = login
+            self.send_body(200, json.dumps({
+                "urls": {"transport_url": "http://{0}:{1}".format(*self.server.server_address)},
+                "access_token": token,
+                "userid": USERID,
+                "expires_in": time.strftime("%a, %d-%b-%Y %H:%M:%S GMT", time.gmtime(expires))}))
+            return
+
+        for bucket in ("shared", "device"):
+            if path == "/v2/put/{0}.{1}".format(bucket, SERIAL):
+                if not self.server.state.check_token(self.headers.get("Authorization")):
+                    self.send_body(401, "", "text/plain")
+                    return
+                try:
+                    values = json.loads(body)
+                except ValueError:
+                    self.send_body(400, "", "text/plain")
+                    return
+                if not self.server.state.put(bucket, values):
+                    self.send_body(503, "", "text/plain")
+                    return
+                self.send_body(200, "", "text/plain")
+                return
+
+        self.send_body(404, "", "text/plain")
+
+    def do_GET(self):
+        self.server.state.count_request()
+        if self.path.split("?")[0] != "/v2/mobile/user." + USERID:
+            self.send_body(404, "", "text/plain")
+            return
+        if not self.server.state.check_token(self.headers.get("Authorization")):
+            self.send_body(401, "", "text/plain")
+            return
+        self.send_body(200, json.dumps(self.server.state.get_payload()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# serve()
+# =======
+# runs the stand-in on its own thread, returns the server (its "state"
+# is the NestState). Port 0 picks a free one, see server_address.
+def serve(address="127.0.0.1", port=DEFAULT_PORT, username="user", password="password",
+          token_seconds=TOKEN_SECONDS):
+    state = NestState(username, password, token_seconds)
+    server = NestServer((address, port), NestHandler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, name="nestsim")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_login_url(server):
+    return "http://{0}:{1}/user/login".format(*server.server_address)
+
+
+def create_parser():
+    parser = OptionParser(usage="nestsim.py [options]",
+                          description="Runs a stand-in for the Nest login and transport servers, point nest.py at it with --login-url")
+
+    parser.add_option("-a", "--address", dest="address", default="127.0.0.1",
+                      help="address to listen on")
+
+    parser.add_option("-p", "--port", dest="port", default=DEFAULT_PORT, type="int",
+                      help="port to listen on")
+
+    parser.add_option("-u", "--user", dest="user", default="user",
+                      help="the username it accepts")
+
+    parser.add_option("--password", dest="password", default="password",
+                      help="the password it accepts")
+
+    parser.add_option("--token-seconds", dest="token_seconds", default=TOKEN_SECONDS, type="int",
+                      help="how long a login lasts")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    server = serve(opts.address, opts.port, opts.user, opts.password, opts.token_seconds)
+    print "login url {0}".format(get_login_url(server))
+    try:
+        while True:
+            time.sleep(60)
+            state = server.state
+            print "{0} logins, {1} connections, {2} requests".format(state.logins, state.connections, state.requests)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+
+import datetime
+import gzip
+import heapq
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import database
+import rollup
+import storage
+
+# retention.py
+# ============
+# keeps the raw readings in the database down to the last "keep_days".
+# Older rows are moved out a day at a time into compressed archive
+# segments, one per day,
+#
+#   <archive_dir>/temperature-2017-03-14.tsv.gz
+#
+# holding the day's rows as chart.get_data() returns them
+# (sensor, timestamp, temp, key) in time order, one tab separated row
+# per line, with the row's epoch seconds after them (the timestamp is
+# local time, the hour the clocks go back has two readings a second
+# with the same one, the epoch tells them apart). The rollups stay in the database so long windows still
+# chart as before, and read_archive() lets the chart's data layer
+# read the archived raw rows alongside the database.
+#
+# Moving a day: the day's rows are merged with any segment already
+# there (rows for the day can turn up late, from the spool say), the
+# segment is written to the side and renamed into place, and then the
+# rows are deleted "batch_rows" at a time, each batch its own short
+# transaction with a pause between, so the monitor's writer is never
+# held up for long. The freed pages are handed back to the file system
+# with incremental vacuum, a few at a time, when the database has
+# auto_vacuum = INCREMENTAL (new databases do, see enable_incremental()
+# for older ones).
+#
+# The rollups of rows logged before the rollup tables existed are
+# built by rollup.backfill(), a row archived before it got to it would
+# never be rolled up, so run() finishes the backfill first.
+
+dbname = '/home/pi/sensorlog.db'
+DEFAULT_ARCHIVE = '/home/pi/sensorlog-archive'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DAY_FORMAT = '%Y-%m-%d'
+BATCH_ROWS = 500  # rows deleted per transaction
+BATCH_PAUSE = 0.05  # seconds between the batches, room for the monitor
+VACUUM_PAGES = 256  # pages freed per incremental vacuum step
+
+
+def get_segment_name(archive_dir, day):
+    return os.path.join(archive_dir, "temperature-{0}.tsv.gz".format(day))
+
+
+# a segment row is (sensor, timestamp, temp, key, epoch)
+def format_row(row):
+    return "{0}\t{1}\t{2!r}\t{3}\t{4}\n".format(row[0], row[1], float(row[2]), row[3], row[4])
+
+
+def parse_row(line):
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) == 4:
+        fields.append(storage.to_epoch(fields[1]))  # a segment from before we kept the epoch
+    sensor, timestamp, temp, key, epoch = fields
+    return int(sensor), timestamp, float(temp), int(key), int(epoch)
+
+
+def read_segment(segment_name):
+    if not os.path.exists(segment_name):
+        return []
+    segment = gzip.open(segment_name, "rb")
+    try:
+        return [parse_row(line) for line in segment]
+    finally:
+        segment.close()
+
+
+def write_segment(segment_name, rows):
+    partial = segment_name + ".partial"
+    segment = gzip.open(partial, "wb")
+    try:
+        for row in rows:
+            segment.write(format_row(row))
+    finally:
+        segment.close()
+
+    # make sure it's on the card before we delete the rows it replaces
+    fd = os.open(partial, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(partial, segment_name)
+
+
+# merge_rows()
+# ============
+# merges (sensor, timestamp, temp, key[, epoch]) rows that are each
+# in time order, keeping the first row seen for each (sensor, epoch,
+# key), at most "limit" of them. A text row's key is its rowid, so two
+# of its rows in the hour the clocks go back are both kept, as are two
+# compact rows with their different epochs.
+def merge_rows(first, second, limit=None):
+    merged = heapq.merge(((row[1], row[3], row) for row in first),
+                         ((row[1], row[3], row) for row in second))
+    timestamp = None
+    seen = set()  # rows seen at "timestamp"
+    count = 0
+    for row_time, key, row in merged:
+        if row_time != timestamp:
+            timestamp = row_time
+            seen = set()
+        row_key = (row[0], row[4] if len(row) > 4 else None, row[3])
+        if row_key in seen:
+            continue
+        seen.add(row_key)
+
+        yield row
+        count += 1
+        if limit is not None and count >= limit:
+            return
+
+
+# read_archive()
+# ==============
+# the archived rows for the window, in the same form and order as
+# chart.get_data() and with the same start/end/after meaning
+def read_archive(archive_dir, start=None, end=None, after=None):
+    if not os.path.isdir(archive_dir):
+        return
+
+    if start is None:
+        days = sorted(name[len("temperature-"):-len(".tsv.gz")] for name in os.listdir(archive_dir)
+                      if name.startswith("temperature-") and name.endswith(".tsv.gz"))
+    else:
+        first = datetime.datetime.strptime(start[:10], DAY_FORMAT)
+        last = datetime.datetime.now()
+        if end is not None:
+            last = datetime.datetime.strptime(end[:10], DAY_FORMAT)
+        days = []
+        while first <= last:
+            days.append(first.strftime(DAY_FORMAT))
+            first += datetime.timedelta(days=1)
+
+    for day in days:
+        for row in read_segment(get_segment_name(archive_dir, day)):
+            if start is not None and row[1] < start:
+                continue
+            if end is not None and row[1] >= end:
+                return
+            if after is not None and (row[1], row[3]) <= (after[0], after[1]):
+                continue
+            yield row[:4]
+
+
+def get_oldest(conn):
+    oldest = None
+    for fmt in storage.get_formats(conn):
+        if fmt == 'text':
+            timestamp = conn.execute("SELECT MIN([timestamp]) FROM Temperature").fetchone()[0]
+        else:
+            epoch = conn.execute("SELECT MIN([time]) FROM TemperatureCompact").fetchone()[0]
+            timestamp = None if epoch is None else storage.to_timestamp(epoch)
+        if timestamp is not None and (oldest is None or timestamp < oldest):
+            oldest = timestamp
+    return oldest
+
+
+# the raw rows of one day from both tables as segment rows, in time
+# order
+def read_day(conn, day_start, day_end):
+    rows = []
+    for fmt in storage.get_formats(conn):
+        if fmt == 'text':
+            # the epoch as storage.to_epoch() would have it
+            rows.extend(conn.execute("SELECT sensor, [timestamp], temp, rowid, "
+                                     "CAST(strftime('%s', [timestamp], 'utc') AS INTEGER) FROM Temperature "
+                                     "WHERE [timestamp] >= ? AND [timestamp] < ?", (day_start, day_end)))
+        else:
+            for sensor, epoch, temp in conn.execute("SELECT sensor, [time], millic / 1000.0 FROM TemperatureCompact "
+                                                    "WHERE [time] >= ? AND [time] < ?",
+                                                    (storage.to_epoch(day_start), storage.to_epoch(day_end))):
+                rows.append((sensor, storage.to_timestamp(epoch), temp, -sensor, epoch))
+
+    rows.sort(key=lambda row: (row[1], row[3]))
+    return rows
+
+
+def delete_rows(conn, rows, batch_rows=BATCH_ROWS, pause=BATCH_PAUSE):
+    for i in range(0, len(rows), batch_rows):
+        batch = rows[i:i + batch_rows]
+        with conn:
+            conn.executemany("DELETE FROM Temperature WHERE rowid = ?",
+                             [(row[3],) for row in batch if row[3] > 0])
+            if storage.is_compact(conn):
+                conn.executemany("DELETE FROM TemperatureCompact WHERE sensor = ? AND [time] = ?",
+                                 [(row[0], row[4]) for row in batch if row[3] < 0])
+        if pause:
+            time.sleep(pause)
+    return
+
+
+# archive_day()
+# =============
+# moves one day's raw rows into its segment, returns the number moved
+def archive_day(conn, archive_dir, day, batch_rows=BATCH_ROWS, pause=BATCH_PAUSE):
+    day_start = day + " 00:00:00"
+    next_day = datetime.datetime.strptime(day, DAY_FORMAT) + datetime.timedelta(days=1)
+    day_end = next_day.strftime(TIME_FORMAT)
+
+    rows = read_day(conn, day_start, day_end)
+    segment_name = get_segment_name(archive_dir, day)
+    write_segment(segment_name, merge_rows(read_segment(segment_name), rows))
+    delete_rows(conn, rows, batch_rows, pause)
+    return len(rows)
+
+
+def vacuum(conn, pages=VACUUM_PAGES, pause=BATCH_PAUSE):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+
+    freed = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages == 0:
+            return freed
+        conn.execute("PRAGMA incremental_vacuum({0})".format(min(pages, free_pages))).fetchall()
+        freed += min(pages, free_pages)
+        if pause:
+            time.sleep(pause)
+
+
+# run()
+# =====
+# archives every day older than "keep_days" days ago, then vacuums.
+# Returns the number of rows archived. Raises RuntimeError if a day
+# won't go (its rows are still there after archiving it), rather than
+# archiving it over and over.
+def run(db_name, archive_dir=DEFAULT_ARCHIVE, keep_days=30, batch_rows=BATCH_ROWS, pause=BATCH_PAUSE, verbose=False):
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    # nothing to do once it's done, the first time it can take a while
+    rollup.backfill(db_name, verbose=verbose)
+
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=keep_days)).strftime(DAY_FORMAT) + " 00:00:00"
+    conn = database.connect(db_name)
+    archived = 0
+    try:
+        while True:
+            oldest = get_oldest(conn)
+            if oldest is None or oldest >= cutoff:
+                break
+            moved = archive_day(conn, archive_dir, oldest[:10], batch_rows, pause)
+            archived += moved
+            if verbose:
+                print "{0}: {1} rows archived".format(oldest[:10], moved)
+            left = get_oldest(conn)
+            if left is not None and left[:10] <= oldest[:10]:
+                raise RuntimeError("{0} still has rows after archiving it ({1})".format(oldest[:10], left))
+
+        freed = vacuum(conn, VACUUM_PAGES, pause)
+        if verbose and freed != 0:
+            print "{0} pages freed".format(freed)
+    finally:
+        conn.close()
+    return archived
+
+
+# enable_incremental()
+# ====================
+# switches an existing database to auto_vacuum = INCREMENTAL. This
+# needs a full VACUUM, which holds the database until it's done, so
+# it's only done when asked for (and best with the monitor stopped).
+def enable_incremental(db_name):
+    conn = database.connect(db_name)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def create_parser():
+    parser = OptionParser(usage="retention.py [options] run|enable-vacuum",
+                          description="Moves raw readings older than --keep-days into compressed daily archive files")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database to trim", metavar="FILE")
+
+    parser.add_option("-a", "--archive-dir", dest="archive_dir", default=DEFAULT_ARCHIVE,
+                      help="where the archive segments go", metavar="DIR")
+
+    parser.add_option("-k", "--keep-days", dest="keep_days", default=30, type="int",
+                      help="days of raw readings to keep in the database")
+
+    parser.add_option("--batch", dest="batch_rows", default=BATCH_ROWS, type="int",
+                      help="rows deleted per transaction")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('run', 'enable-vacuum') or opts.keep_days < 1:
+        parser.print_help()
+        sys.exit(-1)
+
+    if args[0] == 'enable-vacuum':
+        enable_incremental(opts.db_name)
+        return
+
+    archived = run(opts.db_name, opts.archive_dir, opts.keep_days, opts.batch_rows, BATCH_PAUSE, True)
+    print "{0} rows archived to {1}".format(archived, opts.archive_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+import sys
+from optparse import OptionParser
+
+import database
+
+# Rollups
+# =======
+# min/max/count/total per sensor at minute, hour and day granularity,
+# kept up to date as monitor.py writes the raw Temperature rows so the
+# chart can draw long windows from a few thousand rows. The average is
+# total/samples. [timestamp] is the start of the bucket, in the same
+# '%Y-%m-%d %H:%M:%S' text format as the raw rows, so a bucket is just
+# a prefix of the raw timestamp.
+
+dbname = '/home/pi/sensorlog.db'
+
+# (resolution, table, seconds per bucket, raw timestamp -> bucket)
+RESOLUTIONS = [
+    ('minute', 'TemperatureMinute', 60, lambda ts: ts[:16] + ':00'),
+    ('hour', 'TemperatureHour', 60 * 60, lambda ts: ts[:13] + ':00:00'),
+    ('day', 'TemperatureDay', 24 * 60 * 60, lambda ts: ts[:10] + ' 00:00:00'),
+]
+
+
+def get_table(resolution):
+    for name, table, seconds, bucket in RESOLUTIONS:
+        if name == resolution:
+            return table
+    return None
+
+
+def create_rollup_schema(conn):
+    for name, table, seconds, bucket in RESOLUTIONS:
+        conn.execute("CREATE TABLE IF NOT EXISTS {0}(sensor INTEGER NOT NULL, [timestamp] TIMESTAMP NOT NULL, "
+                     "samples INTEGER NOT NULL, total NUMERIC NOT NULL, min_temp NUMERIC, max_temp NUMERIC, "
+                     "PRIMARY KEY(sensor, [timestamp]));".format(table))
+        conn.execute("CREATE INDEX IF NOT EXISTS {0}Time ON {0}([timestamp]);".format(table))
+
+    # raw rows up to "backfill_rowid" were written before we kept
+    # rollups, "backfill_done" is how far backfill() has got with them
+    conn.execute("CREATE TABLE IF NOT EXISTS RollupState(name TEXT PRIMARY KEY, value INTEGER);")
+    conn.execute("INSERT OR IGNORE INTO RollupState(name, value) SELECT 'backfill_rowid', IFNULL(MAX(rowid), 0) FROM Temperature;")
+    conn.execute("INSERT OR IGNORE INTO RollupState(name, value) VALUES('backfill_done', 0);")
+    return
+
+
+# update_rollups()
+# ================
+# folds raw (timestamp, temp, sensor) rows into the rollup tables.
+# Runs inside the caller's transaction so the raw rows and their
+# rollups are committed together. The rows are summed per bucket
+# first so each bucket is touched once per batch.
+
+def update_rollups(conn, rows):
+    for name, table, seconds, bucket in RESOLUTIONS:
+        buckets = {}
+        for timestamp, temp, sensor in rows:
+            if temp is None:
+                continue
+            key = (sensor, bucket(timestamp))
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [1, temp, temp, temp]
+            else:
+                agg[0] += 1
+                agg[1] += temp
+                agg[2] = min(agg[2], temp)
+                agg[3] = max(agg[3], temp)
+
+        if len(buckets) == 0:
+            continue
+
+        conn.executemany("INSERT OR IGNORE INTO {0}(sensor, [timestamp], samples, total, min_temp, max_temp) "
+                         "VALUES(?,?,0,0,?,?)".format(table),
+                         [(key[0], key[1], agg[2], agg[3]) for key, agg in buckets.iteritems()])
+        conn.executemany("UPDATE {0} SET samples = samples + ?, total = total + ?, "
+                         "min_temp = min(min_temp, ?), max_temp = max(max_temp, ?) "
+                         "WHERE sensor = ? AND [timestamp] = ?".format(table),
+                         [(agg[0], agg[1], agg[2], agg[3], key[0], key[1]) for key, agg in buckets.iteritems()])
+    return
+
+
+# pick_resolution()
+# =================
+# the coarsest rollup that still gives us "points" buckets across
+# the window, None means the window is short enough to use raw rows.
+
+def pick_resolution(window_seconds, points):
+    chosen = None
+    for name, table, seconds, bucket in RESOLUTIONS:
+        if window_seconds / seconds >= points:
+            chosen = name
+    return chosen
+
+
+# backfill()
+# ==========
+# builds the rollups for the rows that were logged before the rollup
+# tables existed. Works through them "chunk_rows" at a time, each chunk
+# in its own transaction along with the progress marker, so it can be
+# stopped and restarted and never holds the database for long. With
+# "max_chunks" it does that much and leaves the rest for next time.
+#
+# The monitor runs it a chunk at a time on a schedule while a migration
+# (storage.migrate()) or someone at the command line may run it too.
+# Each chunk takes the write lock (BEGIN IMMEDIATE) before it reads the
+# marker, picks its rows and moves the marker on, so two backfills take
+# turns and never roll the same rows up twice.
+
+def backfill(db_name, chunk_rows=10000, verbose=False, max_chunks=None):
+    conn = database.connect(db_name)
+    with conn:
+        create_rollup_schema(conn)
+
+    total_rows = 0
+    chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            last_rowid = conn.execute("SELECT value FROM RollupState WHERE name = 'backfill_rowid'").fetchone()[0]
+            done_rowid = conn.execute("SELECT value FROM RollupState WHERE name = 'backfill_done'").fetchone()[0]
+            if done_rowid >= last_rowid:
+                break
+
+            chunks += 1
+            rows = conn.execute("SELECT [timestamp], temp, sensor, rowid FROM Temperature "
+                                "WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?",
+                                (done_rowid, last_rowid, chunk_rows)).fetchall()
+            if len(rows) == 0:
+                done_rowid = last_rowid
+            else:
+                done_rowid = rows[-1][3]
+
+            update_rollups(conn, [row[:3] for row in rows])
+            conn.execute("UPDATE RollupState SET value = ? WHERE name = 'backfill_done'", (done_rowid,))
+
+        total_rows += len(rows)
+        if verbose:
+            print "{0} rows rolled up ({1}/{2})".format(total_rows, done_rowid, last_rowid)
+
+    conn.close()
+    return total_rows
+
+
+def create_parser():
+    parser = OptionParser(usage="rollup.py [options] backfill",
+                          description="Builds the minute/hour/day rollups for rows logged before they existed")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database to update", metavar="FILE")
+
+    parser.add_option("-c", "--chunk", dest="chunk_rows", default=10000, type="int",
+                      help="raw rows to roll up per transaction")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] != "backfill":
+        parser.print_help()
+        sys.exit(-1)
+
+    backfill(opts.db_name, opts.chunk_rows, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import Queue
+import threading
+import traceback
+
+import scheduler
+
+# runtime.py
+# ==========
+# runs the monitor as a few threads rather than one blocking loop, so
+# slow database writes or a background job don't eat into the sampling:
+#
+#   producers - sample on their own scheduler and hand rows to the writer
+#   writer    - owns the database connection, takes batches of rows off
+#               a bounded queue and writes them (see monitor.LogWriter)
+#   jobs      - periodic housekeeping (rollup backfill and the like)
+#
+# The queue between the producers and the writer is bounded. When the
+# writer falls behind a producer waits for room, its scheduler then
+# coalesces or skips the ticks it missed, so a slow SD card slows the
+# sampling down instead of filling memory.
+#
+# (python 2 has no asyncio, threads and Queue do the same job here.)
+
+_STOP = object()  # put on the queue to tell the writer to finish up
+
+
+class Runtime(object):
+    def __init__(self, queue_size=100):
+        self._queue = Queue.Queue(queue_size)
+        self._stopping = threading.Event()
+        self._producers = []
+        self._jobs = []
+        self._open_writer = None
+        self._threads = []
+        self._writer_thread = None
+
+        self.writer = None  # whatever open_writer() gave us
+        self.batches = 0
+        self.backpressure = 0  # times a producer had to wait for the writer
+
+    # add_producer()
+    # ==============
+    # "produce" is called with the names of the jobs that are due each
+    # time "ticker" (a scheduler.Scheduler) fires and returns the rows
+    # to write. "finish" is called once on the way out for any last rows.
+    def add_producer(self, name, ticker, produce, finish=None):
+        self._producers.append((name, ticker, produce, finish))
+
+    # add_job()
+    # =========
+    # "job" is called every "period" seconds on the jobs thread.
+    def add_job(self, name, period, job):
+        self._jobs.append((name, period, job))
+
+    # "open_writer" is called on the writer thread (sqlite connections
+    # belong to the thread that opened them) and returns an object with
+    # add_rows(rows), time_to_flush(), flush() and close()
+    def set_writer(self, open_writer):
+        self._open_writer = open_writer
+
+    def start(self):
+        self._writer_thread = self._start_thread("writer", self._write)
+        for name, ticker, produce, finish in self._producers:
+            self._threads.append(self._start_thread(name, self._produce, ticker, produce, finish))
+        if len(self._jobs) != 0:
+            self._threads.append(self._start_thread("jobs", self._run_jobs))
+
+    def _start_thread(self, name, target, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def is_running(self):
+        return not self._stopping.is_set()
+
+    # a sleep for the producers' schedulers that stop() cuts short
+    def sleep(self, seconds):
+        return self._stopping.wait(seconds)
+
+    # stop()
+    # ======
+    # stops the producers and jobs, then lets the writer drain the queue
+    # and flush before it closes the database.
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        if self._writer_thread is not None:
+            if self._writer_thread.is_alive():
+                self._queue.put(_STOP)
+            self._writer_thread.join()
+            self._writer_thread = None
+
+    # run()
+    # =====
+    # starts everything and waits for ^C, a SIGTERM (turned into
+    # SystemExit) or a thread giving up, then shuts down cleanly.
+    def run(self):
+        self.start()
+        try:
+            while self.is_running() and self._writer_thread.is_alive():
+                self._stopping.wait(1.0)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
+
+    def put_rows(self, rows):
+        if len(rows) == 0:
+            return
+        try:
+            self._queue.put_nowait(rows)
+            return
+        except Queue.Full:
+            self.backpressure += 1
+
+        # wait for the writer to catch up, as long as it's still there
+        while self._writer_thread is not None and self._writer_thread.is_alive():
+            try:
+                self._queue.put(rows, True, 1.0)
+                return
+            except Queue.Full:
+                continue
+
+    def _produce(self, ticker, produce, finish):
+        try:
+            while self.is_running():
+                due = ticker.wait()
+                if len(due) == 0 or not self.is_running():
+                    continue
+                self.put_rows(produce(due))
+        except Exception:
+            traceback.print_exc()
+            self._stopping.set()
+
+        if finish is not None:
+            self.put_rows(finish())
+
+    def _write(self):
+        writer = self.writer = self._open_writer()
+        try:
+            while True:
+                try:
+                    rows = self._queue.get(True, writer.time_to_flush())
+                except Queue.Empty:
+                    writer.flush()  # nothing new, but the queued rows are due
+                    continue
+
+                if rows is _STOP:
+                    break
+                writer.add_rows(rows)
+                self.batches += 1
+        except Exception:
+            traceback.print_exc()
+            self._stopping.set()
+        finally:
+            writer.close()
+
+    def _run_jobs(self):
+        ticker = scheduler.Scheduler('skip', sleep=self._stopping.wait)
+        jobs = {}
+        for name, period, job in self._jobs:
+            ticker.add(name, period)
+            jobs[name] = job
+
+        while self.is_running():
+            for name in ticker.wait():
+                try:
+                    jobs[name]()
+                except Exception:
+                    traceback.print_exc()  # a broken job shouldn't stop the monitor
@@ -0,0 +1,146 @@
+import time
+
+# scheduler.py
+# ============
+# runs the monitor's sampling on a fixed grid of absolute deadlines
+# taken from a monotonic clock, so time spent in the loop doesn't push
+# the samples later and later, and setting the wall clock (ntp on a Pi
+# without an RTC does this at boot) doesn't upset the cadence.
+#
+# When the loop overruns and deadlines are missed we don't try to
+# catch up with a burst of samples, what happens is up to the policy:
+#   coalesce - run once as soon as we can for all the missed ticks
+#   skip     - drop the missed ticks and wait for the next deadline
+
+
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    # python 2 has no monotonic clock, ask libc for CLOCK_MONOTONIC
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        return time.time  # better than nothing
+
+
+monotonic = _get_monotonic()
+
+POLICIES = ('coalesce', 'skip')
+
+
+class Job(object):
+    def __init__(self, name, period, deadline):
+        self.name = name
+        self.period = period
+        self.deadline = deadline  # next time (monotonic) the job is due
+
+
+# Scheduler
+# =========
+# jobs each have their own period, wait() sleeps until the earliest
+# deadline and returns the names of the jobs that are due (or nothing
+# if the sleep function returned True, which is how Event.wait() tells
+# us it was woken up). For every
+# cycle we keep the jitter (how late we woke up) and how many ticks
+# were missed, the latest values and running totals.
+
+class Scheduler(object):
+    def __init__(self, policy='coalesce', clock=monotonic, sleep=time.sleep):
+        if policy not in POLICIES:
+            raise ValueError("unknown missed tick policy: {0}".format(policy))
+        self._policy = policy
+        self._clock = clock
+        self._sleep = sleep
+        self._jobs = []
+
+        self.cycles = 0
+        self.last_jitter = 0.0  # seconds we woke up after the deadline
+        self.last_missed = 0  # ticks missed in the last cycle
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.missed_ticks = 0
+        self.overruns = 0  # cycles that missed at least one tick
+
+    # jobs all start on the next tick of a grid anchored at the first
+    # add() so jobs with related periods stay in step with each other
+    def add(self, name, period):
+        now = self._clock()
+        if len(self._jobs) != 0:
+            now = self._jobs[0].deadline - self._jobs[0].period
+        self._jobs.append(Job(name, period, now + period))
+        return
+
+    def get_periods(self):
+        return dict((job.name, job.period) for job in self._jobs)
+
+    def wait(self):
+        while True:
+            deadline = min(job.deadline for job in self._jobs)
+            now = self._clock()
+            if deadline > now:
+                if self._sleep(deadline - now):
+                    return []  # a sleep like threading.Event.wait() was cut short
+                now = self._clock()
+                if now < deadline:
+                    continue  # woke up early (signal), go back to sleep
+
+            due = []
+            jitter = 0.0
+            missed = 0
+            for job in self._jobs:
+                if job.deadline > now:
+                    continue
+
+                late = now - job.deadline
+                ticks_missed = int(late // job.period)
+                job.deadline += (ticks_missed + 1) * job.period
+                missed += ticks_missed
+                if ticks_missed != 0 and self._policy == 'skip':
+                    continue
+
+                due.append(job.name)
+                jitter = max(jitter, late)
+
+            self._record(jitter, missed)
+            if len(due) != 0:
+                return due
+
+    def _record(self, jitter, missed):
+        self.cycles += 1
+        self.last_jitter = jitter
+        self.last_missed = missed
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.total_jitter += jitter
+        self.missed_ticks += missed
+        if missed != 0:
+            self.overruns += 1
+        return
+
+    def get_stats(self):
+        mean_jitter = 0.0
+        if self.cycles != 0:
+            mean_jitter = self.total_jitter / self.cycles
+        return {'cycles': self.cycles,
+                'mean_jitter': mean_jitter,
+                'max_jitter': self.max_jitter,
+                'missed_ticks': self.missed_ticks,
+                'overruns': self.overruns}
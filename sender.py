@@ -0,0 +1,383 @@
+import httplib
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+import database
+import nest
+import scheduler
+import spool
+import storage
+
+# sender.py
+# =========
+# ships a monitor's readings to the collector (collector.py), so the
+# Pis in every room end up in one database. Each node keeps logging to
+# its own sensorlog.db as before, the rows also go to an outbox:
+#
+#   Outbox - a directory of sealed batches, one file per writer flush
+#            named by its sequence number, in spool.py's record format.
+#            A batch is written to a .partial file, synced and renamed
+#            into place, so it's either there whole or not at all. The
+#            outbox's "stream" (made up when it's created) and the last
+#            sequence number handed out live in outbox.state.
+#   Sender - a thread of its own that posts the oldest batches to the
+#            collector, zlib compressed, and deletes them once the
+#            collector says it has them. While the collector can't be
+#            reached the batches pile up in the outbox (on the card,
+#            so a restart doesn't lose them) and go once it's back.
+#
+# The collector keeps the last sequence number it took from each
+# (node, stream) in the same transaction as the rows, and skips any
+# batch at or below it. A batch sent again because the answer got lost
+# on the way back is only counted once, and a node whose outbox was
+# wiped starts a new stream rather than having its batches skipped.
+#
+# The request body (before compression) is
+#
+#   {"node": "kitchen", "stream": "<hex>", "sensors": {"3": "28-0416718527ff"},
+#    "batches": [{"seq": 17, "rows": [[3, epoch, millic], ...]}, ...]}
+#
+# the rows carry the node's own sensor ids and "sensors" their serial
+# ids, the collector turns them into node qualified ones
+# (get_qualified_id()). The answer is {"last_seq": n}.
+
+BATCH_ROWS = 5000  # most rows per request, when catching up
+BACKOFF = 5.0  # seconds before trying again after a failure
+MAX_BACKOFF = 300.0
+IDLE_SECONDS = 30.0  # look at the outbox at least this often
+TIMEOUT = 30.0
+PATH = '/batches'
+
+NODE_NAME = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+class SendError(Exception):
+    pass
+
+
+# the collector's name for a node's sensor, "kitchen/28-0416718527ff"
+def get_qualified_id(node, serial_id):
+    return "{0}/{1}".format(node, serial_id)
+
+
+def check_node(node):
+    if not isinstance(node, basestring) or NODE_NAME.match(node) is None:
+        raise ValueError("bad node name {0!r}".format(node))
+    return node
+
+
+def get_node_name():
+    return socket.gethostname().split('.')[0]
+
+
+# encode_payload()
+# ================
+# the compressed request body for (seq, rows) batches, "serials" maps
+# the sensor ids in the rows to serial ids
+def encode_payload(node, stream, batches, serials):
+    sensors = {}
+    body = []
+    for seq, rows in batches:
+        packed = []
+        for timestamp, temp, sensor in rows:
+            sensors[str(sensor)] = serials.get(sensor, str(sensor))
+            packed.append([sensor, storage.to_epoch(timestamp), storage.to_millic(temp)])
+        body.append({"seq": seq, "rows": packed})
+    return zlib.compress(json.dumps({"node": node, "stream": stream, "sensors": sensors, "batches": body},
+                                    separators=(',', ':')))
+
+
+# decode_payload()
+# ================
+# (node, stream, [(seq, [(epoch, millic, serial id)])]) from a request
+# body, raises ValueError if it isn't one
+def decode_payload(data):
+    try:
+        payload = json.loads(zlib.decompress(data))
+    except zlib.error as e:
+        raise ValueError("not compressed ({0})".format(e))
+
+    node = check_node(payload.get("node"))
+    stream = payload.get("stream")
+    if not isinstance(stream, basestring) or len(stream) == 0:
+        raise ValueError("no stream")
+    sensors = payload.get("sensors") or {}
+
+    batches = []
+    for batch in payload.get("batches") or []:
+        seq = batch["seq"]
+        if not isinstance(seq, (int, long)) or seq < 1:
+            raise ValueError("bad sequence number {0!r}".format(seq))
+        rows = []
+        for sensor, epoch, millic in batch["rows"]:
+            serial_id = sensors.get(str(sensor))
+            if not isinstance(serial_id, basestring) or '/' in serial_id:
+                raise ValueError("bad sensor {0!r}".format(sensor))
+            rows.append((int(epoch), int(millic), serial_id))
+        batches.append((seq, rows))
+    batches.sort(key=lambda batch: batch[0])
+    return node, stream, batches
+
+
+def _write_file(name, data):
+    partial = name + ".partial"
+    out_file = open(partial, "wb")
+    try:
+        out_file.write(data)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    finally:
+        out_file.close()
+    os.rename(partial, name)
+
+
+# Outbox
+# ======
+# the batches waiting to go, see above. add_rows() and seal() are
+# called from the monitor's writer, get_batches() and remove() from
+# the Sender's thread.
+
+class Outbox(object):
+    STATE = 'outbox.state'
+    SUFFIX = '.batch'
+
+    def __init__(self, outbox_dir):
+        self._dir = outbox_dir
+        self._lock = threading.Lock()
+        self._rows = []  # not sealed yet
+        self.sealed = threading.Event()  # set when there's a new batch
+
+        if not os.path.isdir(outbox_dir):
+            os.makedirs(outbox_dir)
+        self.stream, self._seq = self._read_state()
+        seqs = self.get_seqs()
+        if len(seqs) != 0:
+            self._seq = max(self._seq, seqs[-1])  # sealed, but the state wasn't written
+            self.sealed.set()
+
+    def _read_state(self):
+        state_name = os.path.join(self._dir, self.STATE)
+        if os.path.exists(state_name):
+            state_file = open(state_name)
+            try:
+                stream, seq = state_file.read().split()
+            finally:
+                state_file.close()
+            return stream, int(seq)
+
+        stream = uuid.uuid4().hex
+        _write_file(state_name, "{0} 0\n".format(stream))
+        return stream, 0
+
+    def get_dir(self):
+        return self._dir
+
+    def get_batch_name(self, seq):
+        return os.path.join(self._dir, "{0:012d}{1}".format(seq, self.SUFFIX))
+
+    # the sequence numbers of the batches in the outbox, oldest first
+    def get_seqs(self):
+        return sorted(int(name[:-len(self.SUFFIX)]) for name in os.listdir(self._dir)
+                      if name.endswith(self.SUFFIX))
+
+    def add_rows(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+
+    # seal()
+    # ======
+    # writes the rows added since the last seal() as the next batch,
+    # returns its sequence number (None if there was nothing to write).
+    # Raises EnvironmentError if it couldn't be written, the rows are
+    # kept for the next one.
+    def seal(self):
+        with self._lock:
+            if len(self._rows) == 0:
+                return None
+            seq = self._seq + 1
+            _write_file(self.get_batch_name(seq), "".join(spool.pack_row(row) for row in self._rows))
+            _write_file(os.path.join(self._dir, self.STATE), "{0} {1}\n".format(self.stream, seq))
+            self._seq = seq
+            self._rows = []
+        self.sealed.set()
+        return seq
+
+    def get_pending_rows(self):
+        with self._lock:
+            return len(self._rows)
+
+    # get_batches()
+    # =============
+    # [(seq, rows)] for the oldest batches, up to "max_rows" rows (but
+    # always the first batch), rows as (timestamp, temp, sensor)
+    def get_batches(self, max_rows=BATCH_ROWS):
+        batches = []
+        total = 0
+        for seq in self.get_seqs():
+            rows = self.read_batch(seq)
+            if len(batches) != 0 and total + len(rows) > max_rows:
+                break
+            batches.append((seq, rows))
+            total += len(rows)
+        return batches
+
+    def read_batch(self, seq):
+        batch_file = open(self.get_batch_name(seq), "rb")
+        try:
+            data = batch_file.read()
+        finally:
+            batch_file.close()
+
+        rows = []
+        for offset in range(0, len(data) - spool.RECORD.size + 1, spool.RECORD.size):
+            row = spool.unpack_row(data[offset:offset + spool.RECORD.size])
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    # remove()
+    # ========
+    # deletes the batches up to and including "last_seq", the collector
+    # has them
+    def remove(self, last_seq):
+        removed = 0
+        for seq in self.get_seqs():
+            if seq > last_seq:
+                break
+            os.remove(self.get_batch_name(seq))
+            removed += 1
+        return removed
+
+
+# Sender
+# ======
+# posts the outbox to the collector at "url" as "node". The serial ids
+# of the node's sensors come from the Sensor table in "db_name".
+
+class Sender(object):
+    def __init__(self, outbox, db_name, node, url, batch_rows=BATCH_ROWS, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 idle_seconds=IDLE_SECONDS, timeout=TIMEOUT, clock=scheduler.monotonic):
+        self._outbox = outbox
+        self._db_name = db_name
+        self._node = check_node(node)
+        self._url = url.rstrip('/') + PATH
+        self._batch_rows = batch_rows
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._idle_seconds = idle_seconds
+        self._clock = clock
+        self._session = nest.Session(timeout)
+        self._serials = {}  # sensor id -> serial id
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.requests = 0
+        self.batches = 0  # acknowledged
+        self.rows = 0
+        self.failures = 0
+        self.failures_in_a_row = 0
+        self.last_seq = None  # the collector's, from its last answer
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sender")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # close()
+    # =======
+    # gives the outbox up to "timeout" seconds to empty (the monitor's
+    # last rows, say) and stops. Whatever's left goes next time.
+    def close(self, timeout=0.0):
+        deadline = self._clock() + timeout
+        while self._clock() < deadline and len(self._outbox.get_seqs()) != 0 and self.failures_in_a_row == 0:
+            self._outbox.sealed.set()
+            time.sleep(0.1)
+        self._stopping.set()
+        self._outbox.sealed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._session.close()
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stopping.is_set():
+            if backoff:
+                self._stopping.wait(backoff)  # new batches can wait, the collector isn't there
+            else:
+                self._outbox.sealed.wait(self._idle_seconds)
+            if self._stopping.is_set():
+                break
+            self._outbox.sealed.clear()
+            try:
+                self.send_pending()
+            except (SendError, httplib.HTTPException, socket.error, EnvironmentError, sqlite3.Error, ValueError) as e:
+                self.failures += 1
+                self.failures_in_a_row += 1
+                backoff = min(self._backoff * 2 ** (self.failures_in_a_row - 1), self._max_backoff)
+                print "sending to the collector failed ({0}), trying again in {1:.0f}s".format(e, backoff)
+                continue
+            self.failures_in_a_row = 0
+            backoff = 0.0
+
+    # send_pending()
+    # ==============
+    # posts the outbox, "batch_rows" at a time, until it's empty.
+    # Returns the number of batches the collector took, raises on the
+    # first one that fails.
+    def send_pending(self):
+        sent = 0
+        while not self._stopping.is_set():
+            batches = self._outbox.get_batches(self._batch_rows)
+            if len(batches) == 0:
+                break
+            last_seq = self.send(batches)
+            self._outbox.remove(last_seq)
+            acked = [batch for batch in batches if batch[0] <= last_seq]
+            if len(acked) == 0:
+                raise SendError("the collector is at {0}, behind batch {1}".format(last_seq, batches[0][0]))
+            sent += len(acked)
+            self.batches += len(acked)
+            self.rows += sum(len(rows) for seq, rows in acked)
+        return sent
+
+    # send()
+    # ======
+    # posts (seq, rows) batches, returns the last sequence number the
+    # collector has from us
+    def send(self, batches):
+        body = encode_payload(self._node, self._outbox.stream, batches, self.get_serials(batches))
+        self.requests += 1
+        status, reason, data = self._session.request("POST", self._url, body,
+                                                     {"Content-Type": "application/json",
+                                                      "Content-Encoding": "deflate"})
+        if status != 200:
+            raise SendError("{0} {1}".format(status, reason))
+        self.last_seq = int(json.loads(data)["last_seq"])
+        return self.last_seq
+
+    # the serial ids for the sensors in "batches", read from the Sensor
+    # table again when there's one we haven't seen
+    def get_serials(self, batches):
+        for seq, rows in batches:
+            for timestamp, temp, sensor in rows:
+                if sensor not in self._serials:
+                    conn = database.open_reader(self._db_name)
+                    try:
+                        self._serials = dict(conn.execute("SELECT sensor_id, serial_id FROM Sensor").fetchall())
+                    finally:
+                        conn.close()
+                    return self._serials
+        return self._serials
+
+    # returns (requests, batches sent, rows sent, failed requests,
+    # batches waiting in the outbox)
+    def get_stats(self):
+        return self.requests, self.batches, self.rows, self.failures, len(self._outbox.get_seqs())
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+import os
+import struct
+import sys
+import zlib
+from optparse import OptionParser
+
+import database
+import rollup
+import stats
+import storage
+
+# spool.py
+# ========
+# where the monitor's readings go when the database won't take them
+# (locked, corrupt, disk full), so the sampling carries on and nothing
+# is lost. The spool is an append-only file of fixed size records:
+#
+#   magic   2 bytes  0x5350, marks a record
+#   sensor  4 bytes  sensor id
+#   time    8 bytes  epoch seconds
+#   millic  4 bytes  temperature in milli-degrees C
+#   crc     4 bytes  crc32 of the 18 bytes before it
+#
+# Each batch of rows is written with a single write() on a file opened
+# O_APPEND. A write cut short (power cut, full disk) leaves at most one
+# torn record at the end, the crc and the record size let us find the
+# good ones. Once the database is back replay() writes the records in
+# the order they were spooled, skipping any that made it into the
+# database already (a replay that was interrupted, say), and empties
+# the spool.
+
+dbname = '/home/pi/sensorlog.db'
+
+RECORD = struct.Struct('<HIqiI')
+MAGIC = 0x5350
+REPLAY_ROWS = 1000  # rows per transaction when replaying
+
+
+def pack_row(row):
+    timestamp, temp, sensor = row
+    data = struct.pack('<HIqi', MAGIC, sensor, storage.to_epoch(timestamp), storage.to_millic(temp))
+    return data + struct.pack('<I', zlib.crc32(data) & 0xFFFFFFFF)
+
+
+# unpack_row()
+# ============
+# the (timestamp, temp, sensor) row in a record, None if it's damaged
+def unpack_row(record):
+    magic, sensor, epoch, millic, crc = RECORD.unpack(record)
+    if magic != MAGIC or zlib.crc32(record[:-4]) & 0xFFFFFFFF != crc:
+        return None
+    return storage.to_timestamp(epoch), millic / 1000.0, sensor
+
+
+class Spool(object):
+    def __init__(self, spool_name):
+        self._spool_name = spool_name
+        self._size = 0
+        if os.path.exists(spool_name):
+            self._size = os.path.getsize(spool_name)
+
+        self.rows_spooled = 0
+        self.rows_replayed = 0
+        self.duplicates = 0
+        self.damaged = 0
+
+    def get_name(self):
+        return self._spool_name
+
+    def has_records(self):
+        return self._size >= RECORD.size
+
+    # append()
+    # ========
+    # adds (timestamp, temp, sensor) rows to the end of the spool,
+    # raises EnvironmentError if they couldn't be written (the spool
+    # is left as it was).
+    def append(self, rows):
+        if len(rows) == 0:
+            return 0
+
+        data = "".join(pack_row(row) for row in rows)
+        fd = os.open(self._spool_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            size = os.fstat(fd).st_size
+            if size % RECORD.size != 0:
+                # a torn record from an earlier write, drop it so the
+                # records stay aligned
+                size -= size % RECORD.size
+                os.ftruncate(fd, size)
+
+            written = os.write(fd, data)
+            if written != len(data):
+                os.ftruncate(fd, size)
+                raise IOError("short write to {0}".format(self._spool_name))
+        finally:
+            os.close(fd)
+
+        self._size = size + len(data)
+        self.rows_spooled += len(rows)
+        return len(rows)
+
+    # read_rows()
+    # ===========
+    # the rows in the spool in the order they were written
+    def read_rows(self):
+        if not os.path.exists(self._spool_name):
+            return
+        spool_file = open(self._spool_name, "rb")
+        try:
+            while True:
+                record = spool_file.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    return  # the end, or a torn record
+                row = unpack_row(record)
+                if row is None:
+                    self.damaged += 1
+                    continue
+                yield row
+        finally:
+            spool_file.close()
+
+    # replay()
+    # ========
+    # writes the spooled rows into the database "chunk_rows" at a time,
+    # each chunk in its own transaction with its rollups and stats, then
+    # empties the spool. Any error is left to the caller, the spool is
+    # only emptied once every row is in. Returns the number of rows
+    # written.
+    def replay(self, conn, chunk_rows=REPLAY_ROWS):
+        written = 0
+        chunk = []
+        for row in self.read_rows():
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                written += self._write_chunk(conn, chunk)
+                chunk = []
+        written += self._write_chunk(conn, chunk)
+
+        self.clear()
+        self.rows_replayed += written
+        return written
+
+    def _write_chunk(self, conn, rows):
+        if len(rows) == 0:
+            return 0
+        with conn:
+            new_rows = storage.filter_new_rows(conn, rows)
+            storage.insert_rows(conn, new_rows)
+            rollup.update_rollups(conn, new_rows)
+            stats.update_stats(conn, new_rows)
+        self.duplicates += len(rows) - len(new_rows)
+        return len(new_rows)
+
+    def clear(self):
+        if os.path.exists(self._spool_name):
+            spool_file = open(self._spool_name, "r+b")
+            spool_file.truncate(0)
+            spool_file.close()
+        self._size = 0
+
+
+def create_parser():
+    parser = OptionParser(usage="spool.py [options] show|replay",
+                          description="Shows or replays the readings the monitor spooled while the database was unavailable, the monitor replays them itself so only replay with it stopped")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database to replay into", metavar="FILE")
+
+    parser.add_option("-s", "--spool", dest="spool_name", default=None,
+                      help="spool file (default the database name + .spool)", metavar="FILE")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('show', 'replay'):
+        parser.print_help()
+        sys.exit(-1)
+
+    spool = Spool(opts.spool_name or opts.db_name + ".spool")
+    if args[0] == 'show':
+        for timestamp, temp, sensor in spool.read_rows():
+            print "{0} [{1}] {2:.3f}".format(timestamp, sensor, temp)
+        print "{0} damaged records".format(spool.damaged)
+        return
+
+    conn = database.connect(opts.db_name)
+    written = spool.replay(conn)
+    conn.close()
+    print "{0} rows replayed, {1} already in the database, {2} damaged".format(written, spool.duplicates, spool.damaged)
+
+
+if __name__ == "__main__":
+    main()
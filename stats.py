@@ -0,0 +1,358 @@
+#!/usr/bin/python
+
+import datetime
+import math
+import sys
+from optparse import OptionParser
+
+import database
+import retention
+import storage
+
+# stats.py
+# ========
+# per sensor statistics kept up to date as the rows are logged, so the
+# chart's stats panel costs the same however long the log is:
+#
+#   SensorStats     - all time samples/mean/m2/min/max per sensor, and
+#                     the last reading seen
+#   SensorStatsHour - the same per sensor per hour, for the last
+#                     KEEP_HOURS only. A rolling window is the hours
+#                     that fall in it merged together (so it moves on
+#                     an hour at a time).
+#
+# mean and m2 (the sum of squared differences from the mean) are
+# Welford's running values: a batch of rows is accumulated on its own
+# and merged into the stored values with Chan's formula, which doesn't
+# lose precision the way a running sum of squares does. The stats are
+# of the logged rows, what the database holds, not of every reading
+# the compressors thinned out.
+
+dbname = '/home/pi/sensorlog.db'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+WINDOWS = [('24 hours', 24), ('7 days', 7 * 24)]  # (name, hours) shown besides all time
+KEEP_HOURS = max(hours for name, hours in WINDOWS)
+REBUILD_ROWS = 10000  # raw rows read at a time in rebuild()
+
+
+# Accumulator
+# ===========
+# samples, mean, m2, min and max of a set of readings
+
+class Accumulator(object):
+    def __init__(self, samples=0, mean=0.0, m2=0.0, min_temp=None, max_temp=None):
+        self.samples = samples
+        self.mean = mean
+        self.m2 = m2
+        self.min_temp = min_temp
+        self.max_temp = max_temp
+
+    def add(self, temp):
+        temp = float(temp)
+        self.samples += 1
+        delta = temp - self.mean
+        self.mean += delta / self.samples
+        self.m2 += delta * (temp - self.mean)
+        if self.min_temp is None or temp < self.min_temp:
+            self.min_temp = temp
+        if self.max_temp is None or temp > self.max_temp:
+            self.max_temp = temp
+
+    def merge(self, other):
+        if other.samples == 0:
+            return
+        samples = self.samples + other.samples
+        delta = other.mean - self.mean
+        self.mean += delta * other.samples / samples
+        self.m2 += other.m2 + delta * delta * self.samples * other.samples / samples
+        self.samples = samples
+        if self.min_temp is None or other.min_temp < self.min_temp:
+            self.min_temp = other.min_temp
+        if self.max_temp is None or other.max_temp > self.max_temp:
+            self.max_temp = other.max_temp
+
+    # takes back an add() of "temp". min and max can't be taken back,
+    # they stay as they were (the reading was still seen)
+    def remove(self, temp):
+        temp = float(temp)
+        if self.samples <= 1:
+            self.samples, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        mean = (self.mean * self.samples - temp) / (self.samples - 1)
+        self.m2 -= (temp - mean) * (temp - self.mean)
+        self.mean = mean
+        self.samples -= 1
+
+    # the population standard deviation, None without any samples
+    def get_stddev(self):
+        if self.samples == 0:
+            return None
+        return math.sqrt(max(self.m2, 0.0) / self.samples)
+
+    def get_values(self):
+        return self.samples, self.mean, self.m2, self.min_temp, self.max_temp
+
+
+def create_stats_schema(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS SensorStats(sensor INTEGER PRIMARY KEY, samples INTEGER NOT NULL, "
+                 "mean REAL NOT NULL, m2 REAL NOT NULL, min_temp REAL, max_temp REAL, "
+                 "last_timestamp TIMESTAMP, last_temp REAL);")
+    conn.execute("CREATE TABLE IF NOT EXISTS SensorStatsHour(sensor INTEGER NOT NULL, [timestamp] TIMESTAMP NOT NULL, "
+                 "samples INTEGER NOT NULL, mean REAL NOT NULL, m2 REAL NOT NULL, min_temp REAL, max_temp REAL, "
+                 "PRIMARY KEY(sensor, [timestamp]));")
+    conn.execute("CREATE INDEX IF NOT EXISTS SensorStatsHourTime ON SensorStatsHour([timestamp]);")
+    return
+
+
+def has_stats(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'SensorStats'").fetchone()
+    return row is not None
+
+
+def get_hour(timestamp):
+    return timestamp[:13] + ':00:00'
+
+
+# the first hour we keep (or show) for a window of "hours" up to "now"
+def get_first_hour(now, hours):
+    return get_hour((now - datetime.timedelta(hours=hours - 1)).strftime(TIME_FORMAT))
+
+
+# update_stats()
+# ==============
+# folds (timestamp, temp, sensor) rows into the stats. Runs inside the
+# caller's transaction, like rollup.update_rollups(), so the rows and
+# their stats are committed together.
+def update_stats(conn, rows, now=None):
+    first_hour = get_first_hour(now or datetime.datetime.now(), KEEP_HOURS)
+
+    sensors = {}  # sensor -> Accumulator
+    hours = {}  # (sensor, hour) -> Accumulator
+    last = {}  # sensor -> (timestamp, temp)
+    for timestamp, temp, sensor in rows:
+        if temp is None:
+            continue
+        sensors.setdefault(sensor, Accumulator()).add(temp)
+        hour = get_hour(timestamp)
+        if hour >= first_hour:
+            hours.setdefault((sensor, hour), Accumulator()).add(temp)
+        if sensor not in last or timestamp >= last[sensor][0]:
+            last[sensor] = (timestamp, float(temp))
+
+    for sensor, batch in sensors.iteritems():
+        row = conn.execute("SELECT samples, mean, m2, min_temp, max_temp, last_timestamp, last_temp "
+                           "FROM SensorStats WHERE sensor = ?", (sensor,)).fetchone()
+        stored = Accumulator()
+        last_timestamp, last_temp = last[sensor]
+        if row is not None:
+            stored = Accumulator(*row[:5])
+            if row[5] is not None and row[5] > last_timestamp:
+                last_timestamp, last_temp = row[5], row[6]  # a late row (spool replay), not the latest
+        stored.merge(batch)
+        conn.execute("INSERT OR REPLACE INTO SensorStats(sensor, samples, mean, m2, min_temp, max_temp, "
+                     "last_timestamp, last_temp) VALUES(?,?,?,?,?,?,?,?)",
+                     (sensor,) + stored.get_values() + (last_timestamp, last_temp))
+
+    for (sensor, hour), batch in hours.iteritems():
+        row = conn.execute("SELECT samples, mean, m2, min_temp, max_temp FROM SensorStatsHour "
+                           "WHERE sensor = ? AND [timestamp] = ?", (sensor, hour)).fetchone()
+        stored = Accumulator(*row) if row is not None else Accumulator()
+        stored.merge(batch)
+        conn.execute("INSERT OR REPLACE INTO SensorStatsHour(sensor, [timestamp], samples, mean, m2, min_temp, max_temp) "
+                     "VALUES(?,?,?,?,?,?,?)", (sensor, hour) + stored.get_values())
+
+    conn.execute("DELETE FROM SensorStatsHour WHERE [timestamp] < ?", (first_hour,))
+    return
+
+
+# remove_stats()
+# ==============
+# takes (timestamp, temp, sensor) rows that update_stats() counted but
+# that aren't in the database after all back out of the stats, see
+# storage.migrate(). Runs inside the caller's transaction.
+def remove_stats(conn, rows, now=None):
+    if not has_stats(conn):
+        return
+    first_hour = get_first_hour(now or datetime.datetime.now(), KEEP_HOURS)
+
+    sensors = {}  # sensor -> [temp]
+    hours = {}  # (sensor, hour) -> [temp]
+    for timestamp, temp, sensor in rows:
+        if temp is None:
+            continue
+        sensors.setdefault(sensor, []).append(temp)
+        hour = get_hour(timestamp)
+        if hour >= first_hour:
+            hours.setdefault((sensor, hour), []).append(temp)
+
+    for sensor, temps in sensors.iteritems():
+        row = conn.execute("SELECT samples, mean, m2, min_temp, max_temp FROM SensorStats WHERE sensor = ?",
+                           (sensor,)).fetchone()
+        if row is None:
+            continue
+        stored = Accumulator(*row)
+        for temp in temps:
+            stored.remove(temp)
+        conn.execute("UPDATE SensorStats SET samples = ?, mean = ?, m2 = ?, min_temp = ?, max_temp = ? "
+                     "WHERE sensor = ?", stored.get_values() + (sensor,))
+
+    for (sensor, hour), temps in hours.iteritems():
+        row = conn.execute("SELECT samples, mean, m2, min_temp, max_temp FROM SensorStatsHour "
+                           "WHERE sensor = ? AND [timestamp] = ?", (sensor, hour)).fetchone()
+        if row is None:
+            continue
+        stored = Accumulator(*row)
+        for temp in temps:
+            stored.remove(temp)
+        conn.execute("UPDATE SensorStatsHour SET samples = ?, mean = ?, m2 = ?, min_temp = ?, max_temp = ? "
+                     "WHERE sensor = ? AND [timestamp] = ?", stored.get_values() + (sensor, hour))
+    return
+
+
+# get_stats()
+# ===========
+# [(sensor, last timestamp, last temp, [(window name, Accumulator)])]
+# for every sensor with stats, the rolling WINDOWS then 'all time'.
+# Reads one row per sensor plus one per sensor per hour kept, however
+# many rows the log holds.
+def get_stats(conn, now=None):
+    if not has_stats(conn):
+        return []
+    now = now or datetime.datetime.now()
+
+    hour_rows = conn.execute("SELECT sensor, [timestamp], samples, mean, m2, min_temp, max_temp FROM SensorStatsHour "
+                             "WHERE [timestamp] >= ?", (get_first_hour(now, KEEP_HOURS),)).fetchall()
+
+    stats = []
+    for row in conn.execute("SELECT sensor, samples, mean, m2, min_temp, max_temp, last_timestamp, last_temp "
+                            "FROM SensorStats ORDER BY sensor"):
+        windows = []
+        for name, hours in WINDOWS:
+            first_hour = get_first_hour(now, hours)
+            window = Accumulator()
+            for hour_row in hour_rows:
+                if hour_row[0] == row[0] and hour_row[1] >= first_hour:
+                    window.merge(Accumulator(*hour_row[2:]))
+            windows.append((name, window))
+        windows.append(('all time', Accumulator(*row[1:6])))
+        stats.append((row[0], row[6], row[7], windows))
+    return stats
+
+
+# rebuild()
+# =========
+# works the stats out again from every raw row in the database, for a
+# database that was logging before we kept them (see
+# monitor.migrate_log_schema) or after a repair. Rows archived by
+# retention.py are only counted when "archive_rows" (chart.get_data()
+# style rows, see retention.read_archive()) is given. Returns the
+# number of rows counted.
+#
+# It's all one transaction that takes the write lock first (BEGIN
+# IMMEDIATE): rows the monitor wrote part way through a rebuild would
+# be counted by both it and us. The monitor's writer keeps its rows
+# (or spools them) until we're done. The rows are still read and
+# folded in "chunk_rows" at a time so a big log doesn't have to fit in
+# memory.
+def rebuild(conn, archive_rows=None, chunk_rows=REBUILD_ROWS):
+    total = 0
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        create_stats_schema(conn)
+        conn.execute("DELETE FROM SensorStats")
+        conn.execute("DELETE FROM SensorStatsHour")
+
+        if archive_rows is not None:
+            chunk = []
+            for sensor, timestamp, temp, key in archive_rows:
+                chunk.append((timestamp, temp, sensor))
+                if len(chunk) == chunk_rows:
+                    total += add_chunk(conn, chunk)
+                    chunk = []
+            total += add_chunk(conn, chunk)
+
+        # keyset pagination rather than one long SELECT, so there's no
+        # cursor open on the rows while we write the stats
+        for fmt in storage.get_formats(conn):
+            if fmt == 'text':
+                rowid = 0
+                while True:
+                    rows = conn.execute("SELECT rowid, [timestamp], temp, sensor FROM Temperature "
+                                        "WHERE rowid > ? ORDER BY rowid LIMIT ?", (rowid, chunk_rows)).fetchall()
+                    if len(rows) == 0:
+                        break
+                    rowid = rows[-1][0]
+                    total += add_chunk(conn, [row[1:] for row in rows])
+            else:
+                # spelled out rather than (sensor, [time]) > (?, ?), row
+                # values need SQLite 3.15
+                sensor, epoch = -1, 0
+                while True:
+                    rows = conn.execute("SELECT sensor, [time], millic FROM TemperatureCompact "
+                                        "WHERE sensor > ? OR (sensor = ? AND [time] > ?) "
+                                        "ORDER BY sensor, [time] LIMIT ?",
+                                        (sensor, sensor, epoch, chunk_rows)).fetchall()
+                    if len(rows) == 0:
+                        break
+                    sensor, epoch = rows[-1][:2]
+                    total += add_chunk(conn, [(storage.to_timestamp(epoch), millic / 1000.0, sensor)
+                                              for sensor, epoch, millic in rows])
+    return total
+
+
+def add_chunk(conn, rows):
+    if len(rows) != 0:
+        update_stats(conn, rows)
+    return len(rows)
+
+
+def print_stats(db_name):
+    conn = database.open_reader(db_name)
+    for sensor, last_timestamp, last_temp, windows in get_stats(conn):
+        print "[{0}] last {1} at {2}".format(sensor, last_temp, last_timestamp)
+        for name, window in windows:
+            if window.samples == 0:
+                print "    {0:>10}: no readings".format(name)
+                continue
+            print "    {0:>10}: min {1:.3f} max {2:.3f} mean {3:.3f} stddev {4:.3f} ({5} readings)".format(
+                name, window.min_temp, window.max_temp, window.mean, window.get_stddev(), window.samples)
+    conn.close()
+
+
+def create_parser():
+    parser = OptionParser(usage="stats.py [options] show|rebuild",
+                          description="Shows the per sensor statistics, or works them out again from the logged readings. "
+                                      "A rebuild holds the database's write lock until it's done, a running monitor "
+                                      "keeps (or spools) its readings meanwhile and writes them afterwards")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database", metavar="FILE")
+
+    parser.add_option("-a", "--archive-dir", dest="archive_dir", default=None,
+                      help="count the rows retention.py archived here as well", metavar="DIR")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('show', 'rebuild'):
+        parser.print_help()
+        sys.exit(-1)
+
+    if args[0] == 'rebuild':
+        archive_rows = None
+        if opts.archive_dir is not None:
+            archive_rows = retention.read_archive(opts.archive_dir)
+        conn = database.connect(opts.db_name)
+        print "{0} rows counted".format(rebuild(conn, archive_rows))
+        conn.close()
+
+    print_stats(opts.db_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+
+import datetime
+import sys
+import time
+from optparse import OptionParser
+
+import database
+import rollup
+import stats
+
+# storage.py
+# ==========
+# the readings can be kept in one of two tables:
+#
+#   Temperature        - the original format, [timestamp] as
+#                        '%Y-%m-%d %H:%M:%S' text (local time) and temp
+#                        as a float, ~40 bytes a row plus its indexes
+#   TemperatureCompact - [time] as epoch seconds and millic as integer
+#                        milli-degrees C (what the DS18B20 reports),
+#                        clustered on (sensor, time) WITHOUT ROWID so
+#                        the table is its own index, ~12 bytes a row
+#
+# Once TemperatureCompact exists the monitor writes there. migrate()
+# creates it and moves the old rows across a chunk at a time while the
+# monitor keeps running, until then the readers (chart.query_data and
+# read_readings) look in both tables.
+
+dbname = '/home/pi/sensorlog.db'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+COMPACT_TABLE = 'TemperatureCompact'
+
+TEXT_INSERT = "INSERT INTO Temperature([timestamp], temp, sensor) VALUES(?,?,?)"
+COMPACT_INSERT = "INSERT OR IGNORE INTO TemperatureCompact(sensor, [time], millic) VALUES(?,?,?)"
+
+
+def create_compact_schema(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS TemperatureCompact(sensor INTEGER NOT NULL, [time] INTEGER NOT NULL, "
+                 "millic INTEGER NOT NULL, PRIMARY KEY(sensor, [time])) WITHOUT ROWID;")
+    # the chart reads every sensor over a time range, in (time, sensor
+    # descending) order, see chart.query_data() for why descending
+    conn.execute("CREATE INDEX IF NOT EXISTS TemperatureCompactTime ON TemperatureCompact([time], sensor DESC);")
+    return
+
+
+def is_compact(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (COMPACT_TABLE,)).fetchone()
+    return row is not None
+
+
+# get_formats()
+# =============
+# which tables have readings in them, 'text' and/or 'compact'. A new
+# database with neither is 'text'.
+def get_formats(conn):
+    formats = []
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Temperature'").fetchone() is not None:
+        if conn.execute("SELECT 1 FROM Temperature LIMIT 1").fetchone() is not None:
+            formats.append('text')
+    if is_compact(conn):
+        formats.append('compact')
+    if len(formats) == 0:
+        formats.append('text')
+    return formats
+
+
+def to_epoch(timestamp):
+    return int(time.mktime(datetime.datetime.strptime(timestamp, TIME_FORMAT).timetuple()))
+
+
+def to_timestamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch).strftime(TIME_FORMAT)
+
+
+def to_millic(temp):
+    return int(round(float(temp) * 1000))
+
+
+def compact_rows(rows):
+    return [(sensor, to_epoch(timestamp), to_millic(temp)) for timestamp, temp, sensor in rows]
+
+
+# insert_rows()
+# =============
+# writes (timestamp, temp, sensor) rows, as monitor.collect_rows()
+# makes them, in whichever format the database is in. Returns the rows
+# that went in, the ones to roll up and count in the stats: the compact
+# table keeps the reading it has for a (sensor, second) and ignores
+# another one for it.
+def insert_rows(conn, rows):
+    if not is_compact(conn):
+        conn.executemany(TEXT_INSERT, rows)
+        return rows
+
+    inserted = []
+    for row, values in zip(rows, compact_rows(rows)):
+        if conn.execute(COMPACT_INSERT, values).rowcount == 1:
+            inserted.append(row)
+    return inserted
+
+
+# filter_new_rows()
+# =================
+# the (timestamp, temp, sensor) rows that aren't in the database yet,
+# going by (sensor, timestamp), and only the first of any repeats.
+# Both tables are looked in, so it works part way through a migration.
+def filter_new_rows(conn, rows):
+    lookups = []
+    for fmt in get_formats(conn):
+        if fmt == 'text':
+            lookups.append(("SELECT 1 FROM Temperature WHERE sensor = ? AND [timestamp] = ? LIMIT 1", False))
+        else:
+            lookups.append(("SELECT 1 FROM TemperatureCompact WHERE sensor = ? AND [time] = ?", True))
+
+    new_rows = []
+    seen = set()
+    for row in rows:
+        key = (row[2], row[0])
+        if key in seen:
+            continue
+        seen.add(key)
+
+        found = False
+        for sel_sql, epoch in lookups:
+            if conn.execute(sel_sql, (row[2], to_epoch(row[0]) if epoch else row[0])).fetchone() is not None:
+                found = True
+                break
+        if not found:
+            new_rows.append(row)
+
+    return new_rows
+
+
+# read_readings()
+# ===============
+# the (epoch seconds, temp C) readings of one sensor in time order,
+# from both tables, from "start" (a timestamp string) on.
+def read_readings(conn, sensor_id, start=None):
+    readings = []
+    for fmt in get_formats(conn):
+        if fmt == 'text':
+            sel_sql = "SELECT [timestamp], temp FROM Temperature WHERE sensor = ? AND [timestamp] >= ? ORDER BY [timestamp]"
+            for row in conn.execute(sel_sql, (sensor_id, start or '')):
+                readings.append((to_epoch(row[0]), float(row[1])))
+        else:
+            sel_sql = "SELECT [time], millic / 1000.0 FROM TemperatureCompact WHERE sensor = ? AND [time] >= ? ORDER BY [time]"
+            for row in conn.execute(sel_sql, (sensor_id, to_epoch(start) if start else 0)):
+                readings.append(row)
+
+    readings.sort()
+    return readings
+
+
+# uncount_rows()
+# ==============
+# takes (timestamp, temp, sensor) rows that were rolled up and counted
+# in the stats but didn't make it into the database back out again.
+# The rollup buckets they fell in are summed up again from the raw
+# rows in both tables (there are only a few of these rows), the stats
+# have them removed (stats.remove_stats()). Runs inside the caller's
+# transaction.
+def uncount_rows(conn, rows):
+    for name, table, seconds, bucket in rollup.RESOLUTIONS:
+        for sensor, start in set((row[2], bucket(row[0])) for row in rows):
+            end = (datetime.datetime.strptime(start, TIME_FORMAT) +
+                   datetime.timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+            samples, total, min_temp, max_temp = read_totals(conn, sensor, start, end)
+            if samples == 0:
+                conn.execute("DELETE FROM {0} WHERE sensor = ? AND [timestamp] = ?".format(table), (sensor, start))
+            else:
+                conn.execute("UPDATE {0} SET samples = ?, total = ?, min_temp = ?, max_temp = ? "
+                             "WHERE sensor = ? AND [timestamp] = ?".format(table),
+                             (samples, total, min_temp, max_temp, sensor, start))
+    stats.remove_stats(conn, rows)
+    return
+
+
+# read_totals()
+# =============
+# (samples, total, min, max) of one sensor's raw rows from "start" up
+# to "end" (timestamp strings), in both tables
+def read_totals(conn, sensor_id, start, end):
+    totals = [0, 0.0, None, None]
+    for fmt in get_formats(conn):
+        if fmt == 'text':
+            row = conn.execute("SELECT COUNT(temp), TOTAL(temp), MIN(temp), MAX(temp) FROM Temperature "
+                               "WHERE sensor = ? AND [timestamp] >= ? AND [timestamp] < ?",
+                               (sensor_id, start, end)).fetchone()
+        else:
+            row = conn.execute("SELECT COUNT(*), TOTAL(millic) / 1000.0, MIN(millic) / 1000.0, MAX(millic) / 1000.0 "
+                               "FROM TemperatureCompact WHERE sensor = ? AND [time] >= ? AND [time] < ?",
+                               (sensor_id, to_epoch(start), to_epoch(end))).fetchone()
+        if row[0] == 0:
+            continue
+        totals[0] += row[0]
+        totals[1] += row[1]
+        totals[2] = row[2] if totals[2] is None else min(totals[2], row[2])
+        totals[3] = row[3] if totals[3] is None else max(totals[3], row[3])
+    return tuple(totals)
+
+
+# migrate()
+# =========
+# moves an existing database to the compact format without stopping
+# the monitor. The rollups are brought up to date first (the backfill
+# reads the text rows, and takes turns with the monitor's own
+# backfill, see rollup.backfill()), then the compact table is created,
+# which is the monitor's cue to write there from its next flush. The
+# text rows are then copied and deleted "chunk_rows" at a time, each
+# chunk in its own short transaction. (sensor, time) is the compact
+# table's key, so only the first of any repeats is kept, the others
+# were rolled up and counted in the stats and are taken back out
+# (uncount_rows()). Returns the number of rows moved.
+def migrate(db_name, chunk_rows=10000, verbose=False, vacuum=False):
+    rollup.backfill(db_name, chunk_rows, verbose)
+
+    conn = database.connect(db_name)
+    with conn:
+        create_compact_schema(conn)
+
+    moved = 0
+    while True:
+        with conn:
+            rows = conn.execute("SELECT rowid, [timestamp], temp, sensor FROM Temperature ORDER BY rowid LIMIT ?",
+                                (chunk_rows,)).fetchall()
+            if len(rows) == 0:
+                break
+            # (sensor, timestamp) is the key now, the first reading wins
+            text_rows = [row[1:] for row in rows]
+            dropped = []
+            for row, values in zip(text_rows, compact_rows(text_rows)):
+                if conn.execute(COMPACT_INSERT, values).rowcount == 0:
+                    dropped.append(row)
+            conn.execute("DELETE FROM Temperature WHERE rowid <= ?", (rows[-1][0],))
+            if len(dropped) != 0:
+                uncount_rows(conn, dropped)
+
+        moved += len(rows)
+        if verbose:
+            print "{0} rows moved".format(moved)
+
+    if vacuum:
+        # gives the space back to the file system, this does hold
+        # the database for as long as it takes
+        conn.execute("VACUUM")
+
+    conn.close()
+    return moved
+
+
+def print_status(db_name):
+    conn = database.open_reader(db_name)
+    formats = get_formats(conn)
+    print "formats: {0}".format(", ".join(formats))
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Temperature'").fetchone() is not None:
+        print "text rows: {0}".format(conn.execute("SELECT COUNT(*) FROM Temperature").fetchone()[0])
+    if is_compact(conn):
+        print "compact rows: {0}".format(conn.execute("SELECT COUNT(*) FROM TemperatureCompact").fetchone()[0])
+    conn.close()
+
+
+def create_parser():
+    parser = OptionParser(usage="storage.py [options] status|migrate",
+                          description="Moves the temperature log to the compact format, the monitor can keep running")
+
+    parser.add_option("-d", "--db", dest="db_name", default=dbname,
+                      help="sqlite database to migrate", metavar="FILE")
+
+    parser.add_option("-c", "--chunk", dest="chunk_rows", default=10000, type="int",
+                      help="rows to move per transaction")
+
+    parser.add_option("--vacuum", dest="vacuum", default=False, action="store_true",
+                      help="VACUUM afterwards to shrink the file (locks the database while it runs)")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ('status', 'migrate'):
+        parser.print_help()
+        sys.exit(-1)
+
+    if args[0] == 'migrate':
+        moved = migrate(opts.db_name, opts.chunk_rows, True, opts.vacuum)
+        print "moved {0} rows to the compact format".format(moved)
+
+    print_status(opts.db_name)
+
+
+if __name__ == "__main__":
+    main()
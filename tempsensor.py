@@ -1,89 +1,339 @@
-import sqlite3
-import subprocess
+import os
+import threading
+import time
+import compression
+import database
+
+
+W1_DEVICES = '/sys/bus/w1/devices'  # where the 1-Wire bus shows its devices
+DS18B20_FAMILY = '28-'  # serial ids of temperature probes start with this
+
+
+# W1Bus
+# =====
+# where the probes are found and read. This one is the kernel's w1
+# sysfs tree, anything with the same find_devices() and read() can
+# stand in for it (see w1sim.py for a simulated fleet of probes).
+
+class W1Bus(object):
+    def __init__(self, device_root=W1_DEVICES):
+        self._device_root = device_root
+
+    def get_device_root(self):
+        return self._device_root
+
+    # find_devices()
+    # ==============
+    # the serial ids of the probes on the bus, they show up as
+    # directories like
+    #	/sys/bus/w1/devices/28-0416718527ff/w1_slave
+    #	/sys/bus/w1/devices/28-031671cc7fff/w1_slave
+    # no bus (or no probes) is an empty list
+    def find_devices(self):
+        try:
+            names = os.listdir(self._device_root)
+        except OSError:
+            return []
+
+        sensor_addresses = []
+        for name in sorted(names):
+            if not name.startswith(DS18B20_FAMILY):
+                continue
+            if os.path.exists(os.path.join(self._device_root, name, "w1_slave")):
+                sensor_addresses.append(name)
+
+        return sensor_addresses
+
+    # the text of the probe's w1_slave file, reading it blocks while
+    # the DS18B20 does its conversion (~750ms)
+    def read(self, serial_id):
+        tempfile = open(os.path.join(self._device_root, serial_id, "w1_slave"))
+        sensor_text = tempfile.read()
+        tempfile.close()
+        return sensor_text
+
+
+# parse_w1_slave()
+# ================
+# the temperature (C) from a w1_slave file, which looks like
+#	72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+#	72 01 4b 46 7f ff 0e 10 57 t=23125
+# when the driver's CRC check failed the first line ends in NO and
+# the t= value is garbage, so that is a read error.
+def parse_w1_slave(sensor_text):
+    lines = sensor_text.split("\n")
+    if not lines[0].rstrip().endswith("YES"):
+        raise IOError("crc error")
+    tempdata = lines[1].split(" ")[9]
+    return float(tempdata[2:]) / 1000
 
 
 # we track the sensors via an integer value we assign to them
 # in place of the 15-character serial id to reduce the size
 # of the database entries.
 
+# get_units()
+# ===========
+# what a sensor's readings are measured in, "C" unless its serial id
+# says otherwise. The Nest poller's "nest-<serial>-humidity" sensor
+# (nestpoller.py) logs a relative humidity, which mustn't be shown in F.
+UNIT_SUFFIXES = [('-humidity', '%')]
+
+
+def get_units(serial_id):
+    for suffix, units in UNIT_SUFFIXES:
+        if serial_id.endswith(suffix):
+            return units
+    return 'C'
+
+
 class Sensor(object):
     _sensor_id = None
     _serial_id = None
     _active = False
     _temperature = None
     _dirty_temp = True
-    _base_temp = None
+    _read_error = None
+    _read_seconds = None
+    _compressor = None
+    _points = None
+    _bus = None
+    _virtual = False
+    _units = 'C'
 
     def __init__(self, serial_id, sensor_id):
         self._sensor_id = sensor_id  # internal index to identify sensor
         self._serial_id = serial_id  # serial number of the sensor, device address
         self._active = False
-        self._base_temp = None
+        self._compressor = compression.create_compressor()
+        self._points = []  # (time, temperature) the compressor wants stored
+        self._bus = W1Bus()
+        self._units = get_units(serial_id)
 
     def get_temperature(self, farenheight=False):
-        if farenheight and self._temperature != None:
+        if farenheight and self._temperature != None and self.is_temperature():
             return (self._temperature * 1.8 + 32.0)
         return self._temperature
 
-    def set_temperature(self, temperature):
+    # the compressor decides which readings are worth logging, by default
+    # a reading has to move more than 0.2C to eliminate the noise
+    def set_compressor(self, compressor):
+        self._compressor = compressor
+
+    def get_compressor(self):
+        return self._compressor
+
+    def set_temperature(self, temperature, timestamp=None):
         if self._active == False:
             return
 
-        if self._temperature is None:
-            self._dirty_temp = True
-            self._base_temp = temperature
-
-        # okay, to eliminate the noise we will now require a 0.2C swing
-        # to consider it dirty
-        if self._temperature is not None:
-            delta_temp = abs(temperature - self._base_temp)
-            if delta_temp > 0.2:
-                self._dirty_temp = True
-                self._base_temp = temperature
-            else:
-                self._dirty_temp = False
+        if timestamp is None:
+            timestamp = time.time()
+
+        self._points.extend(self._compressor.add(timestamp, temperature))
+        self._dirty_temp = len(self._points) != 0
 
         self._temperature = temperature
         return
 
+    # take_points()
+    # =============
+    # hands over the (time, temperature) points to log. When forced we
+    # also get the latest reading even if the compressor didn't need it.
+    def take_points(self, force_logging=False):
+        if force_logging:
+            self._points.extend(self._compressor.flush())
+
+        points = self._points
+        self._points = []
+        self._dirty_temp = False
+        return points
+
     def get_dirty_temp(self):
         return self._dirty_temp
 
-    def read_temperature(self):
+    # read the probe and return the temperature (C), this blocks
+    # while the DS18B20 does its conversion (~750ms)
+    def read_device(self):
+        return parse_w1_slave(self._bus.read(self._serial_id))
+
+    def read_temperature(self, timestamp=None):
         if self._active == False:
             return
 
-        sensor_dev = "/sys/bus/w1/devices/{0}/w1_slave".format(self._serial_id)
-        tempfile = open(sensor_dev)
-        sensor_text = tempfile.read()
-        tempfile.close()
-        tempdata = sensor_text.split("\n")[1].split(" ")[9]
-        self.set_temperature(float(tempdata[2:]) / 1000)
+        self.set_temperature(self.read_device(), timestamp)
 
         return
 
+    def get_read_error(self):
+        return self._read_error
+
+    # how long the last read that finished took, None if it never did
+    def get_read_seconds(self):
+        return self._read_seconds
+
+    def set_bus(self, bus):
+        self._bus = bus
+
     def get_serial_id(self):
         return self._serial_id
 
+    # what the chart calls the sensor, the probe's serial without the
+    # family code (after the node, "kitchen/0416718527ff", in the
+    # collector's database)
+    def get_label(self):
+        node, slash, serial_id = self._serial_id.rpartition('/')
+        if serial_id.startswith(DS18B20_FAMILY):
+            serial_id = serial_id[len(DS18B20_FAMILY):]
+        return node + slash + serial_id
+
+    # a virtual sensor isn't on the bus, something else (the Nest
+    # poller, say) sets its readings with set_temperature()
+    def is_virtual(self):
+        return self._virtual
+
+    def get_units(self):
+        return self._units
+
+    # only temperatures are converted to F for display
+    def is_temperature(self):
+        return self._units == 'C'
+
     def get_ensor_id(self):
         return self._sensor_id
 
 
+# thread body for concurrent reads, results are handed back
+# as (temperature, error, seconds taken) keyed on the sensor id
+def _read_device(sensor, results):
+    started = time.time()
+    try:
+        temperature = sensor.read_device()
+        results[sensor._sensor_id] = (temperature, None, time.time() - started)
+    except Exception as e:
+        results[sensor._sensor_id] = (None, str(e) or e.__class__.__name__, time.time() - started)
+
+
 class SensorsMgr:
     _db_name = ""  # stash our database name here
     _SensorList = []
+    _pending_reads = {}  # sensor_id -> reader thread that hasn't finished
+    _compression_mode = compression.DEFAULT_MODE
+    _tolerance = compression.DEFAULT_TOLERANCE
+    _sensor_tolerances = {}  # serial_id -> tolerance for that sensor
+    _bus = None
 
     def get_sensor_list(self):
         return self._SensorList
 
-    def read_sensors(self):
+    # the sensors on the 1-Wire bus, leaving out the virtual ones
+    def get_probe_list(self):
+        return [sensor for sensor in self._SensorList if not sensor._virtual]
+
+    # read_sensors()
+    # ==============
+    # with no timeout the sensors are read one after another. With
+    # a timeout (seconds) each active sensor is read on its own
+    # thread so the cycle takes as long as the slowest probe, and a
+    # probe that hasn't answered by then is reported rather than
+    # holding up the rest. Returns {sensor_id: reason} for the
+    # sensors we couldn't read. "sensors" limits the read to some of
+    # our sensors, by default we read all of them.
+    def read_sensors(self, timeout=None, sensors=None):
+        if sensors is None:
+            sensors = self._SensorList
+
+        if timeout is None:
+            timestamp = time.time()  # one timestamp for the whole cycle
+            failures = {}
+            for sensor in sensors:
+                if sensor._active == False or sensor._virtual:
+                    continue
+                started = time.time()
+                try:
+                    sensor.read_temperature(timestamp)
+                    sensor._read_error = None
+                except Exception as e:
+                    sensor._read_error = str(e) or e.__class__.__name__
+                    failures[sensor._sensor_id] = sensor._read_error
+                sensor._read_seconds = time.time() - started
+            return failures
+
+        return self.read_sensors_concurrent(timeout, sensors)
+
+    def read_sensors_concurrent(self, timeout, sensors=None):
+        if sensors is None:
+            sensors = self._SensorList
+
+        timestamp = time.time()  # one timestamp for the whole cycle
+        failures = {}
+        results = {}
+        readers = []
+        for sensor in sensors:
+            if sensor._active == False or sensor._virtual:
+                continue
+
+            # a probe that hung on a previous cycle still has its reader
+            # running, don't pile up another thread behind it
+            reader = self._pending_reads.get(sensor._sensor_id)
+            if reader is not None and reader.is_alive():
+                sensor._read_error = "busy"
+                failures[sensor._sensor_id] = sensor._read_error
+                continue
+
+            reader = threading.Thread(target=_read_device, args=(sensor, results))
+            reader.daemon = True
+            reader.start()
+            self._pending_reads[sensor._sensor_id] = reader
+            readers.append((sensor, reader))
+
+        deadline = time.time() + timeout
+        for sensor, reader in readers:
+            reader.join(max(0.0, deadline - time.time()))
+            if reader.is_alive():
+                sensor._read_error = "timeout"
+                failures[sensor._sensor_id] = sensor._read_error
+                continue
+
+            del self._pending_reads[sensor._sensor_id]
+            temperature, error, sensor._read_seconds = results[sensor._sensor_id]
+            sensor._read_error = error
+            if error is not None:
+                failures[sensor._sensor_id] = error
+                continue
+
+            sensor.set_temperature(temperature, timestamp)
+
+        return failures
+
+    # "device_root" is where to look for the probes, so we can be
+    # pointed at a fake sysfs tree, or "bus" replaces the sysfs tree
+    # altogether (a W1Bus look-alike)
+    def __init__(self, db_name, device_root=W1_DEVICES, bus=None):
+        self._db_name = db_name
+        self._bus = bus or W1Bus(device_root)
+        self._SensorList = []
+        self._pending_reads = {}
+        self._sensor_tolerances = {}
+
+    # set_compression()
+    # =================
+    # how readings are thinned out before they are logged (see
+    # compression.py), "sensor_tolerances" overrides the tolerance
+    # for individual sensors by serial id.
+    def set_compression(self, mode, tolerance, sensor_tolerances=None):
+        self._compression_mode = mode
+        self._tolerance = tolerance
+        self._sensor_tolerances = dict(sensor_tolerances or {})
         for sensor in self._SensorList:
-            sensor.read_temperature()
+            self.configure_sensor(sensor)
         return
 
-    def __init__(self, db_name):
-        self._db_name = db_name
-        self._SensorList = []
+    def configure_sensor(self, sensor):
+        tolerance = self._sensor_tolerances.get(sensor.get_serial_id(), self._tolerance)
+        sensor.set_compressor(compression.create_compressor(self._compression_mode, tolerance))
+        sensor.set_bus(self._bus)
+        return sensor
 
     def get_sensor_by_index(self, idx):
         for sensor in self._SensorList:
@@ -96,7 +346,7 @@ class SensorsMgr:
         if self._db_name is None:
             return False
 
-        conn = sqlite3.connect(self._db_name)
+        conn = database.connect(self._db_name)
         conn.execute(
             "CREATE TABLE IF NOT EXISTS Sensor(sensor_id INTEGER PRIMARY KEY AUTOINCREMENT, [timestamp] TIMESTAMP DEFAULT CURRENT_TIMESTAMP, serial_id TEXT UNIQUE NOT NULL);")
         conn.commit()
@@ -104,12 +354,14 @@ class SensorsMgr:
 
         return True
 
-    # we found a new sensor, write it to the table
-    def log_sensor(self, serial_id):
+    # we found a new sensor, write it to the table. A "virtual" one is
+    # marked before it goes in the list, so the sampler never sees it
+    # as a probe to read off the bus.
+    def log_sensor(self, serial_id, virtual=False):
         if self._db_name is None:
             return False
 
-        conn = sqlite3.connect(self._db_name)
+        conn = database.connect(self._db_name)
         curs = conn.cursor()
 
         ins_sql = "INSERT INTO Sensor (serial_id) VALUES(?)"
@@ -128,18 +380,36 @@ class SensorsMgr:
         sensor_id = row[0]
 
         # we can now add this to our internal list of sensors
-        sensor = Sensor(serial_id, sensor_id)
+        sensor = self.configure_sensor(Sensor(serial_id, sensor_id))
+        sensor._virtual = virtual
         sensor._active = True  # we are adding a newly found sensor, so activate it
         self._SensorList.append(sensor)
 
         return True
 
+    # add_virtual_sensor()
+    # ====================
+    # a sensor whose readings come from somewhere other than the bus,
+    # registered in the Sensor table like a probe (log_sensor()) the
+    # first time we see it. Returns the Sensor.
+    def add_virtual_sensor(self, serial_id):
+        pos = self.sensor_in_list(serial_id)
+        if pos < 0:
+            if not self.log_sensor(serial_id, virtual=True):
+                return None
+            pos = self.sensor_in_list(serial_id)
+
+        sensor = self._SensorList[pos]
+        sensor._virtual = True
+        sensor._active = True
+        return sensor
+
     # read in all the sensors we know about
     def read_sensors_from_db(self):
         if self._db_name is None:
             return False
 
-        conn = sqlite3.connect(self._db_name)
+        conn = database.open_reader(self._db_name)
         curs = conn.cursor()
         sel_sql = "SELECT [timestamp], serial_id, sensor_id from Sensor"
         curs.execute(sel_sql)
@@ -149,29 +419,18 @@ class SensorsMgr:
         for row in all_rows:
             serial_id = row[1]
             sensor_id = row[2]
-            new_sensor = Sensor(serial_id, sensor_id)
+            new_sensor = self.configure_sensor(Sensor(serial_id, sensor_id))
             new_sensor._active = False  # not active until we see it in the wild!
             self._SensorList.append(new_sensor)
 
         return True
 
 
+    # find_sensors()
+    # ==============
+    # the serial ids of the probes on the bus
     def find_sensors(self):
-        # get list of devices
-        s = subprocess.check_output('ls /sys/bus/w1/devices/28-*/w1_slave', shell=True).strip()
-        # we have something that looks like this:
-        #	/sys/bus/w1/devices/28-0416718527ff/w1_slave
-        #	/sys/bus/w1/devices/28-031671cc7fff/w1_slave
-        # So we need to pull out these lines
-        #
-
-        lines = s.decode("utf-8").split('\n')  # separate the lines
-        sensor_addresses = []
-        for line in lines:
-            parts = line.split('/')
-            sensor_addresses.append(parts[5])
-
-        return sensor_addresses
+        return self._bus.find_devices()
 
     def sensor_in_list(self, serial_id):
         for i in range(len(self._SensorList)):
@@ -192,8 +451,29 @@ class SensorsMgr:
             else:
                 self._SensorList[pos]._active = True  # if sensor is present on bus, activate it
 
+        # and anything that has gone from the bus is no longer active
+        for sensor in self._SensorList:
+            if sensor._serial_id not in active_sensors and not sensor._virtual:
+                sensor._active = False
+
         return True
 
+    # rescan_sensors()
+    # ================
+    # looks at the bus again and brings our list up to date, returns
+    # the serial ids of the sensors that (re)appeared and the sensors
+    # that have gone away.
+    def rescan_sensors(self):
+        active_sensors = self.find_sensors()
+        was_active = set(sensor._serial_id for sensor in self._SensorList if sensor._active)
+
+        vanished = [sensor for sensor in self._SensorList
+                    if sensor._active and not sensor._virtual and sensor._serial_id not in active_sensors]
+        self.update_sensor_list(active_sensors)
+
+        appeared = [serial_id for serial_id in active_sensors if serial_id not in was_active]
+        return appeared, vanished
+
     def initialize_sensors(self):
         self.create_sensor_schema()  # make sure the schema is created
         self.read_sensors_from_db()  # get sensors we know about
@@ -0,0 +1,56 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the tree, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import monitor
+import storage
+import tempsensor
+
+START = datetime.datetime(2016, 1, 1)
+
+
+# the timestamp "seconds" after START, as monitor.py writes them
+def timestamp(seconds):
+    return (START + datetime.timedelta(seconds=seconds)).strftime(storage.TIME_FORMAT)
+
+
+# (timestamp, temp, sensor) rows, "count" readings from each of
+# "sensors" a "period" apart
+def make_rows(count, sensors=2, period=30, temp=20.0):
+    return [(timestamp(i * period), temp + (i % 7) * 0.25, sensor)
+            for i in range(count) for sensor in range(1, sensors + 1)]
+
+
+# a database with the text Temperature table as the baseline made it,
+# before the rollups and stats existed
+def make_text_log(db_name, rows):
+    conn = database.connect(db_name)
+    conn.execute("CREATE TABLE Temperature([timestamp] TIMESTAMP, temp NUMERIC, sensor INTEGER);")
+    conn.executemany("INSERT INTO Temperature([timestamp], temp, sensor) VALUES(?,?,?)", rows)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def db_name(tmpdir):
+    return str(tmpdir.join("sensorlog.db"))
+
+
+@pytest.fixture
+def log_db(db_name):
+    monitor.create_log_schema(db_name)
+    tempsensor.SensorsMgr(db_name).create_sensor_schema()
+    return db_name
+
+
+@pytest.fixture
+def compact_db(db_name):
+    monitor.create_log_schema(db_name, True)
+    tempsensor.SensorsMgr(db_name).create_sensor_schema()
+    return db_name
@@ -0,0 +1,82 @@
+import pytest
+
+import database
+import export
+import stats
+import storage
+from conftest import make_rows
+
+SERIALS = {1: u'28-0416718527ff', 2: u'kitchen/28-000000000002'}
+
+
+def fill(db_name, rows):
+    conn = database.connect(db_name)
+    with conn:
+        for sensor_id, serial_id in sorted(SERIALS.items()):
+            conn.execute("INSERT INTO Sensor(sensor_id, serial_id) VALUES(?,?)", (sensor_id, serial_id))
+        storage.insert_rows(conn, rows)
+    conn.close()
+
+
+def read_back(db_name):
+    conn = database.connect(db_name)
+    serials = dict(conn.execute("SELECT sensor_id, serial_id FROM Sensor"))
+    readings = [(storage.to_timestamp(epoch), round(temp, 3), serials[sensor])
+                for sensor, epoch, temp in conn.execute("SELECT sensor, [time], millic / 1000.0 FROM TemperatureCompact")]
+    conn.close()
+    return sorted(readings)
+
+
+@pytest.mark.parametrize("file_name", ["out.csv", "out.ndjson.gz", "out.bin", "out.bin.gz"])
+def test_round_trip(compact_db, tmpdir, file_name):
+    rows = make_rows(700)
+    fill(compact_db, rows)
+    out_name = str(tmpdir.join(file_name))
+    assert export.export(compact_db, out_name, chunk_rows=250) == len(rows)
+
+    copy = str(tmpdir.join("copy.db"))
+    assert export.import_file(copy, out_name, chunk_rows=300, compact=True) == (len(rows), len(rows))
+    assert read_back(copy) == sorted((timestamp, temp, SERIALS[sensor]) for timestamp, temp, sensor in rows)
+
+    conn = database.connect(copy)
+    assert conn.execute("SELECT SUM(samples) FROM TemperatureDay").fetchone()[0] == len(rows)
+    assert sum(windows[-1][1].samples for sensor, ts, temp, windows in stats.get_stats(conn)) == len(rows)
+
+
+def test_importing_twice_adds_nothing(compact_db, tmpdir):
+    rows = make_rows(100)
+    fill(compact_db, rows)
+    out_name = str(tmpdir.join("out.csv"))
+    export.export(compact_db, out_name)
+
+    copy = str(tmpdir.join("copy.db"))
+    export.import_file(copy, out_name, compact=True)
+    assert export.import_file(copy, out_name, compact=True) == (len(rows), 0)
+    assert len(read_back(copy)) == len(rows)
+
+
+def test_export_a_range_of_one_sensor(compact_db, tmpdir):
+    rows = make_rows(200)
+    fill(compact_db, rows)
+    out_name = str(tmpdir.join("out.ndjson"))
+    start, end = rows[20][0], rows[100][0]
+    exported = export.export(compact_db, out_name, start=start, end=end, serial_ids=[SERIALS[2]])
+
+    with open(out_name, "rb") as in_file:
+        readings = list(export.read_ndjson(in_file))
+    assert exported == len(readings)
+    assert set(serial_id for timestamp, temp, serial_id in readings) == set([SERIALS[2]])
+    assert readings[0][0] >= start and readings[-1][0] <= end
+
+
+def test_a_truncated_binary_file_is_an_error(compact_db, tmpdir):
+    fill(compact_db, make_rows(50))
+    out_name = str(tmpdir.join("out.bin"))
+    export.export(compact_db, out_name)
+    with open(out_name, "rb") as in_file:
+        data = in_file.read()
+    with open(out_name, "wb") as out_file:
+        out_file.write(data[:-3])
+
+    with pytest.raises(ValueError):
+        export.import_file(str(tmpdir.join("copy.db")), out_name, compact=True)
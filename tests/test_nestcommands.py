@@ -0,0 +1,161 @@
+import threading
+import time
+
+import nest
+import nestcommands
+
+SERIAL = '01AA01AB43130AB1'
+
+
+# FakeNest
+# ========
+# the parts of nest.Nest the queue uses. A put takes effect straight
+# away unless "errors" has an error to raise for it first, "gate" holds
+# the first put up until it's set.
+class FakeNest(object):
+    def __init__(self):
+        self.serial = SERIAL
+        self.target = 20.0
+        self.fan = 'auto'
+        self.status = None
+        self.status_time = 0
+        self.puts = []
+        self.errors = []
+        self.gate = None
+        self.entered = threading.Event()
+
+    def login(self):
+        pass
+
+    def temp_in(self, temp):
+        return temp
+
+    def get_status(self, max_age=None):
+        self.status = {"shared": {SERIAL: {"target_temperature": self.target, "target_change_pending": False}},
+                       "device": {SERIAL: {"fan_mode": self.fan}}}
+        self.status_time = time.time()
+        return self.status
+
+    def put(self, kind, value):
+        self.puts.append((kind, value))
+        self.status = None
+        if self.gate is not None and not self.entered.is_set():
+            self.entered.set()
+            self.gate.wait(5)
+        if len(self.errors) != 0:
+            raise self.errors.pop(0)
+        if kind == 'temperature':
+            self.target = value
+        else:
+            self.fan = value
+
+    def put_temperature(self, temp):
+        self.put('temperature', temp)
+
+    def put_fan(self, state):
+        self.put('fan', state)
+
+
+def make_queue(thermostat, **kwargs):
+    options = dict(rate=1000.0, burst=100, backoff=0.01, max_backoff=0.05, confirm_interval=0.01, confirm_seconds=1.0)
+    options.update(kwargs)
+    return nestcommands.CommandQueue(thermostat, **options)
+
+
+def test_a_change_is_sent_and_confirmed():
+    thermostat = FakeNest()
+    commands = make_queue(thermostat)
+    try:
+        handle = commands.set_temperature(21.5)
+        assert handle.wait(5)
+        assert handle.state == 'confirmed'
+        assert thermostat.puts == [('temperature', 21.5)]
+    finally:
+        commands.close()
+
+
+def test_waiting_changes_are_replaced_by_newer_ones():
+    thermostat = FakeNest()
+    thermostat.gate = threading.Event()
+    commands = make_queue(thermostat)
+    try:
+        first = commands.set_temperature(18.0)
+        assert thermostat.entered.wait(5)
+        later = [commands.set_temperature(temp) for temp in (19.0, 20.5, 22.0)]
+        fan = commands.set_fan('on')
+        thermostat.gate.set()
+
+        assert later[-1].wait(5) and fan.wait(5)
+        assert [handle.state for handle in later] == ['superseded', 'superseded', 'confirmed']
+        assert first.state == 'superseded'
+        assert thermostat.puts == [('temperature', 18.0), ('temperature', 22.0), ('fan', 'on')]
+        assert commands.coalesced == 3
+    finally:
+        commands.close()
+
+
+def test_a_4xx_fails_straight_away():
+    thermostat = FakeNest()
+    thermostat.errors = [nest.NestError(400, "Bad Request")]
+    commands = make_queue(thermostat)
+    try:
+        handle = commands.set_temperature(21.0)
+        assert not handle.wait(5)
+        assert handle.state == 'failed'
+        assert handle.attempts == 1
+        assert thermostat.puts == [('temperature', 21.0)]
+    finally:
+        commands.close()
+
+
+def test_a_5xx_is_tried_again():
+    thermostat = FakeNest()
+    thermostat.errors = [nest.NestError(503, "Service Unavailable"), nest.NestError(429, "Too Many Requests")]
+    commands = make_queue(thermostat)
+    try:
+        handle = commands.set_temperature(21.0)
+        assert handle.wait(5)
+        assert handle.attempts == 3
+    finally:
+        commands.close()
+
+
+def test_retries_give_up_in_the_end():
+    thermostat = FakeNest()
+    thermostat.errors = [nest.NestError(503, "Service Unavailable")] * 10
+    commands = make_queue(thermostat, retries=2)
+    try:
+        handle = commands.set_fan('on')
+        assert not handle.wait(5)
+        assert handle.state == 'failed'
+        assert handle.attempts == 3
+    finally:
+        commands.close()
+
+
+def test_a_superseded_change_stays_superseded_when_its_put_fails():
+    thermostat = FakeNest()
+    thermostat.gate = threading.Event()
+    thermostat.errors = [nest.NestError(400, "Bad Request")]
+    commands = make_queue(thermostat)
+    try:
+        first = commands.set_temperature(18.0)
+        assert thermostat.entered.wait(5)
+        second = commands.set_temperature(19.0)
+        thermostat.gate.set()
+
+        assert second.wait(5)
+        assert first.state == 'superseded'
+        assert first.done()
+    finally:
+        commands.close()
+
+
+def test_close_cancels_what_is_left():
+    thermostat = FakeNest()
+    commands = make_queue(thermostat, rate=0.001, burst=0)
+    handle = commands.set_temperature(21.0)
+    commands.close()
+    assert handle.state == 'cancelled'
+    assert commands.set_fan('on').state == 'cancelled'
+    assert thermostat.puts == []
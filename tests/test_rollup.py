@@ -0,0 +1,82 @@
+import threading
+
+import database
+import rollup
+from conftest import make_rows, make_text_log
+
+
+def get_totals(db_name, table='TemperatureDay'):
+    conn = database.connect(db_name)
+    totals = conn.execute("SELECT SUM(samples), SUM(total), MIN(min_temp), MAX(max_temp) FROM {0}".format(table)).fetchone()
+    conn.close()
+    return totals
+
+
+def test_backfill_rolls_up_every_row(db_name):
+    rows = make_rows(1000)
+    make_text_log(db_name, rows)
+
+    assert rollup.backfill(db_name, chunk_rows=300) == len(rows)
+    for name, table, seconds, bucket in rollup.RESOLUTIONS:
+        samples, total, min_temp, max_temp = get_totals(db_name, table)
+        assert samples == len(rows)
+        assert total == sum(row[1] for row in rows)
+        assert min_temp == min(row[1] for row in rows)
+        assert max_temp == max(row[1] for row in rows)
+
+
+def test_backfill_again_does_nothing(db_name):
+    rows = make_rows(500)
+    make_text_log(db_name, rows)
+
+    rollup.backfill(db_name, chunk_rows=300)
+    assert rollup.backfill(db_name, chunk_rows=300) == 0
+    assert get_totals(db_name)[0] == len(rows)
+
+
+def test_backfill_carries_on_where_it_stopped(db_name):
+    rows = make_rows(500)
+    make_text_log(db_name, rows)
+
+    assert rollup.backfill(db_name, chunk_rows=100, max_chunks=2) == 200
+    assert get_totals(db_name)[0] == 200
+    assert rollup.backfill(db_name, chunk_rows=100) == len(rows) - 200
+    assert get_totals(db_name)[0] == len(rows)
+
+
+def test_rows_after_the_rollups_are_left_to_the_writer(db_name):
+    make_text_log(db_name, make_rows(100))
+    rollup.backfill(db_name)
+
+    conn = database.connect(db_name)
+    conn.execute("INSERT INTO Temperature([timestamp], temp, sensor) VALUES('2016-02-01 00:00:00', 20.0, 1)")
+    conn.commit()
+    conn.close()
+
+    assert rollup.backfill(db_name) == 0
+
+
+def test_overlapping_backfills_count_each_row_once(db_name):
+    rows = make_rows(20000)
+    make_text_log(db_name, rows)
+
+    def one_chunk_at_a_time():
+        for i in range(50):
+            rollup.backfill(db_name, chunk_rows=500, max_chunks=1)
+
+    threads = [threading.Thread(target=rollup.backfill, args=(db_name, 2000)),
+               threading.Thread(target=one_chunk_at_a_time)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rollup.backfill(db_name)
+
+    assert get_totals(db_name)[0] == len(rows)
+    assert get_totals(db_name, 'TemperatureMinute')[0] == len(rows)
+
+
+def test_pick_resolution():
+    assert rollup.pick_resolution(60 * 60, 600) is None
+    assert rollup.pick_resolution(7 * 24 * 60 * 60, 600) == 'minute'
+    assert rollup.pick_resolution(365 * 24 * 60 * 60, 600) == 'hour'
@@ -0,0 +1,59 @@
+import os
+
+import database
+import spool
+import stats
+from conftest import make_rows
+
+
+def test_pack_and_unpack():
+    row = make_rows(1)[0]
+    assert spool.unpack_row(spool.pack_row(row)) == row
+
+    damaged = bytearray(spool.pack_row(row))
+    damaged[8] ^= 0xFF
+    assert spool.unpack_row(bytes(damaged)) is None
+
+
+def test_replay_writes_the_rows_in_order_and_empties_the_spool(compact_db, tmpdir):
+    rows = make_rows(50)
+    queue = spool.Spool(str(tmpdir.join("sensorlog.db.spool")))
+    queue.append(rows[:40])
+    queue.append(rows[40:])
+    assert list(queue.read_rows()) == rows
+
+    conn = database.connect(compact_db)
+    assert queue.replay(conn, chunk_rows=30) == len(rows)
+    assert not queue.has_records()
+    assert list(queue.read_rows()) == []
+    assert conn.execute("SELECT COUNT(*) FROM TemperatureCompact").fetchone()[0] == len(rows)
+    assert conn.execute("SELECT SUM(samples) FROM TemperatureDay").fetchone()[0] == len(rows)
+
+
+def test_replay_skips_rows_already_written(log_db, tmpdir):
+    rows = make_rows(20)
+    conn = database.connect(log_db)
+    spool.Spool(str(tmpdir.join("first.spool"))).append(rows[:10])
+    spool.Spool(str(tmpdir.join("first.spool"))).replay(conn)
+
+    queue = spool.Spool(str(tmpdir.join("second.spool")))
+    queue.append(rows)   # an interrupted replay leaves the first ones behind
+    assert queue.replay(conn) == len(rows) - 10
+    assert queue.duplicates == 10
+    assert conn.execute("SELECT COUNT(*) FROM Temperature").fetchone()[0] == len(rows)
+    assert sum(windows[-1][1].samples for sensor, ts, temp, windows in stats.get_stats(conn)) == len(rows)
+
+
+def test_a_torn_record_is_dropped(tmpdir):
+    rows = make_rows(5)
+    name = str(tmpdir.join("torn.spool"))
+    queue = spool.Spool(name)
+    queue.append(rows[:3])
+    with open(name, "ab") as spool_file:
+        spool_file.write(spool.pack_row(rows[3])[:7])   # cut short by a power cut
+
+    queue = spool.Spool(name)
+    assert list(queue.read_rows()) == rows[:3]
+    queue.append(rows[3:])
+    assert list(queue.read_rows()) == rows
+    assert os.path.getsize(name) == len(rows) * spool.RECORD.size
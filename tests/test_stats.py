@@ -0,0 +1,83 @@
+import math
+import random
+
+import database
+import stats
+import storage
+from conftest import make_rows
+
+
+def accumulate(temps):
+    acc = stats.Accumulator()
+    for temp in temps:
+        acc.add(temp)
+    return acc
+
+
+def assert_same(acc, other):
+    assert acc.samples == other.samples
+    assert abs(acc.mean - other.mean) < 1e-9
+    assert abs(acc.m2 - other.m2) < 1e-6
+    assert acc.min_temp == other.min_temp
+    assert acc.max_temp == other.max_temp
+
+
+def test_add():
+    temps = [20.0, 21.5, 19.25, 22.0]
+    acc = accumulate(temps)
+    mean = sum(temps) / len(temps)
+    assert acc.samples == 4
+    assert abs(acc.mean - mean) < 1e-12
+    assert abs(acc.get_stddev() - math.sqrt(sum((temp - mean) ** 2 for temp in temps) / len(temps))) < 1e-12
+    assert (acc.min_temp, acc.max_temp) == (19.25, 22.0)
+
+
+def test_merge_is_the_same_as_adding_them_all():
+    rng = random.Random(1)
+    temps = [20.0 + rng.random() * 5 for i in range(1000)]
+    merged = stats.Accumulator()
+    for i in range(0, len(temps), 137):
+        merged.merge(accumulate(temps[i:i + 137]))
+    assert_same(merged, accumulate(temps))
+
+
+def test_merge_with_nothing():
+    acc = accumulate([20.0, 21.0])
+    acc.merge(stats.Accumulator())
+    assert_same(acc, accumulate([20.0, 21.0]))
+
+    empty = stats.Accumulator()
+    empty.merge(accumulate([20.0, 21.0]))
+    assert_same(empty, accumulate([20.0, 21.0]))
+
+
+def test_remove_takes_back_an_add():
+    acc = accumulate([20.0, 21.5, 19.25, 22.0])
+    acc.remove(21.5)
+    expected = accumulate([20.0, 19.25, 22.0])
+    assert acc.samples == expected.samples
+    assert abs(acc.mean - expected.mean) < 1e-12
+    assert abs(acc.m2 - expected.m2) < 1e-9
+
+    acc = accumulate([20.0])
+    acc.remove(20.0)
+    assert (acc.samples, acc.mean, acc.m2, acc.get_stddev()) == (0, 0.0, 0.0, None)
+
+
+def test_rebuild_matches_the_running_stats(compact_db):
+    conn = database.connect(compact_db)
+    rows = make_rows(2000, sensors=3)
+    with conn:
+        storage.insert_rows(conn, rows)
+    for i in range(0, len(rows), 500):
+        with conn:
+            stats.update_stats(conn, rows[i:i + 500])
+    running = stats.get_stats(conn)
+
+    assert stats.rebuild(conn, chunk_rows=700) == len(rows)
+    rebuilt = stats.get_stats(conn)
+
+    assert len(running) == len(rebuilt) == 3
+    for (sensor, last_timestamp, last_temp, windows), rebuilt_sensor in zip(running, rebuilt):
+        assert (sensor, last_timestamp, last_temp) == rebuilt_sensor[:3]
+        assert_same(windows[-1][1], rebuilt_sensor[3][-1][1])
@@ -0,0 +1,93 @@
+import database
+import monitor
+import rollup
+import stats
+import storage
+from conftest import make_rows, make_text_log, timestamp
+
+
+def write(conn, rows):
+    with conn:
+        inserted = storage.insert_rows(conn, rows)
+        rollup.update_rollups(conn, inserted)
+        stats.update_stats(conn, inserted)
+    return inserted
+
+
+def count_rows(conn, table):
+    return conn.execute("SELECT COUNT(*) FROM {0}".format(table)).fetchone()[0]
+
+
+def test_compact_round_trip():
+    row = (timestamp(0), 21.437, 3)
+    compact = storage.compact_rows([row])[0]
+    assert compact == (3, storage.to_epoch(row[0]), 21437)
+    assert storage.to_timestamp(compact[1]) == row[0]
+
+
+def test_text_insert_keeps_every_row(log_db):
+    conn = database.connect(log_db)
+    rows = [(timestamp(0), 20.0, 1), (timestamp(0), 20.5, 1)]
+    assert write(conn, rows) == rows
+    assert count_rows(conn, "Temperature") == 2
+
+
+def test_compact_insert_keeps_the_first_reading(compact_db):
+    conn = database.connect(compact_db)
+    assert write(conn, [(timestamp(0), 20.0, 1), (timestamp(0), 22.0, 1), (timestamp(1), 21.0, 1)]) == \
+        [(timestamp(0), 20.0, 1), (timestamp(1), 21.0, 1)]
+    assert write(conn, [(timestamp(0), 25.0, 1)]) == []
+
+    assert conn.execute("SELECT millic FROM TemperatureCompact WHERE [time] = ?",
+                        (storage.to_epoch(timestamp(0)),)).fetchone()[0] == 20000
+    assert conn.execute("SELECT samples, total FROM TemperatureMinute").fetchone() == (2, 41)
+    assert stats.get_stats(conn)[0][3][-1][1].samples == 2
+
+
+def test_filter_new_rows(compact_db):
+    conn = database.connect(compact_db)
+    write(conn, [(timestamp(0), 20.0, 1)])
+    rows = [(timestamp(0), 20.0, 1), (timestamp(0), 20.0, 2), (timestamp(1), 20.0, 1), (timestamp(1), 20.5, 1)]
+    assert storage.filter_new_rows(conn, rows) == [(timestamp(0), 20.0, 2), (timestamp(1), 20.0, 1)]
+
+
+def test_migrate_moves_every_row(db_name):
+    rows = make_rows(1000)
+    make_text_log(db_name, rows)
+    monitor.create_log_schema(db_name)
+
+    assert storage.migrate(db_name, chunk_rows=300) == len(rows)
+
+    conn = database.connect(db_name)
+    assert storage.get_formats(conn) == ['compact']
+    assert count_rows(conn, "TemperatureCompact") == len(rows)
+    assert storage.read_readings(conn, 1) == [(storage.to_epoch(row[0]), row[1]) for row in rows if row[2] == 1]
+    assert conn.execute("SELECT SUM(samples) FROM TemperatureDay").fetchone()[0] == len(rows)
+
+
+def test_migrate_takes_dropped_repeats_back_out(db_name):
+    rows = make_rows(300)
+    repeats = [(rows[10][0], 99.0, rows[10][2]), rows[20]]
+    make_text_log(db_name, rows + repeats)
+    monitor.create_log_schema(db_name)   # the stats count the repeats
+
+    conn = database.connect(db_name)
+    late = [(timestamp(100000), 21.0, 1), (timestamp(100000), 30.0, 1)]   # logged after the rollups
+    write(conn, late)
+
+    storage.migrate(db_name, chunk_rows=50)
+
+    kept = len(rows) + 1
+    for name, table, seconds, bucket in rollup.RESOLUTIONS:
+        assert conn.execute("SELECT SUM(samples), MAX(max_temp) FROM {0}".format(table)).fetchone() == (kept, 21.5)
+    counted = [(sensor, windows[-1][1].get_values()[:3]) for sensor, last_timestamp, last_temp, windows
+               in stats.get_stats(conn)]
+
+    stats.rebuild(conn)
+    rebuilt = [(sensor, windows[-1][1].get_values()[:3]) for sensor, last_timestamp, last_temp, windows
+               in stats.get_stats(conn)]
+    assert [sensor for sensor, values in counted] == [1, 2]
+    for (sensor, values), (rebuilt_sensor, rebuilt_values) in zip(counted, rebuilt):
+        assert values[0] == rebuilt_values[0]
+        assert abs(values[1] - rebuilt_values[1]) < 1e-9
+        assert abs(values[2] - rebuilt_values[2]) < 1e-6
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import tempsensor
+
+# w1sim.py
+# ========
+# a pretend 1-Wire bus so the monitor can be run (and timed) without
+# a drawer full of DS18B20s. The probes live in a directory laid out
+# like /sys/bus/w1/devices, each with a w1_slave file in the format
+# the kernel driver writes, scratchpad bytes, CRC and all. Every probe
+# has its own:
+#
+#   latency - how long a read blocks, the DS18B20 takes ~750ms to do
+#             a 12-bit conversion
+#   noise   - standard deviation (C) of the reading
+#   drift   - C per hour the probe wanders off by
+#   crc     - the chance a read comes back with a failed CRC
+#
+# SimulatedBus is a tempsensor.W1Bus so SensorsMgr can use it as is,
+# or run this as a script to keep a tree up to date for a monitor in
+# another process (--w1-devices).
+
+DEFAULT_LATENCY = 0.75  # seconds
+DEFAULT_NOISE = 0.05  # C
+SERIAL_BASE = 0x0416718527ff
+
+
+# crc8()
+# ======
+# the Dallas/Maxim 1-Wire CRC (x^8 + x^5 + x^4 + 1) over a list of
+# bytes, the 9th scratchpad byte is this over the first 8.
+def crc8(data):
+    crc = 0
+    for byte in data:
+        for i in range(8):
+            mix = (crc ^ byte) & 0x01
+            crc >>= 1
+            if mix:
+                crc ^= 0x8C
+            byte >>= 1
+    return crc
+
+
+# format_w1_slave()
+# =================
+# the two lines the w1_therm driver gives for a reading of
+# "temperature" (C), rounded to the DS18B20's 1/16C steps. With
+# "crc_error" a bit of the scratchpad is flipped on the way in,
+# so the check fails and the first line ends in NO.
+def format_w1_slave(temperature, crc_error=False, rng=random):
+    raw = int(round(temperature * 16)) & 0xFFFF
+    scratchpad = [raw & 0xFF, raw >> 8, 0x4B, 0x46, 0x7F, 0xFF, (0x10 - (raw & 0x0F)) & 0xFF, 0x10]
+    scratchpad.append(crc8(scratchpad))
+
+    status = "YES"
+    if crc_error:
+        scratchpad[rng.randint(0, 7)] ^= 1 << rng.randint(0, 7)
+        status = "NO"
+
+    received = " ".join("{0:02x}".format(byte) for byte in scratchpad)
+    signed = scratchpad[0] | (scratchpad[1] << 8)
+    if signed & 0x8000:
+        signed -= 0x10000
+    return "{0} : crc={1:02x} {2}\n{0} t={3}\n".format(received, scratchpad[8], status, signed * 1000 // 16)
+
+
+class SimulatedProbe(object):
+    def __init__(self, serial_id, temperature, latency=DEFAULT_LATENCY, noise=DEFAULT_NOISE,
+                 drift=0.0, crc_failures=0.0):
+        self.serial_id = serial_id
+        self.temperature = temperature  # what the probe would read with no noise or drift
+        self.latency = latency
+        self.noise = noise
+        self.drift = drift  # C per hour
+        self.crc_failures = crc_failures  # 0..1
+        self.started = time.time()
+        self.reads = 0
+
+    def convert(self, rng):
+        self.reads += 1
+        hours = (time.time() - self.started) / 3600.0
+        temperature = self.temperature + self.drift * hours + rng.gauss(0.0, self.noise)
+        return format_w1_slave(temperature, rng.random() < self.crc_failures, rng)
+
+
+# SimulatedBus
+# ============
+# "count" probes spread over a few degrees either side of
+# "temperature", in a directory of our own unless "device_root" says
+# where (it's removed by close() only if we made it). Probes can be
+# plugged in and pulled out while the monitor is running.
+
+class SimulatedBus(tempsensor.W1Bus):
+    def __init__(self, count, device_root=None, temperature=20.0, latency=DEFAULT_LATENCY,
+                 noise=DEFAULT_NOISE, drift=0.0, crc_failures=0.0, seed=None):
+        self._made_root = device_root is None
+        if device_root is None:
+            device_root = tempfile.mkdtemp(prefix="w1sim-")
+        tempsensor.W1Bus.__init__(self, device_root)
+
+        self._rng = random.Random(seed)
+        self._probes = {}
+        self._defaults = {'latency': latency, 'noise': noise, 'drift': drift, 'crc_failures': crc_failures}
+
+        master = os.path.join(device_root, "w1_bus_master1")
+        if not os.path.isdir(master):
+            os.makedirs(master)
+
+        for i in range(count):
+            self.add_probe(temperature=temperature + self._rng.uniform(-3.0, 3.0))
+
+    # add_probe()
+    # ===========
+    # plugs in a probe, with the bus' settings unless they're given.
+    # Returns its serial id, made up when there isn't one.
+    def add_probe(self, serial_id=None, temperature=20.0, **settings):
+        if serial_id is None:
+            serial_id = "{0}{1:012x}".format(tempsensor.DS18B20_FAMILY, SERIAL_BASE + len(self._probes))
+            while serial_id in self._probes:
+                serial_id = "{0}{1:012x}".format(tempsensor.DS18B20_FAMILY, self._rng.getrandbits(48))
+
+        for name, value in self._defaults.items():
+            settings.setdefault(name, value)
+        probe = SimulatedProbe(serial_id, temperature, **settings)
+
+        probe_dir = os.path.join(self._device_root, serial_id)
+        if not os.path.isdir(probe_dir):
+            os.makedirs(probe_dir)
+        self._probes[serial_id] = probe
+        self.write_probe(probe)
+        return serial_id
+
+    def remove_probe(self, serial_id):
+        self._probes.pop(serial_id, None)
+        shutil.rmtree(os.path.join(self._device_root, serial_id), ignore_errors=True)
+
+    def get_probe(self, serial_id):
+        return self._probes.get(serial_id)
+
+    def get_serial_ids(self):
+        return sorted(self._probes.keys())
+
+    # write_probe()
+    # =============
+    # a fresh conversion into the probe's w1_slave, written to the side
+    # and renamed so a reader never sees half a file.
+    def write_probe(self, probe):
+        probe_file = os.path.join(self._device_root, probe.serial_id, "w1_slave")
+        partial = probe_file + ".tmp"
+        with open(partial, "w") as probe_out:
+            probe_out.write(probe.convert(self._rng))
+        os.rename(partial, probe_file)
+
+    def write_all(self):
+        for probe in self._probes.values():
+            self.write_probe(probe)
+
+    # read()
+    # ======
+    # what reading the real w1_slave does: wait for the conversion,
+    # then return the text. The file is written first so what we
+    # hand back went through the same files the kernel would show.
+    def read(self, serial_id):
+        probe = self._probes.get(serial_id)
+        if probe is None:
+            raise IOError("no such device: {0}".format(serial_id))
+
+        if probe.latency > 0:
+            time.sleep(probe.latency)
+        self.write_probe(probe)
+        return tempsensor.W1Bus.read(self, serial_id)
+
+    def close(self):
+        if self._made_root:
+            shutil.rmtree(self._device_root, ignore_errors=True)
+
+
+def create_parser():
+    parser = OptionParser(usage="w1sim.py [options]",
+                          description="Keeps a simulated 1-Wire device tree up to date for monitor.py --w1-devices")
+
+    parser.add_option("-r", "--root", dest="device_root", default=None,
+                      help="directory to put the probes in (default a temporary one)", metavar="DIR")
+
+    parser.add_option("-n", "--sensors", dest="sensors", default=4, type="int",
+                      help="number of probes on the bus")
+
+    parser.add_option("--temperature", dest="temperature", default=20.0, type="float",
+                      help="temperature (C) the probes are around")
+
+    parser.add_option("--noise", dest="noise", default=DEFAULT_NOISE, type="float",
+                      help="standard deviation (C) of each reading")
+
+    parser.add_option("--drift", dest="drift", default=0.0, type="float",
+                      help="C per hour the probes drift by")
+
+    parser.add_option("--crc-failures", dest="crc_failures", default=0.0, type="float",
+                      help="fraction of reads with a bad CRC (0..1)")
+
+    parser.add_option("--seconds", dest="seconds", default=1.0, type="float",
+                      help="how often to write new readings")
+
+    parser.add_option("--seed", dest="seed", default=None, type="int",
+                      help="random seed, for repeatable runs")
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (opts, args) = parser.parse_args()
+
+    if opts.sensors < 0 or not 0.0 <= opts.crc_failures <= 1.0:
+        parser.print_help()
+        sys.exit(-1)
+
+    # the monitor reads the files itself here, so there's no latency
+    # to add, the readings just change underneath it
+    bus = SimulatedBus(opts.sensors, opts.device_root, opts.temperature, 0.0,
+                       opts.noise, opts.drift, opts.crc_failures, opts.seed)
+    print "{0} probes in {1}".format(opts.sensors, bus.get_device_root())
+    try:
+        while True:
+            bus.write_all()
+            time.sleep(opts.seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bus.close()
+
+
+if __name__ == "__main__":
+    main()